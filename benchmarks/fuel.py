@@ -0,0 +1,75 @@
+"""
+Fuel metering benchmark.
+
+Times a loop heavy function (summing 1..n) and a call heavy one (recursive
+countdown) with and without fuel metering, reporting the overhead of
+charging fuel on calls and on loop back edges.
+"""
+import time
+
+from posed.vm import Function, VirtualMachine
+
+
+def sum_to():
+    return Function(nparams=1, returns=True, code=[
+        ('block', [
+            ('loop', [
+                ('const', 0.0),
+                ('local.get', 0),
+                ('ge',),
+                ('br_if', 1),
+                ('local.get', 1),
+                ('local.get', 0),
+                ('add',),
+                ('local.set', 1),
+                ('local.get', 0),
+                ('const', 1.0),
+                ('sub',),
+                ('local.set', 0),
+                ('br', 0),
+            ]),
+        ]),
+        ('local.get', 1),
+    ])
+
+
+def countdown():
+    return Function(nparams=1, returns=True, code=[
+        ('block', [
+            ('const', 0.0),
+            ('local.get', 0),
+            ('ge',),
+            ('br_if', 0),
+            ('local.get', 0),
+            ('const', 1.0),
+            ('sub',),
+            ('call', 0),
+            ('return',),
+        ]),
+        ('local.get', 0),
+    ])
+
+
+def timings(func, n, repeat=40):
+    """Best CPU seconds for a call without and with fuel metering, interleaving the runs."""
+    plain = VirtualMachine(functions=[func])
+    metered = VirtualMachine(functions=[func], fuel=0)
+    best = [float('inf'), float('inf')]
+    for _ in range(repeat):
+        for i, vm in enumerate((plain, metered)):
+            vm.fuel = None if vm is plain else 10 ** 12
+            start = time.process_time()
+            vm.call(func, n)
+            best[i] = min(best[i], time.process_time() - start)
+    return best
+
+
+def main(n=20000):
+    for name, func in (('loop', sum_to()), ('calls', countdown())):
+        plain, metered = timings(func, float(n))
+        print(f'{name:6} {plain * 1e3:7.2f} ms unmetered {metered * 1e3:7.2f} ms metered '
+              f'({(metered / plain - 1) * 100:+.1f}%)')
+
+
+if __name__ == '__main__':
+    main()
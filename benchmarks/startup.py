@@ -0,0 +1,49 @@
+"""
+Startup benchmark for the compiler front end.
+
+Times building a Lexer and Parser:
+    - cold: the first ones in a fresh process, including imports
+    - cached: later ones, sharing the shipped parse tables
+    - uncached: rebuilding the ply lexer and LALR tables every time, as
+      happens without shipped tables on a read only install
+"""
+import subprocess
+import sys
+import timeit
+
+from posed.compiler.lexer import Lexer
+from posed.compiler.parser import Parser
+
+COLD = '''
+import time
+start = time.perf_counter()
+from posed.compiler.lexer import Lexer
+from posed.compiler.parser import Parser
+Parser(Lexer()).parse('1 + 2 * 3 / 4')
+print(time.perf_counter() - start)
+'''
+
+
+def cold():
+    """Seconds to import, build and use a parser in a new process."""
+    output = subprocess.run([sys.executable, '-c', COLD], check=True, capture_output=True, text=True)
+    return float(output.stdout)
+
+
+def cached():
+    Parser(Lexer())
+
+
+def uncached():
+    Parser(Lexer(optimize=False), write_tables=False, debug=False)
+
+
+def main(number=200):
+    print(f'cold:     {cold() * 1e3:8.3f} ms')
+    for func in (cached, uncached):
+        seconds = min(timeit.repeat(func, number=number, repeat=3)) / number
+        print(f'{func.__name__ + ":":9} {seconds * 1e6:8.1f} us per Parser(Lexer())')
+
+
+if __name__ == '__main__':
+    main()
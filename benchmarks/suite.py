@@ -0,0 +1,396 @@
+"""
+Benchmark suite for the VM and compiler with regression tracking.
+
+Each benchmark runs a workload and reports its throughput, instructions
+executed per second for the VM (counted once with a CountingProfiler) and
+characters or AST nodes per second for the compiler front end:
+
+    python -m benchmarks.suite                  # run and compare with the baseline
+    python -m benchmarks.suite --save           # run and save as the new baseline
+    python -m benchmarks.suite calls memory     # only benchmarks matching names
+
+Results are compared with the JSON baseline (benchmarks/baseline.json by
+default) and the run fails if any benchmark is slower than its baseline by
+more than the threshold (a benchmark that seems slower is measured again to
+rule out noise first). Baselines are only comparable on the machine that
+made them so regenerate one (``make bench-baseline``) before comparing
+changes on a new machine.
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import sys
+import time
+
+from posed.compiler.compiler import Compiler
+from posed.compiler.lexer import Lexer
+from posed.compiler.parser import create_parser
+from posed.compiler.scanner import Scanner
+from posed.profiler import CountingProfiler
+from posed.vm import BatchedExternalFunction, ExternalFunction, Function, VirtualMachine
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+#   Allowed slow down relative to the baseline before a run fails
+THRESHOLD = 0.15
+
+#   CPU seconds each measurement runs a workload for, best of REPEAT is kept
+MIN_TIME = 0.05
+REPEAT = 20
+
+BENCHMARKS = {}
+
+
+def benchmark(unit):
+    """Register a function returning (run, work), a workload and the amount of work it does in unit."""
+    def register(func):
+        BENCHMARKS[func.__name__] = (func, unit)
+        return func
+    return register
+
+
+def _vm_workload(functions, program):
+    """A workload executing a program and the number of instructions it executes."""
+    vm = VirtualMachine(functions=functions)
+
+    def run():
+        vm.execute(program)
+        vm.stack.clear()
+
+    with CountingProfiler(vm) as profiler:
+        run()
+    return run, sum(profiler.opcodes().values())
+
+
+def _noop(*args):
+    return 0.0
+
+
+@benchmark('instructions')
+def while_loop(n=20000):
+    #   x = 0; while x < n: show(x); x = x + 1, with x in memory
+    addr = 42
+    program = [
+        ('block', [
+            ('const', addr),
+            ('const', 0.0),
+            ('store',),
+            ('loop', [
+                ('const', float(n)),
+                ('const', addr),
+                ('load',),
+                ('le',),
+                ('br_if', 1),
+                ('const', addr),
+                ('load',),
+                ('call', 0),
+                ('const', addr),
+                ('const', addr),
+                ('load',),
+                ('const', 1.0),
+                ('add',),
+                ('store',),
+                ('br', 0),
+            ]),
+        ]),
+    ]
+    return _vm_workload([ExternalFunction(nparams=1, returns=False, call=_noop)], program)
+
+
+@benchmark('instructions')
+def countdown_iterative(n=50000):
+    countdown = Function(nparams=1, returns=False, code=[
+        ('block', [
+            ('loop', [
+                ('const', 0.0),
+                ('local.get', 0),
+                ('ge',),
+                ('br_if', 1),
+                ('local.get', 0),
+                ('const', 1.0),
+                ('sub',),
+                ('local.set', 0),
+                ('br', 0),
+            ]),
+        ]),
+    ])
+    return _vm_workload([countdown], [('const', float(n)), ('call', 0)])
+
+
+@benchmark('instructions')
+def countdown_recursive(n=20000):
+    countdown = Function(nparams=1, returns=True, code=[
+        ('block', [
+            ('const', 0.0),
+            ('local.get', 0),
+            ('ge',),
+            ('br_if', 0),
+            ('local.get', 0),
+            ('const', 1.0),
+            ('sub',),
+            ('call', 0),
+            ('return',),
+        ]),
+        ('local.get', 0),
+    ])
+    return _vm_workload([countdown], [('const', float(n)), ('call', 0)])
+
+
+@benchmark('instructions')
+def functions(n=5000):
+    #   repeat n times: div(mul(add(1.0, 2.0), 5.0), 3.0)
+    binary = [Function(nparams=2, returns=True, code=[('local.get', 0), ('local.get', 1), (name,)])
+              for name in ('add', 'mul', 'div')]
+    program = [
+        ('block', [
+            ('loop', [
+                ('const', 1.0),
+                ('const', 2.0),
+                ('call', 0),
+                ('const', 5.0),
+                ('call', 1),
+                ('const', 3.0),
+                ('call', 2),
+                ('local.set', 1),
+                ('local.get', 0),
+                ('const', 1.0),
+                ('add',),
+                ('local.set', 0),
+                ('local.get', 0),
+                ('const', float(n)),
+                ('ge',),
+                ('br_if', 1),
+                ('br', 0),
+            ]),
+        ]),
+    ]
+    return _vm_workload(binary, program)
+
+
+@benchmark('instructions')
+def memory(n=4000):
+    #   for each 8 bytes: memory[i] = memory[i] + 1.0, then copy 4 values from memory[0] over it
+    program = [
+        ('block', [
+            ('loop', [
+                ('local.get', 0),
+                ('local.get', 0),
+                ('load',),
+                ('const', 1.0),
+                ('add',),
+                ('store',),
+                ('local.get', 0),
+                ('const', 0),
+                ('load.vec', 4),
+                ('store.vec', 4),
+                ('local.get', 0),
+                ('const', 8),
+                ('add',),
+                ('local.set', 0),
+                ('local.get', 0),
+                ('const', 8 * n),
+                ('ge',),
+                ('br_if', 1),
+                ('br', 0),
+            ]),
+        ]),
+    ]
+    return _vm_workload([], [('const', 0), ('local.set', 0), *program])
+
+
+@benchmark('instructions')
+def external_calls(n=20000):
+    #   for i in range(n): total = f(total, i)
+    program = [
+        ('block', [
+            ('loop', [
+                ('local.get', 1),
+                ('local.get', 0),
+                ('call', 0),
+                ('local.set', 1),
+                ('local.get', 0),
+                ('const', 1.0),
+                ('add',),
+                ('local.set', 0),
+                ('local.get', 0),
+                ('const', float(n)),
+                ('ge',),
+                ('br_if', 1),
+                ('br', 0),
+            ]),
+        ]),
+    ]
+    return _vm_workload([ExternalFunction(nparams=2, returns=True, call=_noop)], program)
+
+
+@benchmark('instructions')
+def batched_calls(n=20000):
+    #   for i in range(n): show(i), with the calls to show batched
+    program = [
+        ('block', [
+            ('loop', [
+                ('local.get', 0),
+                ('call', 0),
+                ('local.get', 0),
+                ('const', 1.0),
+                ('add',),
+                ('local.set', 0),
+                ('local.get', 0),
+                ('const', float(n)),
+                ('ge',),
+                ('br_if', 1),
+                ('br', 0),
+            ]),
+        ]),
+    ]
+    return _vm_workload([BatchedExternalFunction(nparams=1, call=_noop)], program)
+
+
+def _expression(n=300):
+    """A large expression of n terms."""
+    return ' + '.join(f'({i}.5 * {i % 7} - {i % 3}) / 4' for i in range(n))
+
+
+@benchmark('chars')
+def lexer():
+    text = _expression()
+    lexer = Lexer()._lexer
+
+    def run():
+        lexer.input(text)
+        while lexer.token():
+            pass
+
+    return run, len(text)
+
+
+@benchmark('chars')
+def scanner():
+    text = _expression()
+    scanner = Scanner()
+    return (lambda: collections.deque(scanner.tokenize(text), maxlen=0)), len(text)
+
+
+def _parse(frontend):
+    text = _expression()
+    parser = create_parser(frontend)
+    return (lambda: parser.parse(text)), len(text)
+
+
+@benchmark('chars')
+def parser_ply():
+    return _parse('ply')
+
+
+@benchmark('chars')
+def parser_pratt():
+    return _parse('pratt')
+
+
+@benchmark('nodes')
+def compiler():
+    ast = create_parser('pratt').parse(_expression())
+    compiler = Compiler()
+    return (lambda: compiler.compile(ast)), len(compiler.compile(ast))
+
+
+def measure(run, min_time=MIN_TIME, repeat=REPEAT):
+    """Best seconds per call of run, each measurement calling it for at least min_time."""
+    start = time.process_time()
+    run()       # warms up and calibrates
+    number = max(1, round(min_time / (time.process_time() - start)))
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.process_time()
+        for _ in range(number):
+            run()
+        best = min(best, (time.process_time() - start) / number)
+    return best
+
+
+def select(patterns):
+    """Names of the benchmarks containing one of patterns, all of them if there are none."""
+    return [name for name in BENCHMARKS if not patterns or any(pattern in name for pattern in patterns)]
+
+
+def run_benchmarks(names, results=None):
+    """Rates by benchmark name, keeping the better of each and any rate already in results."""
+    results = dict(results or {})
+    for name in names:
+        setup, unit = BENCHMARKS[name]
+        run, work = setup()
+        rate = work / measure(run)
+        print(f'{name:24} {rate:14,.0f} {unit}/s', flush=True)
+        if name not in results or rate > results[name]['rate']:
+            results[name] = {'rate': rate, 'unit': f'{unit}/s'}
+    return results
+
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)['results']
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(path, results):
+    baseline = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=4, sort_keys=True)
+        f.write('\n')
+
+
+def regressions(results, baseline, threshold=THRESHOLD):
+    """(name, change) for results slower than their baseline by more than threshold, change is relative."""
+    slower = []
+    for name, result in results.items():
+        if name in baseline:
+            change = result['rate'] / baseline[name]['rate'] - 1
+            if change < -threshold:
+                slower.append((name, change))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('names', nargs='*', help='only run benchmarks with a name containing one of these')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline JSON file')
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='fail if slower than the baseline by more than this fraction')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(select(args.names))
+    if args.save:
+        baseline = load_baseline(args.baseline)
+        baseline.update(results)
+        save_baseline(args.baseline, baseline)
+        print(f'saved baseline to {args.baseline}')
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    slower = regressions(results, baseline, args.threshold)
+    if slower:
+        #   timings are noisy, a regression has to be reproduced to count
+        print('\nmeasuring again:')
+        results = run_benchmarks([name for name, _ in slower], results)
+        slower = regressions(results, baseline, args.threshold)
+    print()
+    for name, result in results.items():
+        if name in baseline:
+            change = result['rate'] / baseline[name]['rate'] - 1
+            print(f'{name:24} {change * 100:+7.1f}% vs baseline')
+    for name, change in slower:
+        print(f'REGRESSION: {name} is {-change * 100:.1f}% slower than the baseline', file=sys.stderr)
+    return 1 if slower else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
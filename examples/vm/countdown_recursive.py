@@ -1,6 +1,6 @@
 import logging
 
-from posed.vm import VirtualMachine, Function, ExternalFunction
+from posed.vm import logging_setup, VirtualMachine, Function, ExternalFunction
 
 
 def main():
@@ -46,6 +46,7 @@ def main():
         countdown,
     ]
 
+    logging_setup()
     vm = VirtualMachine(functions=functions, debug=False)
     vm.execute(instructions=program, locals_=None)
 
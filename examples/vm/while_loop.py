@@ -1,6 +1,6 @@
 import logging
 
-from posed.vm import VirtualMachine, ExternalFunction
+from posed.vm import logging_setup, VirtualMachine, ExternalFunction
 
 
 def main():
@@ -49,6 +49,7 @@ def main():
         ExternalFunction(nparams=1, returns=False, call=show_value),
     ]
 
+    logging_setup()
     vm = VirtualMachine(functions=functions, debug=False)
     vm.execute(instructions=program, locals_=None)
 
@@ -0,0 +1,62 @@
+"""
+Running guest programs as asyncio coroutines.
+
+Guests calling async external functions (``AsyncExternalFunction``) await
+them rather than block the event loop, so many guests, each with its own VM,
+can be run concurrently on one loop:
+
+   async def fetch(key):
+       ...
+
+   functions = [AsyncExternalFunction(nparams=1, returns=True, call=fetch), ...]
+   vms = [VirtualMachine(functions, fuel=0) for _ in programs]
+   await asyncio.gather(*(execute(vm, program, quantum=1000) for vm, program in zip(vms, programs)))
+
+With a ``quantum`` a metered VM (one created with ``fuel``) is given that
+much fuel at a time and yields to the event loop whenever it runs out, so
+busy guests are time sliced rather than holding up the others (a loop or
+call costing more than the quantum gets a slice big enough to run it once).
+Without one running out of fuel raises OutOfFuel as usual.
+"""
+import asyncio
+import functools
+
+from posed.vm import Function, OutOfFuel, Suspended, _check_args
+
+
+async def _drive(vm, step, quantum):
+    """Run step() resuming vm at every suspension until it completes."""
+    if quantum is not None:
+        vm.fuel = quantum
+    while True:
+        try:
+            return step()
+        except OutOfFuel as e:
+            if quantum is None:
+                raise
+            await asyncio.sleep(0)
+            #   a slice smaller than the charge that ran out would never get past it
+            step = functools.partial(vm.resume, e.state, max(quantum, e.cost))
+        except Suspended as e:
+            result = await e.awaitable
+            if e.returns:
+                vm.push(result)
+            step = functools.partial(vm.resume, e.state)
+
+
+async def execute(vm, instructions, locals_=None, quantum=None):
+    """Execute instructions on vm, awaiting async external calls, leaving results on vm.stack."""
+    await _drive(vm, functools.partial(vm.execute, instructions, locals_), quantum)
+
+
+async def call(vm, func, *args, quantum=None):
+    """Call a function on vm, awaiting async external calls, returning its result."""
+    if not isinstance(func, Function):
+        result = func.call(*args)
+        return await result if func.awaitable else result
+    _check_args(func, args)
+    code = vm._load(func)
+    locals_ = [*args, *code.zeros]
+    await _drive(vm, functools.partial(vm.run, code, locals_), quantum)
+    if func.returns:
+        return vm.pop()
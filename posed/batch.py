@@ -0,0 +1,207 @@
+"""
+Batch execution of VM code over many inputs at once with NumPy.
+
+Every value on the stack and in a local is an array with one element (lane)
+per input, so a program is interpreted once for a whole data set rather than
+once per row. ``const``, ``local.get`` and the binary operators work column
+wise.
+
+Branches
+--------
+Lanes may disagree on a ``br_if``. Execution then continues with a mask of
+the lanes still active, the others wait at the label they branched to:
+
+- ``br``/``br_if`` deactivate the (taking) lanes and park them, along with
+  their view of the stack, at the target label
+- at the end of a ``block`` the lanes that branched to it are reactivated
+- a ``loop`` body is re-run while any lane branched back to it, lanes that
+  fall off the end wait until every lane has left the loop
+- ``return`` deactivates lanes for the rest of the function
+
+Writes to locals only affect active lanes and instructions are skipped once
+no lane is active. The stack height at a label must be the same on every
+path to it (as for a wasm block without results) so the stacks of lanes
+rejoining there can be merged.
+
+Differences from VirtualMachine
+-------------------------------
+- memory instructions aren't supported, there's no per lane memory
+- external functions are called once per instruction with arrays holding the
+  arguments of the active lanes and must return an array of results
+- functions get their own stack and must leave exactly their return value
+- division by zero gives inf or nan as for NumPy rather than raising
+"""
+try:
+    import numpy as np
+except ImportError:     # optional, pip install posed[batch]
+    np = None
+
+from posed.vm import (
+    BINARY_OPS, Function, InvalidBranch, InvalidOpcode, VirtualMachineError, load_function, lower,
+)
+
+
+def _size(columns, size):
+    """The number of lanes for some columns of input."""
+    if size is None:
+        size = np.broadcast(*columns).size if columns else 1
+    return size
+
+
+class _Label:
+    """Lanes waiting at a label with the stack they had when they branched to it."""
+    def __init__(self, size):
+        self.mask = np.zeros(size, dtype=bool)
+        self.stack = None
+
+    def add(self, mask, stack):
+        if not mask.any():
+            return
+        if self.stack is None:
+            self.stack = list(stack)
+        elif len(stack) != len(self.stack):
+            raise VirtualMachineError(
+                f'Stack height {len(stack)} differs from {len(self.stack)} at a label')
+        else:
+            self.stack = [np.where(mask, new, old) for new, old in zip(stack, self.stack)]
+        self.mask |= mask
+
+
+class _Frame:
+    """State of a function call."""
+    def __init__(self, locals_, active, returns=False):
+        self.locals = locals_
+        self.active = active        # lanes currently executing
+        self.returns = returns
+        self.result = np.zeros(len(active))
+
+
+class BatchVirtualMachine:
+    """Runs VM code over many inputs at once, stack values are arrays with an element per input."""
+    def __init__(self, functions):
+        if np is None:
+            raise ImportError('Batch execution requires numpy, pip install posed[batch]')
+        self.functions = functions
+        self.stack = []
+        self.size = 0
+        self._nlocals = {}
+
+    def push(self, item):
+        """Push a value onto the stack."""
+        self.stack.append(item)
+
+    def pop(self):
+        """Pop a value off the stack as an array with an element per input."""
+        return np.broadcast_to(self.stack.pop(), (self.size,))
+
+    def call(self, func, *args, size=None):
+        """Call a function with a column of values per parameter, returning a column of results."""
+        self.size = _size(args, size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = self._call(func, args, np.ones(self.size, dtype=bool))
+        return np.broadcast_to(result, (self.size,))
+
+    def execute(self, instructions, locals_=(), size=None):
+        """Execute instructions with locals_ as columns of initial local values."""
+        self.size = _size(locals_, size)
+        frame = _Frame(self._locals(locals_, lower(instructions).nlocals), np.ones(self.size, dtype=bool))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self._execute(instructions, frame, [])
+
+    def _locals(self, values, nlocals):
+        """Columns for the locals of a frame."""
+        locals_ = [np.broadcast_to(value, (self.size,)) for value in values]
+        locals_.extend(np.zeros(self.size) for _ in range(nlocals - len(values)))
+        return locals_
+
+    def _call(self, func, args, active):
+        if isinstance(func, Function):
+            nlocals = self._nlocals.get(func)
+            if nlocals is None:
+                nlocals = self._nlocals[func] = load_function(func).nlocals
+            frame = _Frame(self._locals(args, nlocals), active.copy(), func.returns)
+            caller_stack = self.stack
+            self.stack = []
+            try:
+                self._execute(func.code, frame, [])
+                if func.returns and frame.active.any():
+                    frame.result = np.where(frame.active, self.stack.pop(), frame.result)
+            finally:
+                self.stack = caller_stack
+            return frame.result
+        else:
+            if func.awaitable:
+                raise VirtualMachineError('Async external functions are not supported in batch mode')
+            #   a batched function is already given every active lane's arguments at once
+            call = func.host if func.batched else func.call
+            result = call(*(np.broadcast_to(arg, (self.size,))[active] for arg in args))
+            if func.returns:
+                results = np.zeros(self.size)
+                results[active] = result
+                return results
+
+    def _execute(self, instructions, frame, labels):
+        #   labels holds a _Label for each enclosing block/loop, innermost last
+        for opcode, *args in instructions:
+            if not frame.active.any():
+                return      # the rest is unreachable for every lane
+            if opcode == 'const':
+                #   NumPy scalars so constant division by zero gives inf/nan too
+                self.stack.append(np.float64(args[0]))
+            elif opcode in BINARY_OPS:
+                right = self.stack.pop()
+                left = self.stack.pop()
+                #   comparisons give bool arrays, for which + is or and - raises, as floats they add up as in the VM
+                self.stack.append(np.asarray(BINARY_OPS[opcode](left, right), dtype=float))
+            elif opcode == 'local.get':
+                self.stack.append(frame.locals[args[0]])
+            elif opcode == 'local.set':
+                frame.locals[args[0]] = np.where(frame.active, self.stack.pop(), frame.locals[args[0]])
+            elif opcode == 'call':
+                func = self.functions[args[0]]
+                fargs = [self.stack.pop() for _ in range(func.nparams)][::-1]
+                result = self._call(func, fargs, frame.active)
+                if func.returns:
+                    self.stack.append(result)
+            elif opcode in ('br', 'br_if'):
+                level = args[0]
+                if not 0 <= level < len(labels):
+                    raise InvalidBranch(f'Branch level {level} exceeds nesting depth {len(labels)}')
+                taking = frame.active
+                if opcode == 'br_if':
+                    taking = taking & np.asarray(self.stack.pop(), dtype=bool)
+                labels[-1 - level].add(taking, self.stack)
+                frame.active = frame.active & ~taking
+            elif opcode == 'block':
+                label = _Label(self.size)
+                self._execute(args[0], frame, labels + [label])
+                self._join(frame, label)
+            elif opcode == 'loop':
+                exits = _Label(self.size)
+                while True:
+                    label = _Label(self.size)
+                    self._execute(args[0], frame, labels + [label])
+                    exits.add(frame.active, self.stack)
+                    if label.stack is None:
+                        break
+                    frame.active = label.mask
+                    self.stack = label.stack
+                frame.active = exits.mask
+                if exits.stack is not None:
+                    self.stack = exits.stack
+            elif opcode == 'return':
+                if frame.returns:
+                    frame.result = np.where(frame.active, self.stack.pop(), frame.result)
+                frame.active = np.zeros(self.size, dtype=bool)
+            else:
+                raise InvalidOpcode(f'Unsupported opcode {opcode} in batch mode')
+
+    def _join(self, frame, label):
+        """Reactivate the lanes waiting at the end of a block."""
+        fallthrough = _Label(self.size)
+        fallthrough.add(frame.active, self.stack)
+        if label.stack is not None:
+            fallthrough.add(label.mask, label.stack)
+        frame.active = fallthrough.mask
+        if fallthrough.stack is not None:
+            self.stack = fallthrough.stack
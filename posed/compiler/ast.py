@@ -1,21 +1,39 @@
-"""Classes for various AST objects generated by the parser."""
+"""Classes for various AST objects generated by the parser.
+
+Nodes have ``__slots__`` to keep large machine generated ASTs compact and
+operators are stateless singletons, ``Add() is Add()``.
+"""
+
+#   The instance of each Operator class
+_operators = {}
 
 
 class Operator:
+    __slots__ = ()
+
+    def __new__(cls):
+        instance = _operators.get(cls)
+        if instance is None:
+            instance = _operators[cls] = super().__new__(cls)
+        return instance
+
     def __repr__(self):
         return f"{self.__class__.__name__}()"
 
 
-class Add(Operator): pass
-class Sub(Operator): pass
-class Mul(Operator): pass
-class Div(Operator): pass
+class Add(Operator): __slots__ = ()
+class Sub(Operator): __slots__ = ()
+class Mul(Operator): __slots__ = ()
+class Div(Operator): __slots__ = ()
 
 
-class Expr: pass
+class Expr:
+    __slots__ = ()
 
 
 class Constant(Expr):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -24,6 +42,8 @@ class Constant(Expr):
 
 
 class BinaryOp(Expr):
+    __slots__ = ('left', 'op', 'right')
+
     def __init__(self, left, op, right):
         self.left = left
         self.right = right
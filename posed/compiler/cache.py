@@ -0,0 +1,112 @@
+"""
+A cache of compiled programs keyed on their source text.
+
+Parsing dominates the cost of compiling an expression, so programs that are
+submitted again and again are only parsed, optimised and compiled the first
+time. The cache holds at most ``maxsize`` programs, evicting the least
+recently used one when it's full.
+
+   >>> cache = CompileCache(maxsize=1024)
+   >>> cache.compile('1 + 2 * 3')
+   [('const', 7.0)]
+   >>> cache.compile('1 + 2 * 3')
+   [('const', 7.0)]
+   >>> cache.hits, cache.misses
+   (1, 1)
+
+Persistence
+-----------
+Given a ``path`` the cache is loaded from that file when it's created and
+written back by ``save()``, so a restarted process is warm immediately. The
+file is JSON, most recently used program last, and is replaced atomically.
+A missing or unreadable file just gives an empty cache.
+"""
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+from posed.compiler.compiler import Compiler
+from posed.compiler.optimizer import Optimizer
+from posed.compiler.parser import create_parser
+
+MAX_SIZE = 4096
+
+#   Bumped if the instructions compiled for some source text change
+FORMAT_VERSION = 1
+
+
+class CompileCache:
+    """An LRU cache mapping source text to the instructions compiled from it."""
+    def __init__(self, maxsize=MAX_SIZE, path=None, frontend='ply'):
+        if maxsize < 1:
+            raise ValueError(f'Cache size must be positive, got {maxsize}')
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._programs = OrderedDict()
+        self._parser = create_parser(frontend)
+        self._optimizer = Optimizer()
+        self._compiler = Compiler()
+        if path is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self._programs)
+
+    def __contains__(self, text):
+        return text in self._programs
+
+    def compile(self, text):
+        """Instructions for source text, or None if it doesn't parse."""
+        program = self._programs.get(text)
+        if program is not None:
+            self.hits += 1
+            self._programs.move_to_end(text)
+            return list(program)
+        self.misses += 1
+        ast = self._parser.parse(text)
+        if ast is None:
+            return None     # not cached so the syntax error is reported every time
+        program = self._compiler.compile(self._optimizer.optimize(ast))
+        self._add(text, tuple(program))
+        return program
+
+    def _add(self, text, program):
+        self._programs[text] = program
+        self._programs.move_to_end(text)
+        if len(self._programs) > self.maxsize:
+            self._programs.popitem(last=False)
+
+    def clear(self):
+        """Remove every program and reset the counters."""
+        self._programs.clear()
+        self.hits = self.misses = 0
+
+    def load(self):
+        """Add the programs saved at path."""
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(saved, dict) or saved.get('version') != FORMAT_VERSION:
+            return
+        for text, program in saved['programs']:
+            self._add(text, tuple(tuple(instruction) for instruction in program))
+
+    def save(self):
+        """Write the programs to path."""
+        if self.path is None:
+            raise ValueError('No path to save the cache to')
+        saved = {'version': FORMAT_VERSION, 'programs': list(self._programs.items())}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.posed-cache-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(saved, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
@@ -1,36 +1,52 @@
 """A simple compiler targeting the instruction set for the VM."""
 
-from posed.compiler.ast import BinaryOp, Constant, Add, Sub, Mul, Div
+from posed.compiler.ast import BinaryOp, Constant, Operator, Add, Sub, Mul, Div
 from posed.compiler.lexer import Lexer
+from posed.compiler.optimizer import Optimizer
 from posed.compiler.parser import Parser
 from posed.vm import VirtualMachine
 
 
+#   The instruction for each operator
+INSTRUCTIONS = {
+    Add: ('add',),
+    Sub: ('sub',),
+    Mul: ('mul',),
+    Div: ('div',),
+}
+
+
 class Compiler:
     def compile(self, expr, instructions=None):
         """Converts an AST into a set of executable VM instructions."""
         if instructions is None:
             instructions = []
-        if isinstance(expr, Constant):
-            instructions.append(('const', expr.value))
-        elif isinstance(expr, Add):
-            instructions.append(('add',))
-        elif isinstance(expr, Sub):
-            instructions.append(('sub',))
-        elif isinstance(expr, Mul):
-            instructions.append(('mul',))
-        elif isinstance(expr, Div):
-            instructions.append(('div',))
-        elif isinstance(expr, BinaryOp):
-            self.compile(expr.left, instructions)
-            self.compile(expr.right, instructions)
-            self.compile(expr.op, instructions)
+        instructions.extend(self.iter_compile(expr))
         return instructions
 
+    def iter_compile(self, expr):
+        """Generate the instructions for an AST in order.
+
+        Nodes are visited with an explicit stack rather than recursion, so
+        there is no limit on the depth of an AST.
+        """
+        pending = [expr]
+        while pending:
+            node = pending.pop()
+            if isinstance(node, BinaryOp):
+                pending.append(node.op)
+                pending.append(node.right)
+                pending.append(node.left)
+            elif isinstance(node, Constant):
+                yield ('const', node.value)
+            elif isinstance(node, Operator):
+                yield INSTRUCTIONS[type(node)]
+
 
 def main():
     lexer = Lexer()
     parser = Parser(lexer)
+    optimizer = Optimizer()
     compiler = Compiler()
 
     program = '1 + 2 * 3 / 4'
@@ -39,6 +55,9 @@ def main():
     ast = parser.parse(program)
     print(f'ast: {ast!r}')
 
+    ast = optimizer.optimize(ast)
+    print(f'optimised: {ast!r} ({len(optimizer.folded)} folded)')
+
     program = compiler.compile(ast)
     print(f'program: {program!r}')
 
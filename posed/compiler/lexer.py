@@ -1,20 +1,23 @@
 import ply.lex as lex
 
+from posed.compiler.tokens import TOKENS
+
+#   ply lexers built once per Lexer class and cloned for each instance
+_templates = {}
+
 
 class Lexer:
     def __init__(self, **kwargs):
-        self._lexer = lex.lex(module=self, **kwargs)
+        if kwargs:
+            self._lexer = lex.lex(module=self, **kwargs)
+        else:
+            template = _templates.get(type(self))
+            if template is None:
+                template = _templates[type(self)] = lex.lex(module=self)
+            self._lexer = template.clone(self)
 
     # List of token names
-    tokens = (
-        'NUMBER',
-        'PLUS',
-        'MINUS',
-        'TIMES',
-        'DIVIDE',
-        'LPAREN',
-        'RPAREN',
-    )
+    tokens = TOKENS
 
     # Regular expression rules for simple tokens
     t_PLUS = r'\+'
@@ -0,0 +1,103 @@
+"""An optimiser simplifying ASTs before they are compiled."""
+import math
+import operator as op
+
+from posed.compiler.ast import BinaryOp, Constant, Add, Sub, Mul, Div
+from posed.compiler.lexer import Lexer
+from posed.compiler.parser import Parser
+
+OPERATORS = {
+    Add: op.add,
+    Sub: op.sub,
+    Mul: op.mul,
+    Div: op.truediv,
+}
+
+
+def _is(expr, value):
+    """Whether expr is a constant equal to value, including the sign of zero."""
+    return (isinstance(expr, Constant)
+            and expr.value == value
+            and math.copysign(1.0, expr.value) == math.copysign(1.0, value))
+
+
+class Optimizer:
+    """Folds constant subexpressions and simplifies algebraic identities.
+
+    Only rewrites that give bit for bit the same result under IEEE 754 are
+    made, so x + 0 isn't simplified (-0.0 + 0.0 is 0.0) but x + -0 is.
+    """
+    def __init__(self):
+        self.folded = []    # (original, replacement) for each rewrite of the last AST optimised
+
+    def optimize(self, expr):
+        """Returns an optimised copy of an AST."""
+        self.folded = []
+        #   Post order with an explicit stack, so there's no limit on the depth of an AST
+        results = []
+        pending = [(expr, False)]
+        while pending:
+            node, visited = pending.pop()
+            if not isinstance(node, BinaryOp):
+                results.append(node)
+            elif not visited:
+                pending.append((node, True))
+                pending.append((node.right, False))
+                pending.append((node.left, False))
+            else:
+                right = results.pop()
+                left = results.pop()
+                results.append(self._rewrite(node, left, right))
+        return results.pop()
+
+    def _rewrite(self, expr, left, right):
+        """A BinaryOp given its optimised operands."""
+        result = self._simplify(expr.op, left, right)
+        if result is None:
+            if left is expr.left and right is expr.right:
+                return expr
+            return BinaryOp(left, expr.op, right)
+        self.folded.append((expr, result))
+        return result
+
+    def _simplify(self, operator, left, right):
+        if isinstance(left, Constant) and isinstance(right, Constant):
+            try:
+                return Constant(OPERATORS[type(operator)](left.value, right.value))
+            except ZeroDivisionError:
+                return None     # left for the VM to raise at runtime
+        if isinstance(operator, Mul):
+            if _is(right, 1.0):
+                return left
+            if _is(left, 1.0):
+                return right
+        elif isinstance(operator, Div):
+            if _is(right, 1.0):
+                return left
+        elif isinstance(operator, Add):
+            if _is(right, -0.0):
+                return left
+            if _is(left, -0.0):
+                return right
+        elif isinstance(operator, Sub):
+            if _is(right, 0.0):
+                return left
+        return None
+
+
+def main():
+    lexer = Lexer()
+    parser = Parser(lexer)
+    optimizer = Optimizer()
+
+    program = '1 + 2 * 3 / 4'
+    print(f'expr: {program!r}')
+
+    ast = optimizer.optimize(parser.parse(program))
+    print(f'ast: {ast!r}')
+    for original, replacement in optimizer.folded:
+        print(f'folded: {original!r} -> {replacement!r}')
+
+
+if __name__ == '__main__':
+    main()
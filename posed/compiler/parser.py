@@ -1,13 +1,40 @@
-import ply.yacc as yacc
+import os
+import threading
 
-from posed.compiler.lexer import Lexer
 from posed.compiler.ast import BinaryOp, Add, Sub, Mul, Div, Constant
+from posed.compiler.pratt import PrattParser
+
+#   ply (and the Lexer built on it) is imported where it's used so the pratt
+#   front end can be used without loading it
+
+#   Parse tables shipped with the package, regenerate with `make parsetab`
+TABMODULE = 'posed.compiler.parsetab'
+
+#   ply parsers aren't thread safe so each thread gets its own
+_parsers = threading.local()
 
 
 class Parser:
     def __init__(self, lexer, **kwargs):
         self.tokens = lexer.tokens
-        self._parser = yacc.yacc(module=self, **kwargs)
+        self._lexer = lexer
+        if kwargs:
+            import ply.yacc as yacc
+            self._parser = yacc.yacc(module=self, **kwargs)
+        else:
+            self._parser = self._shared_parser()
+
+    def _shared_parser(self):
+        """A ply parser built from the shipped tables, shared by instances of this class in a thread."""
+        parsers = _parsers.__dict__.setdefault('by_class', {})
+        parser = parsers.get(type(self))
+        if parser is None:
+            import ply.yacc as yacc
+            #   optimize skips regenerating the tables if the grammar's signature
+            #   doesn't match, tests check the shipped tables are up to date
+            parser = parsers[type(self)] = yacc.yacc(
+                module=self, tabmodule=TABMODULE, optimize=True, debug=False, write_tables=False)
+        return parser
 
     def p_expression_plus(self, p):
         'expression : expression PLUS term'
@@ -47,10 +74,44 @@ class Parser:
 
     def parse(self, data):
         """Generate an AST for the specified program."""
-        return self._parser.parse(data)
+        return self._parser.parse(data, lexer=self._lexer._lexer)
+
+
+def parse(data):
+    """Parse data with a parser shared by the current thread."""
+    parser = getattr(_parsers, 'default', None)
+    if parser is None:
+        from posed.compiler.lexer import Lexer
+        parser = _parsers.default = Parser(Lexer())
+    return parser.parse(data)
+
+
+def create_parser(frontend='ply'):
+    """A parser for a front end, 'ply' (Lexer and Parser) or 'pratt' (Scanner and PrattParser)."""
+    if frontend == 'ply':
+        from posed.compiler.lexer import Lexer
+        return Parser(Lexer())
+    elif frontend == 'pratt':
+        return PrattParser()
+    raise ValueError(f'Unknown front end {frontend!r}')
+
+
+def write_tables():
+    """Regenerate the parse tables shipped with the package."""
+    import ply.yacc as yacc
+    from posed.compiler.lexer import Lexer
+    outputdir = os.path.dirname(__file__)
+    #   ply keeps tables whose grammar signature matches, even with stale line numbers
+    try:
+        os.remove(os.path.join(outputdir, TABMODULE.rsplit('.', 1)[-1] + '.py'))
+    except FileNotFoundError:
+        pass
+    yacc.yacc(module=Parser(Lexer(), write_tables=False, debug=False), tabmodule=TABMODULE,
+              outputdir=outputdir, debug=False)
 
 
 def main():
+    from posed.compiler.lexer import Lexer
     lexer = Lexer()
     parser = Parser(lexer)
     program = '1 + 2 * 3 / 4'
@@ -0,0 +1,66 @@
+"""A precedence climbing (Pratt) parser building the same ASTs as the ply Parser."""
+from posed.compiler.ast import BinaryOp, Add, Sub, Mul, Div, Constant
+from posed.compiler.scanner import Scanner
+
+#   token -> (binding power, operator)
+BINARY = {
+    'PLUS': (10, Add),
+    'MINUS': (10, Sub),
+    'TIMES': (20, Mul),
+    'DIVIDE': (20, Div),
+}
+
+
+class ParseError(Exception):
+    pass
+
+
+class PrattParser:
+    def __init__(self, lexer=None):
+        if lexer is None:
+            lexer = Scanner()
+        self.tokens = lexer.tokens
+        self._lexer = lexer
+
+    def parse(self, data):
+        """Generate an AST for the specified program, a string or a file like object."""
+        self._tokens = self._lexer.tokenize(data)
+        self._advance()
+        try:
+            expr = self._expression(0)
+            if self._type is not None:
+                raise ParseError(self._type)
+        except ParseError:
+            print("Syntax error in input!")
+            return None
+        finally:
+            self._tokens = None
+        return expr
+
+    def _advance(self):
+        self._type, self._value = next(self._tokens, (None, None))
+
+    def _expression(self, min_power):
+        """Parse operands joined by operators binding tighter than min_power."""
+        left = self._factor()
+        while self._type in BINARY:
+            power, operator = BINARY[self._type]
+            if power <= min_power:
+                break
+            self._advance()
+            left = BinaryOp(op=operator(), left=left, right=self._expression(power))
+        return left
+
+    def _factor(self):
+        if self._type == 'NUMBER':
+            expr = Constant(self._value)
+            self._advance()
+        elif self._type == 'LPAREN':
+            self._advance()
+            expr = self._expression(0)
+            if self._type != 'RPAREN':
+                raise ParseError(self._type)
+            self._advance()
+        else:
+            raise ParseError(self._type)
+        return expr
@@ -1,19 +1,22 @@
-from posed.compiler.lexer import Lexer
-from posed.compiler.parser import Parser
-from posed.compiler.compiler import Compiler
+from posed.compiler.cache import MAX_SIZE, CompileCache
 from posed.vm import VirtualMachine
 
 
 class REPL:
     """An interactive REPL (read evaluate print loop)."""
-    def __init__(self):
-        self._lexer = Lexer()
-        self._parser = Parser(self._lexer)
-        self._compiler = Compiler()
+    def __init__(self, frontend='ply', cache_size=MAX_SIZE, cache_path=None):
+        self._cache = CompileCache(maxsize=cache_size, path=cache_path, frontend=frontend)
         self._vm = VirtualMachine(functions=[], debug=False)
 
     def start(self, prompt='> '):
         """Start the REPL."""
+        try:
+            self._loop(prompt)
+        finally:
+            if self._cache.path is not None:
+                self._cache.save()
+
+    def _loop(self, prompt):
         while True:
             try:
                 text = input(prompt)
@@ -21,8 +24,9 @@ class REPL:
                 break
             if not text:
                 continue
-            ast = self._parser.parse(text)
-            program = self._compiler.compile(ast)
+            program = self._cache.compile(text)
+            if program is None:
+                continue
             self._vm.execute(instructions=program, locals_=None)
             print(self._vm.pop())
 
@@ -0,0 +1,59 @@
+"""A single pass regex scanner producing the same tokens as the ply Lexer."""
+import re
+
+from posed.compiler.tokens import TOKENS
+
+#   Same rules (and order) as Lexer, plus catch alls for whitespace and errors
+TOKEN_RE = re.compile(r'''
+    (?P<NUMBER>\d+\.?\d?)
+  | (?P<newline>\n+)
+  | (?P<ignore>[ \t]+)
+  | (?P<PLUS>\+)
+  | (?P<MINUS>-)
+  | (?P<TIMES>\*)
+  | (?P<DIVIDE>/)
+  | (?P<LPAREN>\()
+  | (?P<RPAREN>\))
+  | (?P<error>.)
+''', re.VERBOSE | re.DOTALL)
+
+#   Characters read at a time from files
+CHUNK_SIZE = 65536
+
+
+class Scanner:
+    """Tokenises strings or files lazily, one (type, value) pair at a time."""
+    tokens = TOKENS
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.lineno = 1
+
+    def tokenize(self, data):
+        """Generate (type, value) tokens from a string or a file like object."""
+        self.lineno = 1
+        if isinstance(data, str):
+            yield from self._scan(data, final=True)
+            return
+        carry = ''
+        while True:
+            chunk = data.read(self.chunk_size)
+            carry = yield from self._scan(carry + chunk, final=not chunk)
+            if not chunk:
+                break
+
+    def _scan(self, text, final):
+        """Generate tokens from text, returning any trailing text that may continue in the next chunk."""
+        for match in TOKEN_RE.finditer(text):
+            kind = match.lastgroup
+            if not final and match.end() == len(text) and kind in ('NUMBER', 'newline', 'ignore'):
+                return text[match.start():]
+            if kind == 'NUMBER':
+                yield kind, float(match.group())
+            elif kind == 'newline':
+                self.lineno += len(match.group())
+            elif kind == 'error':
+                print("Illegal character '%s'" % match.group())
+            elif kind != 'ignore':
+                yield kind, match.group()
+        return ''
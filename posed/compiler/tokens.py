@@ -0,0 +1,11 @@
+"""Token types shared by the front ends, kept apart from the ply Lexer so the Scanner doesn't need ply."""
+
+TOKENS = (
+    'NUMBER',
+    'PLUS',
+    'MINUS',
+    'TIMES',
+    'DIVIDE',
+    'LPAREN',
+    'RPAREN',
+)
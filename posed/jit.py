@@ -0,0 +1,235 @@
+"""
+A tier up compiler translating VM functions into Python functions.
+
+The structured instructions of a function are translated into Python source
+where the operand stack is tracked at translation time, so values live in
+Python local variables rather than on ``VirtualMachine.stack``. Every
+``block``/``loop`` becomes a ``while True`` loop, a branch to a block is a
+``break`` and a branch to a loop is a ``continue``. Branches out of more than
+one level set ``br`` to the number of levels left to cross and break.
+
+   ('block', [                          while True:
+       ('loop', [                           while True:
+           ('const', 0.0),                      t1 = 0.0 >= l0
+           ('local.get', 0),                    if t1:
+           ('ge',),                                 br = 1
+           ('br_if', 1),                            break
+           ('local.get', 0),                    t2 = l0 - 1.0
+           ('const', 1.0),                      l0 = t2
+           ('sub',),                            continue
+           ('local.set', 0),                if br:
+           ('br', 0),                           br -= 1
+       ]),                                      break
+   ])                                       break
+
+Functions are translated once they have been called ``jit_threshold`` times
+by a VM created with that option.
+
+Only functions the translator fully understands are compiled, anything else
+raises Untranslatable and is left to the interpreter. Notably:
+    - calls to other guest functions (so deep recursion keeps using the
+      interpreter's heap allocated call stack)
+    - calls to async external functions, which suspend the interpreter
+    - values left on the stack across a block, loop or branch boundary
+    - functions that don't leave exactly their return value on the stack
+"""
+import math
+
+from posed.vm import VirtualMachineError, ExternalFunction, load_function, _F64
+
+OPERATORS = {
+    'add': '+',
+    'sub': '-',
+    'mul': '*',
+    'div': '/',
+    'mod': '%',
+    'ge': '>=',
+    'gt': '>',
+    'le': '<=',
+    'lt': '<',
+    'eq': '==',
+    'ne': '!=',
+}
+
+
+class Untranslatable(VirtualMachineError):
+    pass
+
+
+class Translator:
+    """Translates a single function into Python source."""
+    def __init__(self, func, functions):
+        self.func = func
+        self.functions = functions
+        self.nlocals = load_function(func).nlocals
+        self.lines = []
+        self.stack = []
+        self.constants = {}     # name -> value for constants bound in the closure
+        self.ntemps = 0
+        self.multi_level = False
+
+    def emit(self, depth, line):
+        self.lines.append('    ' * depth + line)
+
+    def temp(self):
+        self.ntemps += 1
+        return f't{self.ntemps}'
+
+    def constant(self, value):
+        """A Python expression for a constant, inlined when it has a literal form."""
+        if type(value) in (int, float) and math.isfinite(value):
+            return repr(value)
+        return self.bind(value)
+
+    def bind(self, value):
+        """The name of a value bound in the closure of the translated function."""
+        name = f'c{len(self.constants)}'
+        self.constants[name] = value
+        return name
+
+    def pop(self):
+        if not self.stack:
+            raise Untranslatable('Stack underflow')
+        return self.stack.pop()
+
+    def require_empty_stack(self, where):
+        if self.stack:
+            raise Untranslatable(f'Values left on the stack at {where}')
+
+    def source(self):
+        """Python source for a factory returning the translated function."""
+        params = ', '.join(f'l{i}' for i in range(self.func.nparams))
+        self.translate(self.func.code, [], depth=2)
+        header = [f'def native({params}):', '    memory = vm.memory']
+        header += [f'    l{i} = 0.0' for i in range(self.func.nparams, self.nlocals)]
+        if self.multi_level:
+            header.append('    br = 0')
+        names = ', '.join(['vm', 'unpack_f64', 'pack_f64', *self.constants])
+        lines = [f'def make({names}):']
+        lines += ['    ' + line for line in header]
+        lines += self.lines
+        lines.append('    return native')
+        return '\n'.join(lines) + '\n'
+
+    def finish(self, depth):
+        """Emit the return at the end of the function, or for a return instruction."""
+        if self.func.returns:
+            value = self.pop()
+            self.require_empty_stack('return')
+            self.emit(depth, f'return {value}')
+        else:
+            self.require_empty_stack('return')
+            self.emit(depth, 'return')
+
+    def translate(self, instructions, constructs, depth):
+        """Translate instructions returning False if they end with an unconditional jump.
+
+        constructs are the opcodes of the enclosing blocks and loops, innermost last.
+        """
+        for opcode, *args in instructions:
+            if opcode == 'const':
+                self.stack.append(self.constant(args[0]))
+            elif opcode in OPERATORS:
+                right = self.pop()
+                left = self.pop()
+                temp = self.temp()
+                self.emit(depth, f'{temp} = {left} {OPERATORS[opcode]} {right}')
+                self.stack.append(temp)
+            elif opcode == 'local.get':
+                self.check_local(args[0])
+                self.stack.append(f'l{args[0]}')
+            elif opcode == 'local.set':
+                self.check_local(args[0])
+                value = self.pop()
+                name = f'l{args[0]}'
+                for i, entry in enumerate(self.stack):
+                    if entry == name:   # keep the value the local had when it was read
+                        temp = self.temp()
+                        self.emit(depth, f'{temp} = {name}')
+                        self.stack[i] = temp
+                self.emit(depth, f'{name} = {value}')
+            elif opcode == 'load':
+                addr = self.pop()
+                temp = self.temp()
+                self.emit(depth, f'{temp} = unpack_f64(memory, {addr})[0]')
+                self.stack.append(temp)
+            elif opcode == 'store':
+                value = self.pop()
+                addr = self.pop()
+                self.emit(depth, f'pack_f64(memory, {addr}, {value})')
+            elif opcode == 'call':
+                self.call(args[0], depth)
+            elif opcode in ('block', 'loop'):
+                self.require_empty_stack(opcode)
+                self.emit(depth, 'while True:')
+                if self.translate(args[0], constructs + [opcode], depth + 1):
+                    self.require_empty_stack(f'end of {opcode}')
+                    self.emit(depth + 1, 'break')
+                if constructs and self.multi_level:
+                    self.emit(depth, 'if br:')
+                    self.emit(depth + 1, 'br -= 1')
+                    if constructs[-1] == 'loop':
+                        self.emit(depth + 1, 'if not br:')
+                        self.emit(depth + 2, 'continue')
+                    self.emit(depth + 1, 'break')
+            elif opcode == 'br':
+                self.require_empty_stack('br')
+                self.branch(args[0], constructs, depth)
+                return False
+            elif opcode == 'br_if':
+                condition = self.pop()
+                self.require_empty_stack('br_if')
+                self.emit(depth, f'if {condition}:')
+                self.branch(args[0], constructs, depth + 1)
+            elif opcode == 'return':
+                self.finish(depth)
+                return False
+            else:
+                raise Untranslatable(f'Unsupported opcode {opcode}')
+        if not constructs:
+            self.finish(depth)
+            return False
+        return True
+
+    def check_local(self, index):
+        if not 0 <= index < self.nlocals:
+            raise Untranslatable(f'Local {index} out of range')
+
+    def branch(self, level, constructs, depth):
+        if not 0 <= level < len(constructs):
+            raise Untranslatable(f'Branch level {level} exceeds nesting depth {len(constructs)}')
+        if level == 0:
+            self.emit(depth, 'continue' if constructs[-1] == 'loop' else 'break')
+        else:
+            self.multi_level = True
+            self.emit(depth, f'br = {level}')
+            self.emit(depth, 'break')
+
+    def call(self, index, depth):
+        func = self.functions[index]
+        if not isinstance(func, ExternalFunction):
+            raise Untranslatable('Calls to guest functions are left to the interpreter')
+        if func.awaitable:
+            raise Untranslatable('Calls to async external functions suspend the interpreter')
+        if func.batched:
+            raise Untranslatable('Calls to batched external functions are queued by the interpreter')
+        args = [self.pop() for _ in range(func.nparams)][::-1]
+        call = f'{self.bind(func.call)}({", ".join(args)})'
+        if func.returns:
+            temp = self.temp()
+            self.emit(depth, f'{temp} = {call}')
+            self.stack.append(temp)
+        else:
+            self.emit(depth, call)
+
+
+def translate(func, vm):
+    """Translate a function into a Python function taking its params and returning its result."""
+    translator = Translator(func, vm.functions)
+    source = translator.source()
+    namespace = {}
+    try:
+        exec(compile(source, f'<jit {id(func):#x}>', 'exec'), namespace)
+    except (SyntaxError, RecursionError) as e:    # e.g. too many nested blocks
+        raise Untranslatable(str(e)) from e
+    return namespace['make'](vm, _F64.unpack_from, _F64.pack_into, **translator.constants)
@@ -0,0 +1,386 @@
+"""
+A compact binary format for function tables, a tiny take on wasm modules.
+
+Layout
+------
+   magic        b'\\0psd'
+   version      uleb128
+   count        uleb128, the number of entries in the function table
+   entries      one per function, in table order
+
+   function     0x00, nparams, returns (a byte), nlocals + 1 (0 if None),
+                body size in bytes, body
+   import       0x01, nparams, returns (a byte), name size, name (utf-8)
+
+A body is a sequence of instructions, each an opcode byte followed by its
+immediates, and a ``block``/``loop`` body is terminated by ``end`` (0x00).
+Integer immediates are LEB128 (signed for constants) and floats are little
+endian doubles. Integer and float constants have their own opcodes so that
+addresses and vector sizes come back as ints and arithmetic as floats.
+
+External functions can't be serialised, they're written as imports by name
+and resolved against the ``imports`` given when the module is loaded.
+
+Loading
+-------
+``load()`` maps the file into memory and only reads the function table, a
+function's body is decoded into instructions the first time its code is
+used (typically by ``VirtualMachine`` lowering it on the first call).
+"""
+import mmap
+import struct
+from collections.abc import Sequence
+
+from posed.vm import BINARY_OPS, ExternalFunction, Function, VirtualMachineError
+
+MAGIC = b'\0psd'
+VERSION = 1
+
+FUNCTION = 0x00
+IMPORT = 0x01
+
+#   Opcode bytes, never renumber these without bumping VERSION
+OPCODES = {
+    'end': 0x00,
+    'const.i': 0x01,
+    'const.f64': 0x02,
+    'local.get': 0x03,
+    'local.set': 0x04,
+    'call': 0x05,
+    'br': 0x06,
+    'br_if': 0x07,
+    'return': 0x08,
+    'block': 0x09,
+    'loop': 0x0a,
+    'load': 0x0b,
+    'store': 0x0c,
+    'load.vec': 0x0d,
+    'store.vec': 0x0e,
+    'memory.copy': 0x0f,
+    'memory.fill': 0x10,
+    'memory.size': 0x11,
+    'memory.grow': 0x12,
+    'add': 0x20,
+    'sub': 0x21,
+    'mul': 0x22,
+    'div': 0x23,
+    'mod': 0x24,
+    'ge': 0x25,
+    'gt': 0x26,
+    'le': 0x27,
+    'lt': 0x28,
+    'eq': 0x29,
+    'ne': 0x2a,
+    'local.local.op': 0x40,
+    'local.const.op': 0x41,
+    'local.const.op.local.set': 0x42,
+    'const.local.op.br_if': 0x43,
+}
+
+OPNAMES = {byte: name for name, byte in OPCODES.items()}
+
+#   Instructions with a single unsigned immediate
+_INDEXED = ('local.get', 'local.set', 'call', 'br', 'br_if', 'load.vec', 'store.vec')
+
+#   Tags for constants inside superinstructions
+_INT = 0x00
+_F64 = 0x01
+
+_DOUBLE = struct.Struct('<d')
+
+
+class ModuleError(VirtualMachineError):
+    pass
+
+
+def dumps(functions, imports=None):
+    """Serialise a function table to bytes, imports maps names to its external functions."""
+    names = {id(func): name for name, func in (imports or {}).items()}
+    out = bytearray(MAGIC)
+    _uleb(out, VERSION)
+    _uleb(out, len(functions))
+    for func in functions:
+        if isinstance(func, ExternalFunction):
+            name = names.get(id(func))
+            if name is None:
+                raise ModuleError(f'External function {func.call!r} has no import name')
+            out.append(IMPORT)
+            _signature(out, func)
+            encoded = name.encode()
+            _uleb(out, len(encoded))
+            out += encoded
+        else:
+            out.append(FUNCTION)
+            _signature(out, func)
+            _uleb(out, 0 if func.nlocals is None else func.nlocals + 1)
+            body = bytearray()
+            _encode(body, func.code)
+            _uleb(out, len(body))
+            out += body
+    return bytes(out)
+
+
+def dump(functions, path, imports=None):
+    """Serialise a function table to a file."""
+    with open(path, 'wb') as f:
+        f.write(dumps(functions, imports))
+
+
+def loads(data, imports=None):
+    """Load a function table from bytes (or any buffer), decoding function bodies on first use."""
+    reader = _Reader(memoryview(data))
+    if bytes(reader.read(len(MAGIC))) != MAGIC:
+        raise ModuleError('Not a posed module')
+    version = reader.uleb()
+    if version != VERSION:
+        raise ModuleError(f'Unsupported module version {version}, expected {VERSION}')
+    functions = []
+    for _ in range(reader.uleb()):
+        kind = reader.byte()
+        nparams = reader.uleb()
+        returns = bool(reader.byte())
+        if kind == FUNCTION:
+            nlocals = reader.uleb() - 1
+            size = reader.uleb()
+            code = LazyCode(reader.data, reader.pos, reader.pos + size)
+            reader.pos += size
+            functions.append(Function(nparams, returns, code, None if nlocals < 0 else nlocals))
+        elif kind == IMPORT:
+            name = bytes(reader.read(reader.uleb())).decode()
+            functions.append(_resolve(name, nparams, returns, imports or {}))
+        else:
+            raise ModuleError(f'Unknown function kind {kind:#x} at offset {reader.pos - 1}')
+    return functions
+
+
+def load(path, imports=None):
+    """Load a function table from a file, which is memory mapped rather than read."""
+    with open(path, 'rb') as f:
+        #   the mapping stays open while any function's code refers to it
+        return loads(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), imports)
+
+
+class LazyCode(Sequence):
+    """The instructions of a function body, decoded from the module when first used."""
+    def __init__(self, data, start, end):
+        self._data = data
+        self._start = start
+        self._end = end
+        self._instructions = None
+
+    @property
+    def instructions(self):
+        if self._instructions is None:
+            reader = _Reader(self._data, self._start)
+            self._instructions = _decode(reader, nested=False, end=self._end)
+            self._data = None
+        return self._instructions
+
+    def __getitem__(self, index):
+        return self.instructions[index]
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def __iter__(self):
+        return iter(self.instructions)
+
+    def __repr__(self):
+        if self._instructions is None:
+            return f'<LazyCode {self._end - self._start} bytes>'
+        return repr(self._instructions)
+
+
+def _resolve(name, nparams, returns, imports):
+    func = imports.get(name)
+    if func is None:
+        raise ModuleError(f'Unresolved import {name!r}')
+    if (func.nparams, bool(func.returns)) != (nparams, returns):
+        raise ModuleError(
+            f'Import {name!r} has signature ({func.nparams}, {func.returns}), '
+            f'module expects ({nparams}, {returns})')
+    return func
+
+
+def _signature(out, func):
+    _uleb(out, func.nparams)
+    out.append(1 if func.returns else 0)
+
+
+def _encode(out, instructions):
+    for opcode, *args in instructions:
+        if opcode == 'const':
+            if isinstance(args[0], int):
+                out.append(OPCODES['const.i'])
+                _sleb(out, int(args[0]))
+            else:
+                out.append(OPCODES['const.f64'])
+                out += _DOUBLE.pack(_float(args[0]))
+            continue
+        if opcode not in OPCODES or opcode in ('end', 'const.i', 'const.f64'):
+            raise ModuleError(f'Unsupported opcode {opcode}')
+        out.append(OPCODES[opcode])
+        if opcode in _INDEXED:
+            _uleb(out, args[0])
+        elif opcode in ('block', 'loop'):
+            _encode(out, args[0])
+            out.append(OPCODES['end'])
+        elif opcode == 'local.local.op':
+            a, b, name = args
+            _uleb(out, a)
+            _uleb(out, b)
+            _operator(out, name)
+        elif opcode == 'local.const.op':
+            index, value, name = args
+            _uleb(out, index)
+            _value(out, value)
+            _operator(out, name)
+        elif opcode == 'local.const.op.local.set':
+            index, value, name, dest = args
+            _uleb(out, index)
+            _value(out, value)
+            _operator(out, name)
+            _uleb(out, dest)
+        elif opcode == 'const.local.op.br_if':
+            value, index, name, level = args
+            _value(out, value)
+            _uleb(out, index)
+            _operator(out, name)
+            _uleb(out, level)
+
+
+def _decode(reader, nested, end=None):
+    instructions = []
+    while True:
+        if not nested and reader.pos >= end:
+            return instructions
+        offset = reader.pos
+        opcode = OPNAMES.get(reader.byte())
+        if opcode == 'end':
+            if nested:
+                return instructions
+            raise ModuleError(f'Unexpected end at offset {offset}')
+        elif opcode == 'const.i':
+            instructions.append(('const', reader.sleb()))
+        elif opcode == 'const.f64':
+            instructions.append(('const', reader.f64()))
+        elif opcode in _INDEXED:
+            instructions.append((opcode, reader.uleb()))
+        elif opcode in ('block', 'loop'):
+            instructions.append((opcode, _decode(reader, nested=True)))
+        elif opcode == 'local.local.op':
+            instructions.append((opcode, reader.uleb(), reader.uleb(), reader.operator()))
+        elif opcode == 'local.const.op':
+            instructions.append((opcode, reader.uleb(), reader.value(), reader.operator()))
+        elif opcode == 'local.const.op.local.set':
+            instructions.append((opcode, reader.uleb(), reader.value(), reader.operator(), reader.uleb()))
+        elif opcode == 'const.local.op.br_if':
+            instructions.append((opcode, reader.value(), reader.uleb(), reader.operator(), reader.uleb()))
+        elif opcode is not None:
+            instructions.append((opcode,))
+        else:
+            raise ModuleError(f'Unknown opcode {reader.data[offset]:#x} at offset {offset}')
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ModuleError(f'Unsupported constant {value!r}') from None
+
+
+def _operator(out, name):
+    if name not in BINARY_OPS:
+        raise ModuleError(f'Unsupported operator {name}')
+    out.append(OPCODES[name])
+
+
+def _value(out, value):
+    """A tagged constant for a superinstruction."""
+    if isinstance(value, int):
+        out.append(_INT)
+        _sleb(out, int(value))
+    else:
+        out.append(_F64)
+        out += _DOUBLE.pack(_float(value))
+
+
+def _uleb(out, value):
+    if value < 0:
+        raise ModuleError(f'Expected an unsigned integer, got {value}')
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _sleb(out, value):
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if (value == 0 and not byte & 0x40) or (value == -1 and byte & 0x40):
+            out.append(byte)
+            return
+        out.append(byte | 0x80)
+
+
+class _Reader:
+    """Reads values from a buffer, tracking the position."""
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def read(self, n):
+        if self.pos + n > len(self.data):
+            raise ModuleError(f'Unexpected end of module at offset {len(self.data)}')
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return chunk
+
+    def byte(self):
+        if self.pos >= len(self.data):
+            raise ModuleError(f'Unexpected end of module at offset {self.pos}')
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def uleb(self):
+        result = shift = 0
+        while True:
+            byte = self.byte()
+            result |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return result
+
+    def sleb(self):
+        result = shift = 0
+        while True:
+            byte = self.byte()
+            result |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                if byte & 0x40:
+                    result -= 1 << shift
+                return result
+
+    def f64(self):
+        return _DOUBLE.unpack(self.read(8))[0]
+
+    def value(self):
+        tag = self.byte()
+        if tag == _INT:
+            return self.sleb()
+        elif tag == _F64:
+            return self.f64()
+        raise ModuleError(f'Unknown constant tag {tag:#x} at offset {self.pos - 1}')
+
+    def operator(self):
+        offset = self.pos
+        name = OPNAMES.get(self.byte())
+        if name not in BINARY_OPS:
+            raise ModuleError(f'Unknown operator at offset {offset}')
+        return name
@@ -0,0 +1,127 @@
+"""
+Running many independent VM programs in parallel across processes.
+
+A VM is single threaded pure Python, so a ``Pool`` spreads jobs over worker
+processes instead. Each worker creates one ``VirtualMachine`` for the
+function table when it starts (the table is sent to a worker once, not with
+every job) and runs every job it is given on it.
+
+   >>> with Pool(functions) as pool:
+   ...     for result in pool.imap([(0, (10.0,)), (0, (20.0,))]):
+   ...         print(result.index, result.value, result.error)
+
+Jobs
+----
+A job is a ``(program, args)`` pair where program is either:
+
+- the index of a function in the table, which is called with args, the
+  job's value is its return value (None if it doesn't return one)
+- a list of instructions, which is executed with args as its initial
+  locals, the job's value is the list of values it left on the stack
+
+Results stream back as jobs complete as ``Result(index, value, error)``
+where index is the job's position in the jobs given. An exception raised
+by a job (such as a ``VirtualMachineError``) is returned as its error
+rather than raised, so one bad job doesn't stop the rest.
+
+Small jobs are sent to workers in chunks to amortise the cost of passing
+them between processes. Jobs in a worker share its VM's memory, the stack is
+cleared and any ``fuel`` refilled before each job.
+"""
+import collections
+import multiprocessing
+
+from posed.vm import VirtualMachine
+
+#   Upper limit on jobs sent to a worker at once, keeping results streaming
+MAX_CHUNK_SIZE = 256
+
+#   Chunks per worker when the number of jobs is known
+CHUNKS_PER_WORKER = 4
+
+#   For jobs from an iterator with no length
+DEFAULT_CHUNK_SIZE = 32
+
+Result = collections.namedtuple('Result', 'index value error')
+
+#   The worker's VM and the fuel each job gets, set by _init_worker()
+_vm = None
+_fuel = None
+
+
+def _init_worker(functions, options):
+    global _vm, _fuel
+    _vm = VirtualMachine(functions, **options)
+    _fuel = options.get('fuel')
+
+
+def _run_job(job):
+    index, program, args = job
+    _vm.stack.clear()
+    _vm.fuel = _fuel
+    try:
+        if isinstance(program, int):
+            return Result(index, _vm.call(_vm.functions[program], *args), None)
+        _vm.execute(program, args)
+        return Result(index, list(_vm.stack), None)
+    except Exception as e:
+        return Result(index, None, e)
+
+
+def _chunksize(njobs, processes):
+    """The number of jobs to send a worker at once."""
+    if njobs is None:
+        return DEFAULT_CHUNK_SIZE
+    chunks = processes * CHUNKS_PER_WORKER
+    return max(1, min(MAX_CHUNK_SIZE, -(-njobs // chunks)))
+
+
+class Pool:
+    """Worker processes each running jobs on their own VM for a function table.
+
+    options are passed on to VirtualMachine, the function table and options
+    must be picklable if processes are spawned rather than forked.
+    """
+    def __init__(self, functions, processes=None, context=None, **options):
+        context = context or multiprocessing.get_context()
+        self.processes = processes or context.cpu_count()
+        self._pool = context.Pool(self.processes, _init_worker, (functions, options))
+
+    def imap(self, jobs, chunksize=None):
+        """Run jobs, yielding a Result for each as they complete."""
+        if chunksize is None:
+            njobs = len(jobs) if hasattr(jobs, '__len__') else None
+            chunksize = _chunksize(njobs, self.processes)
+        tasks = ((index, program, tuple(args)) for index, (program, args) in enumerate(jobs))
+        return self._pool.imap_unordered(_run_job, tasks, chunksize)
+
+    def map(self, jobs, chunksize=None):
+        """Run jobs, returning their values in order or raising the first job error."""
+        values = [None] * len(jobs)
+        errors = {}
+        for index, value, error in self.imap(jobs, chunksize):
+            values[index] = value
+            if error is not None:
+                errors[index] = error
+        if errors:
+            raise errors[min(errors)]
+        return values
+
+    def close(self):
+        """Stop the workers once queued jobs are done."""
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        """Stop the workers immediately."""
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
@@ -0,0 +1,378 @@
+"""
+Profilers for guest programs run by a VirtualMachine.
+
+CountingProfiler
+----------------
+Counts every instruction executed, with a copy of the dispatch loop that
+keeps a counter per instruction and per call stack (the VM switches back to
+its usual loop afterwards, so profiling costs nothing when disabled):
+
+   with CountingProfiler(vm) as profiler:
+       vm.execute(program)
+   print(profiler.report())
+
+It reports exact opcode histograms, instructions, calls and wall time per
+function and the hot loops by the path of their ``loop`` instruction, the
+index in the function's code followed by the index inside each enclosing
+block/loop. Time is measured at calls and returns, so it includes profiling
+overhead but is fair between functions.
+
+SamplingProfiler
+----------------
+Looks at what the VM is running every ``interval`` seconds from a
+background thread, reading the locals of the dispatch loop, so the VM runs at
+full speed in between. It reports opcodes and time per function estimated
+from the samples. Samples are taken when the sampling thread gets the GIL so
+intervals shorter than ``sys.getswitchinterval()`` are stretched. A sample
+landing while the loop is part way through a call or return, with its code
+and call frames out of step, is dropped.
+
+Both give ``collapsed()`` stacks, one line per call stack with a count, as
+consumed by flamegraph.pl, speedscope, inferno and the like:
+
+   main;f0;f1 1520
+   main;f0 30
+
+Functions are named ``f<index>`` in the function table unless given names,
+top level programs are ``main``.
+"""
+import collections
+import sys
+import threading
+import time
+
+from posed.vm import (
+    BINARY_OPS, BINOP, CALL, FUEL, OPNAMES, RETURN, Function, fuse, _run_fast, _run_indexed, _run_profiled, _run_traced,
+)
+
+FunctionStats = collections.namedtuple('FunctionStats', 'calls instructions seconds')
+
+#   Instructions standing for several in the code as written
+SPANS = {
+    'const.local.op.br_if': 4,
+    'local.const.op.local.set': 4,
+    'local.local.op': 3,
+    'local.const.op': 3,
+}
+
+_OPERATORS = {func: name for name, func in BINARY_OPS.items()}
+
+_RUN_CODE = {run.__code__ for run in (_run_fast, _run_traced, _run_profiled)}
+
+
+def _opname(instruction):
+    opcode, arg = instruction
+    if opcode == BINOP:
+        return _OPERATORS.get(arg, 'binop')
+    return OPNAMES.get(opcode, str(opcode))
+
+
+def _loops(source, loaded, path=()):
+    """Yield (path, leaf index) for each loop, walking source alongside the (maybe fused) code loaded from it.
+
+    Leaves are the instructions other than block/loop in order, each lowered
+    into one bytecode instruction.
+    """
+    leaves = 0
+    i = 0
+    for instruction in loaded:
+        opcode = instruction[0]
+        if opcode in ('block', 'loop'):
+            if opcode == 'loop':
+                yield path + (i,), leaves
+            for loop_path, leaf in _loops(source[i][1], instruction[1], path + (i,)):
+                yield loop_path, leaves + leaf
+            leaves += _count_leaves(instruction[1])
+            i += 1
+        else:
+            leaves += 1
+            i += 1 if tuple(source[i]) == tuple(instruction) else SPANS.get(opcode, 1)
+
+
+def _count_leaves(instructions):
+    return sum(_count_leaves(args[0]) if opcode in ('block', 'loop') else 1 for opcode, *args in instructions)
+
+
+class _Profiler:
+    """Naming of functions and formatting shared by the profilers."""
+    def __init__(self, vm, names=None):
+        self.vm = vm
+        self.names = names or {}
+
+    def _indices(self):
+        """Function table index for each loaded Code."""
+        indices = {}
+        for index, func in enumerate(self.vm.functions):
+            code = self.vm._code.get(func) if isinstance(func, Function) else None
+            if code is not None:
+                indices[code] = index
+        return indices
+
+    def name(self, index):
+        """The name of a function by index, None for a top level program."""
+        if index is None:
+            return 'main'
+        return self.names.get(index, f'f{index}')
+
+    def _collapsed(self, weights):
+        """Lines of ';' separated stacks of function indices with their weights."""
+        lines = []
+        for stack, weight in sorted(weights.items(), key=lambda item: [self.name(i) for i in item[0]]):
+            if weight:
+                lines.append(f'{";".join(self.name(index) for index in stack)} {weight}')
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def write_collapsed(self, path, **kwargs):
+        """Write collapsed stacks to a file for a flamegraph tool."""
+        with open(path, 'w') as f:
+            f.write(self.collapsed(**kwargs))
+
+    def report(self, limit=10):
+        """A human readable summary."""
+        lines = [f'{"function":<16} {"calls":>10} {"instructions":>14} {"seconds":>10}']
+        for index, stats in sorted(self.functions().items(), key=lambda item: -item[1].seconds):
+            lines.append(f'{self.name(index):<16} {stats.calls:>10} {stats.instructions:>14} {stats.seconds:>10.6f}')
+        lines.append('')
+        lines.append(f'{"opcode":<28} {"count":>14}')
+        for name, count in self.opcodes().most_common(limit):
+            lines.append(f'{name:<28} {count:>14}')
+        return '\n'.join(lines) + '\n'
+
+
+class CountingProfiler(_Profiler):
+    """Counts the instructions a VM executes per call stack."""
+    def __init__(self, vm, names=None):
+        super().__init__(vm, names)
+        self.calls = collections.Counter()      # function index -> calls
+        #   Call stacks are a tree of nodes, a node for each Code called from its parent node
+        self._parents = [None]                  # node -> parent node, 0 is the root
+        self._codes = [None]                    # node -> Code running
+        self._children = {}                     # (node, Code) -> child node
+        self._counts = [None]                   # node -> count per instruction of its Code
+        self._seconds = [0.0]                   # node -> seconds spent in its Code
+        self._node = 0
+        self._since = None
+        self._run = None
+
+    def start(self):
+        self._run = self.vm._run
+        self.vm.profile = self
+        self.vm._run = _run_profiled
+
+    def stop(self):
+        self.vm._run = self._run
+        self.vm.profile = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    #   Called by the dispatch loop
+
+    def _child(self, node, code):
+        child = self._children.get((node, code))
+        if child is None:
+            child = self._children[node, code] = len(self._parents)
+            self._parents.append(node)
+            self._codes.append(code)
+            self._counts.append([0] * len(code.instructions))
+            self._seconds.append(0.0)
+        return child
+
+    def _switch(self, node):
+        now = time.perf_counter()
+        if self._since is not None:
+            self._seconds[self._node] += now - self._since
+        self._since = now
+        self._node = node
+        return self._counts[node]
+
+    def enter(self, code, frames):
+        """Start (or resume) running code with frames of callers."""
+        node = 0
+        for caller, _, _ in frames:
+            node = self._child(node, caller)
+        return self._switch(self._child(node, code))
+
+    def call(self, index, callee):
+        self.calls[index] += 1
+        return self._switch(self._child(self._node, callee))
+
+    def count_call(self, index):
+        self.calls[index] += 1
+
+    def ret(self):
+        return self._switch(self._parents[self._node])
+
+    def leave(self):
+        self._switch(0)
+        self._since = None
+
+    #   Reports
+
+    def _by_index(self):
+        """(node, function index, Code, counts, seconds) for each node."""
+        indices = self._indices()
+        for node in range(1, len(self._parents)):
+            code = self._codes[node]
+            yield node, indices.get(code), code, self._counts[node], self._seconds[node]
+
+    def opcodes(self):
+        """A Counter of instructions executed by name, binary operators by their own names."""
+        opcodes = collections.Counter()
+        for _, _, code, counts, _ in self._by_index():
+            for instruction, count in zip(code.instructions, counts):
+                if count and instruction[0] != FUEL:
+                    opcodes[_opname(instruction)] += count
+        return opcodes
+
+    def functions(self):
+        """FunctionStats by function index (None for top level programs), instructions and seconds exclude callees."""
+        instructions = collections.Counter()
+        seconds = collections.Counter()
+        for _, index, _, counts, elapsed in self._by_index():
+            instructions[index] += sum(counts)
+            seconds[index] += elapsed
+        return {index: FunctionStats(self.calls[index], instructions[index], seconds[index])
+                for index in instructions.keys() | self.calls.keys()}
+
+    def loops(self):
+        """(function index, path of the loop, times its body started) for every loop run, hottest first."""
+        totals = collections.Counter()
+        for _, index, code, counts, _ in self._by_index():
+            if code.source is None:
+                continue
+            pcs = [pc for pc, (opcode, _) in enumerate(code.instructions) if opcode != FUEL]
+            source = list(code.source)
+            loaded = fuse(source) if self.vm.fused else source
+            for path, leaf in _loops(source, loaded):
+                totals[index, path] += counts[pcs[leaf]]
+        return [(index, list(path), count) for (index, path), count in totals.most_common() if count]
+
+    def collapsed(self, weight='instructions'):
+        """Collapsed stacks weighted by 'instructions' or 'microseconds'."""
+        indices = self._indices()
+        stacks = [()]
+        for node in range(1, len(self._parents)):     # parents come before their children
+            stacks.append(stacks[self._parents[node]] + (indices.get(self._codes[node]),))
+        weights = collections.Counter()
+        for node, _, _, counts, seconds in self._by_index():
+            weights[stacks[node]] += sum(counts) if weight == 'instructions' else round(seconds * 1e6)
+        return self._collapsed(weights)
+
+    def report(self, limit=10):
+        lines = [super().report(limit), f'{"loop":<28} {"iterations":>14}']
+        for index, path, count in self.loops()[:limit]:
+            lines.append(f'{self.name(index) + " " + str(path):<28} {count:>14}')
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler(_Profiler):
+    """Samples what a VM is running at intervals from a background thread."""
+    def __init__(self, vm, interval=0.001, names=None, thread=None):
+        super().__init__(vm, names)
+        self.interval = interval
+        self.samples = collections.Counter()    # stack of Codes -> samples
+        self.opcode_samples = collections.Counter()
+        self.elapsed = 0.0
+        self._thread_id = (thread or threading.current_thread()).ident
+        self._run_code = _RUN_CODE | {_run_indexed().__code__} if vm.stack_pointer else _RUN_CODE
+        self._running = threading.Event()
+        self._sampler = None
+        self._started = None
+
+    def start(self):
+        self._running.set()
+        self._started = time.perf_counter()
+        self._sampler = threading.Thread(target=self._sample_loop, name='posed-sampler', daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._running.clear()
+        self._sampler.join()
+        self.elapsed += time.perf_counter() - self._started
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _sample_loop(self):
+        while self._running.is_set():
+            time.sleep(self.interval)
+            self.sample()
+
+    def sample(self):
+        """Record what the profiled thread is running."""
+        frame = sys._current_frames().get(self._thread_id)
+        runs = []
+        while frame is not None:
+            if frame.f_code in self._run_code:
+                runs.append(frame.f_locals)
+            frame = frame.f_back
+        if not runs:
+            return
+        instructions = runs[0]['code'].instructions
+        pc = runs[0]['pc']
+        instruction = instructions[pc - 1] if 0 < pc <= len(instructions) else None
+        if instruction is not None and instruction[0] == RETURN:
+            return      # the caller's frame may be popped before code is switched back to it
+        stack = []
+        for f_locals in reversed(runs):     # outermost run first
+            #   frames is None until the loop starts
+            frames = f_locals.get('frames') or ()
+            callees = [*(frame[0] for frame in frames[1:]), f_locals['code']]
+            if not all(self._calls(caller, pc, callee) for (caller, pc, _), callee in zip(frames, callees)):
+                return      # a frame pushed by a call before code is switched to the callee
+            stack.extend(frame[0] for frame in frames)
+            stack.append(f_locals['code'])
+        self.samples[tuple(stack)] += 1
+        if instruction is not None:
+            self.opcode_samples[_opname(instruction)] += 1
+
+    def _calls(self, caller, pc, callee):
+        """Whether the instruction before pc in caller calls callee."""
+        if not 0 < pc <= len(caller.instructions):
+            return False
+        opcode, arg = caller.instructions[pc - 1]
+        return opcode == CALL and self.vm._code.get(self.vm.functions[arg]) is callee
+
+    def _per_sample(self):
+        total = sum(self.samples.values())
+        return self.elapsed / total if total else 0.0
+
+    def opcodes(self):
+        """A Counter of samples by the instruction being executed."""
+        return collections.Counter(self.opcode_samples)
+
+    def functions(self):
+        """FunctionStats by function index with seconds estimated from samples, calls and instructions aren't known."""
+        indices = self._indices()
+        seconds = collections.Counter()
+        for stack, count in self.samples.items():
+            seconds[indices.get(stack[-1])] += count * self._per_sample()
+        return {index: FunctionStats(None, None, elapsed) for index, elapsed in seconds.items()}
+
+    def collapsed(self, weight='samples'):
+        """Collapsed stacks weighted by 'samples' or estimated 'microseconds'."""
+        indices = self._indices()
+        weights = collections.Counter()
+        for stack, count in self.samples.items():
+            key = tuple(indices.get(code) for code in stack)
+            weights[key] += count if weight == 'samples' else round(count * self._per_sample() * 1e6)
+        return self._collapsed(weights)
+
+    def report(self, limit=10):
+        lines = [f'{"function":<16} {"seconds":>10}']
+        for index, stats in sorted(self.functions().items(), key=lambda item: -item[1].seconds):
+            lines.append(f'{self.name(index):<16} {stats.seconds:>10.6f}')
+        lines.append('')
+        lines.append(f'{"opcode":<28} {"samples":>14}')
+        for name, count in self.opcodes().most_common(limit):
+            lines.append(f'{name:<28} {count:>14}')
+        return '\n'.join(lines) + '\n'
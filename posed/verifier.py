@@ -0,0 +1,200 @@
+"""
+A verifier checking VM code once when it's loaded rather than as it runs.
+
+The stack height is tracked through the structured instructions of a
+function (relative to the height when it was called) and checked against:
+
+- stack underflow, an instruction popping values the function didn't push
+- the height at a label, every branch to a block and its fall through must
+  agree on the height at its end, a branch back to a loop must have the
+  height it had on entry (otherwise the stack grows on every iteration)
+- returns, a function must leave exactly its return value (or nothing)
+- unknown opcodes and operators, branch levels beyond the nesting depth,
+  calls to functions missing from the table and locals out of range
+
+Code following a ``br`` or ``return`` in the same block is unreachable, it
+is still checked for everything but the stack height.
+
+Errors report the path to the offending instruction, the index in the
+function's code followed by the index inside each enclosing block/loop:
+
+   VerifyError: [2, 0, 5] ('sub',): Stack underflow, needs 2 values, has 1
+
+``verify()`` returns the maximum stack height the code reaches, which a VM
+created with ``verify=True`` keeps as ``Code.max_stack``.
+"""
+from posed.vm import BINARY_OPS, Function, VirtualMachineError
+
+#   (values popped, values pushed) for instructions with fixed stack effects
+EFFECTS = {
+    'const': (0, 1),
+    'load': (1, 1),
+    'store': (2, 0),
+    'local.get': (0, 1),
+    'local.set': (1, 0),
+    'memory.copy': (3, 0),
+    'memory.fill': (3, 0),
+    'memory.size': (0, 1),
+    'memory.grow': (1, 1),
+    'local.local.op': (0, 1),
+    'local.const.op': (0, 1),
+    'local.const.op.local.set': (0, 0),
+    **{name: (2, 1) for name in BINARY_OPS},
+}
+
+#   Instructions branching to the label their last immediate refers to
+BRANCHES = ('br', 'br_if', 'const.local.op.br_if')
+
+
+class VerifyError(VirtualMachineError):
+    pass
+
+
+class _Label:
+    """The branch target of an enclosing block or loop."""
+    def __init__(self, opcode, height):
+        self.opcode = opcode
+        self.height = height    # height on entry for a loop, at the end for a block (None if unknown)
+
+
+class Verifier:
+    """Tracks the stack height through a function's code."""
+    def __init__(self, functions, nlocals=None, returns=None):
+        self.functions = functions
+        self.nlocals = nlocals      # None if inferred from the code, so any index is in range
+        self.returns = returns      # None for top level programs, which leave any results
+        self.max_stack = 0
+
+    def verify(self, instructions, height=0):
+        """Verify a function body, returning its maximum stack height."""
+        self.max_stack = height
+        height = self.block(instructions, [], height, [])
+        if height is not None:
+            self.check_return(height, [len(instructions)], ('end',))
+        return self.max_stack
+
+    def error(self, path, instruction, message):
+        if instruction[0] in ('block', 'loop'):
+            instruction = (instruction[0], [...])
+        raise VerifyError(f'{path} {tuple(instruction)!r}: {message}')
+
+    def block(self, instructions, path, height, labels):
+        """The height after a sequence of instructions, None if its end can't be reached."""
+        for i, instruction in enumerate(instructions):
+            here = path + [i]
+            try:
+                opcode, *args = instruction
+            except (TypeError, ValueError):
+                self.error(here, instruction, 'Malformed instruction')
+            if opcode in ('block', 'loop'):
+                label = _Label(opcode, height if opcode == 'loop' else None)
+                height = self.block(args[0], here, height, labels + [label])
+                if opcode == 'block':
+                    if height is not None:
+                        self.join(label, height, here, instruction)
+                    height = label.height
+                continue
+            pops, pushes = self.effect(opcode, args, here, instruction)
+            if opcode in BRANCHES:
+                label = self.label(args[-1], labels, here, instruction)
+            if height is None:
+                continue
+            if height < pops:
+                self.error(here, instruction, f'Stack underflow, needs {pops} values, has {height}')
+            height -= pops
+            if opcode in BRANCHES:
+                self.branch(label, height, here, instruction)
+                if opcode == 'br':
+                    height = None
+                    continue
+            elif opcode == 'return':
+                self.check_return(height, here, instruction)
+                height = None
+                continue
+            height += pushes
+            self.max_stack = max(self.max_stack, height)
+        return height
+
+    def effect(self, opcode, args, path, instruction):
+        """(values popped, values pushed) by an instruction, checking its immediates."""
+        if opcode in EFFECTS:
+            if opcode in ('local.get', 'local.set'):
+                self.check_local(args[0], path, instruction)
+            elif opcode in ('local.local.op', 'local.const.op', 'local.const.op.local.set'):
+                self.check_local(args[0], path, instruction)
+                if opcode == 'local.local.op':
+                    self.check_local(args[1], path, instruction)
+                elif opcode == 'local.const.op.local.set':
+                    self.check_local(args[3], path, instruction)
+                self.check_operator(args[2], path, instruction)
+            return EFFECTS[opcode]
+        elif opcode == 'const.local.op.br_if':
+            self.check_local(args[1], path, instruction)
+            self.check_operator(args[2], path, instruction)
+            return 0, 0
+        elif opcode == 'load.vec':
+            return 1, args[0]
+        elif opcode == 'store.vec':
+            return args[0] + 1, 0
+        elif opcode == 'call':
+            index = args[0]
+            if not 0 <= index < len(self.functions):
+                self.error(path, instruction, f'No function {index} in a table of {len(self.functions)}')
+            func = self.functions[index]
+            return func.nparams, 1 if func.returns else 0
+        elif opcode == 'br_if':
+            return 1, 0
+        elif opcode in ('br', 'return'):
+            return 0, 0
+        self.error(path, instruction, f'Unsupported opcode {opcode}')
+
+    def check_local(self, index, path, instruction):
+        if index < 0 or self.nlocals is not None and index >= self.nlocals:
+            self.error(path, instruction, f'Local {index} out of range for {self.nlocals} locals')
+
+    def check_operator(self, name, path, instruction):
+        if name not in BINARY_OPS:
+            self.error(path, instruction, f'Unsupported operator {name}')
+
+    def check_return(self, height, path, instruction):
+        if self.returns is not None and height != int(bool(self.returns)):
+            expected = 'its return value' if self.returns else 'an empty stack'
+            self.error(path, instruction, f'Function must return with {expected}, has {height} values')
+
+    def label(self, level, labels, path, instruction):
+        """The label a branch jumps to."""
+        if not 0 <= level < len(labels):
+            self.error(path, instruction, f'Branch level {level} exceeds nesting depth {len(labels)}')
+        return labels[-1 - level]
+
+    def branch(self, label, height, path, instruction):
+        if label.opcode == 'loop':
+            if height != label.height:
+                self.error(path, instruction, f'Stack height {height} differs from {label.height} on entry to the loop')
+        else:
+            self.join(label, height, path, instruction)
+
+    def join(self, label, height, path, instruction):
+        """Record a path reaching the end of a block."""
+        if label.height is None:
+            label.height = height
+        elif label.height != height:
+            self.error(path, instruction, f'Stack height {height} differs from {label.height} at the end of the block')
+
+
+def verify(instructions, functions, nlocals=None, returns=None, height=0):
+    """Verify top level instructions (or a function body given returns), returning the maximum stack height.
+
+    height is the number of values already on the stack that the instructions may use.
+    """
+    return Verifier(functions, nlocals, returns).verify(instructions, height)
+
+
+def verify_function(func, functions):
+    """Verify a function, returning its maximum stack height."""
+    return verify(func.code, functions, func.nlocals, bool(func.returns))
+
+
+def verify_functions(functions):
+    """Verify every guest function in a function table."""
+    return [verify_function(func, functions) if isinstance(func, Function) else None for func in functions]
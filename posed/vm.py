@@ -5,11 +5,19 @@ Features
 --------
 - stack based execution model
 - basic linear heap memory storage model and pointer access
+- bulk memory operations (copy, fill and vectors of doubles)
+- growable memory, optionally backed by a memory mapped file
 - expressions
-- functions (including local variables)
+- functions (including local variables), calls don't recurse in Python
 - blocks (groups of expressions)
 - branching (if statements)
 - looping
+- optional verification of code when it is loaded (see posed.verifier)
+- optional fuel metering, bounding how long guest code runs
+- suspending at calls to async external functions and resuming later
+- external functions called with batches of queued arguments
+- counting and sampling profilers (see posed.profiler)
+- snapshots of memory and stack, and copy on write clones started from them
 
 Conditionals
 ------------
@@ -38,10 +46,141 @@ Loops
        ])
    ]) # label : 1
 
+Memory
+------
+Addresses are byte offsets into ``memory`` and values are little endian
+doubles. The bulk operations take their operands from the stack in order:
+
+   ('load.vec', n)      addr -> v0 .. vn-1
+   ('store.vec', n)     addr v0 .. vn-1 ->
+   ('memory.copy',)     dst src nbytes ->
+   ('memory.fill',)     dst byte nbytes ->
+
+Memory is measured in 64 KiB pages by ``memory.size`` and ``memory.grow``.
+``memory.grow`` pops a number of pages to add and pushes the previous size
+in pages, or -1 if the memory can't grow (a limit was hit or it is backed by
+a read only or copy on write mapping of a file).
+
+Bytecode
+--------
+Function code is lowered once by the loader into flat bytecode: a list of
+``(opcode, arg)`` pairs with integer opcodes, where ``block``/``loop`` are
+erased and every ``br``/``br_if`` carries the address it jumps to.
+
+   ('block', [                  0: (CONST, 1.0)
+       ('loop', [               1: (BR_IF, 3)
+           ('const', 1.0),      2: (BR, 0)
+           ('br_if', 1),        3: (RETURN, None)
+           ('br', 0),
+       ]),
+   ])
+
+Function locals live in a fixed size list of slots, parameters first. Locals
+that aren't parameters start as 0.0 and the number of slots is taken from
+``Function.nlocals`` or, if that's None, the highest local index used.
+
+Superinstructions
+-----------------
+Unless a VM is created with ``fused=False`` the loader first runs a peephole
+pass rewriting common sequences into single instructions, where op is any
+binary operator:
+
+   local.get a, local.get b, op                 ('local.local.op', a, b, op)
+   local.get a, const x, op                     ('local.const.op', a, x, op)
+   local.get a, const x, op, local.set b        ('local.const.op.local.set', a, x, op, b)
+   const x, local.get a, op, br_if n            ('const.local.op.br_if', x, a, op, n)
+
+Operand stack
+-------------
+A VM created with ``stack_pointer=True`` keeps operands in an OperandStack
+whose slots are preallocated to the maximum height the verifier finds for
+the code being run (such a VM always verifies code), and the dispatch loop
+indexes them with a local stack pointer instead of calling list methods. It
+runs code moving values through the stack 15-40% faster, and ``vm.stack``
+still behaves as a list for callers.
+
+Fuel
+----
+A VM created with ``fuel=n`` meters the code it runs, every call and loop
+iteration is charged for its instructions (roughly one unit per bytecode
+instruction executed, superinstructions count once). When a charge would
+take ``vm.fuel`` below zero execution stops with an OutOfFuel error, whose
+``state`` resumes it where it stopped with the stack intact:
+
+   vm = VirtualMachine(functions, fuel=10000)
+   try:
+       vm.execute(program)
+   except OutOfFuel as e:
+       vm.resume(e.state, fuel=10000)     # e.g. once other guests had a turn
+
+Execution stops at the charge that ran out and resuming retries it, so
+resuming with less fuel than that charge (``e.cost``) stops again at the
+same place without making progress, forever if retried in a loop. Resume
+with at least ``max(n, e.cost)`` when slicing with small amounts of fuel.
+
+Charges are made on calls and on the branches back to the start of a loop,
+so straight line code between them runs unmetered and metering costs little:
+under 15% on the tightest (five instruction) loop, see benchmarks/fuel.py.
+Translated functions aren't metered so ``fuel`` can't be combined with
+``jit_threshold``. Only the outermost run can be resumed, not one stopped
+inside an external function calling back into the VM.
+
+Suspension
+----------
+Calling an AsyncExternalFunction stops execution with a Suspended error
+holding the awaitable it returned. Once that is done its result (if it
+returns one) is pushed and execution resumed from ``state`` as for fuel.
+posed.aio does this for asyncio, running guests as coroutines.
+
+Batched external functions
+--------------------------
+Calls to a BatchedExternalFunction, a sink without a result such as one
+showing values, are queued rather than made one at a time. Its ``call`` is
+given a list per param of the queued arguments once ``size`` calls are
+queued and when a run ends, even with an error (``vm.flush()`` passes them on
+sooner), so guests calling it in tight loops don't pay for a Python call
+each time:
+
+   show = BatchedExternalFunction(nparams=1, call=lambda values: print(*values, sep='\n'))
+
+The host sees calls later than the guest made them, relative to other
+external functions, so it suits sinks whose effects nothing else depends on.
+The queue belongs to the function, so VMs sharing a function table share it
+and the next run to end on any of them passes on all of its calls.
+
+Snapshots
+---------
+``snapshot()`` captures the memory, stack and fuel of a VM between runs,
+typically once an init program has filled memory with tables, and
+``restore()`` resets a VM to it. ``clone()`` creates a new VM from a
+snapshot, sharing the function table and loaded code, with memory a copy on
+write mapping of the snapshot's image so clones share its pages until they
+write to them (and so, like other copy on write mappings, can't grow):
+
+   vm.execute(init)
+   warm = vm.snapshot()
+   for request in requests:
+       guest = vm.clone(warm)      # microseconds, whatever the memory size
+       guest.call(handler, *request)
+
 """
+import ast
+import copy
+import functools
+import inspect
 import logging
+import mmap
 import operator as op
 import struct
+import tempfile
+import textwrap
+from collections.abc import Mapping, MutableSequence
+
+
+#   Set by _specialise() when building the dispatch loops; see _run().
+TRACE = False
+PROFILE = False
+STACK_POINTER = False
 
 
 def logging_setup(debug=False):
@@ -59,27 +198,95 @@ class InvalidOpcode(VirtualMachineError):
     pass
 
 
+class InvalidBranch(VirtualMachineError):
+    pass
+
+
+class InvalidLocal(VirtualMachineError):
+    pass
+
+
+class CallStackOverflow(VirtualMachineError):
+    pass
+
+
+class OutOfFuel(VirtualMachineError):
+    def __init__(self, msg, state=None, cost=None):
+        super().__init__(msg)
+        self.state = state      # where execution stopped, for VirtualMachine.resume()
+        self.cost = cost        # of the charge that ran out, the least fuel to resume with
+
+
+class Suspended(VirtualMachineError):
+    def __init__(self, msg, state=None, awaitable=None, returns=False):
+        super().__init__(msg)
+        self.state = state      # where execution stopped, for VirtualMachine.resume()
+        self.awaitable = awaitable
+        self.returns = returns  # whether the awaited result is to be pushed before resuming
+
+
 class Function:
-    def __init__(self, nparams, returns, code):
+    def __init__(self, nparams, returns, code, nlocals=None):
         self.nparams = nparams
         self.returns = returns
         self.code = code
+        self.nlocals = nlocals      # params included, inferred from code if None
+
+
+#   Default number of calls a BatchedExternalFunction queues before calling the host
+BATCH_SIZE = 1024
 
 
 class ExternalFunction:
+    awaitable = False
+    batched = False
+
     def __init__(self, nparams, returns, call):
         self.nparams = nparams
         self.returns = returns
         self.call = call
 
 
-class Break(Exception):
-    def __init__(self, level):
-        self.level = level
+class AsyncExternalFunction(ExternalFunction):
+    """An external function returning an awaitable, calls to it suspend execution (see posed.aio)."""
+    awaitable = True
 
 
-class Return(Exception):
-    pass
+class BatchedExternalFunction(ExternalFunction):
+    """An external function without a result whose calls are queued and passed to the host in batches.
+
+    call is given a list per param holding the arguments of up to size calls.
+    """
+    batched = True
+
+    def __init__(self, nparams, call, size=BATCH_SIZE):
+        if nparams < 1:
+            raise ValueError('Batched external functions need at least one param')
+        super().__init__(nparams, False, self.queue)
+        self.host = call
+        self.size = size
+        self.limit = size * nparams     # queued arguments in a full batch
+        self.pending = []               # arguments of queued calls in order, nparams per call
+
+    def queue(self, *args):
+        """Queue a call, passing the batch on to the host once it is full."""
+        self.pending.extend(args)
+        if len(self.pending) >= self.limit:
+            self.flush()
+
+    def flush(self):
+        """Pass any queued calls on to the host."""
+        pending = self.pending
+        if pending:
+            self.pending = []
+            n = self.nparams
+            self.host(*(pending[i::n] for i in range(n)))
+
+
+def _check_args(func, args):
+    """Raise VirtualMachineError unless args are the right number for a function."""
+    if len(args) != func.nparams:
+        raise VirtualMachineError(f'Function takes {func.nparams} arguments, {len(args)} given')
 
 
 BINARY_OPS = {
@@ -96,15 +303,461 @@ BINARY_OPS = {
     'ne': op.ne,
 }
 
+#   Flat bytecode opcodes
+CONST = 0
+BINOP = 1
+LOAD = 2
+STORE = 3
+LOCAL_GET = 4
+LOCAL_SET = 5
+CALL = 6
+BR = 7
+BR_IF = 8
+RETURN = 9
+LOAD_VEC = 10
+STORE_VEC = 11
+MEMORY_COPY = 12
+MEMORY_FILL = 13
+MEMORY_SIZE = 14
+MEMORY_GROW = 15
+LOCAL_LOCAL_OP = 16
+LOCAL_CONST_OP = 17
+LOCAL_CONST_OP_LOCAL_SET = 18
+CONST_LOCAL_OP_BR_IF = 19
+FUEL = 20
+BR_FUEL = 21
+
+OPNAMES = {
+    CONST: 'const',
+    BINOP: 'binop',
+    LOAD: 'load',
+    STORE: 'store',
+    LOCAL_GET: 'local.get',
+    LOCAL_SET: 'local.set',
+    CALL: 'call',
+    BR: 'br',
+    BR_IF: 'br_if',
+    RETURN: 'return',
+    LOAD_VEC: 'load.vec',
+    STORE_VEC: 'store.vec',
+    MEMORY_COPY: 'memory.copy',
+    MEMORY_FILL: 'memory.fill',
+    MEMORY_SIZE: 'memory.size',
+    MEMORY_GROW: 'memory.grow',
+    LOCAL_LOCAL_OP: 'local.local.op',
+    LOCAL_CONST_OP: 'local.const.op',
+    LOCAL_CONST_OP_LOCAL_SET: 'local.const.op.local.set',
+    CONST_LOCAL_OP_BR_IF: 'const.local.op.br_if',
+    FUEL: 'fuel',
+    BR_FUEL: 'br.fuel',
+}
+
+PAGE_SIZE = 65536
+
+_MMAP_ACCESS = {
+    'read': mmap.ACCESS_READ,
+    'write': mmap.ACCESS_WRITE,
+    'copy': mmap.ACCESS_COPY,
+}
+
+_F64 = struct.Struct('<d')
+
+
+@functools.lru_cache(maxsize=None)
+def _f64_vector(n):
+    """A precompiled struct for n contiguous little endian doubles."""
+    return struct.Struct(f'<{n}d')
+
+
+#   Free frames kept per function for reuse by later calls
+FRAME_POOL_SIZE = 64
+
+#   Default limit on the depth of nested guest function calls
+MAX_CALL_DEPTH = 1000000
+
+
+class Code:
+    """Flat bytecode lowered from a structured instruction list."""
+    def __init__(self, instructions, nparams=0, nlocals=0):
+        self.instructions = instructions    # [(opcode, arg), ...]
+        self.nparams = nparams
+        self.nlocals = nlocals
+        self.zeros = (0.0,) * (nlocals - nparams)   # initial non-param locals
+        self.frames = []                    # pool of free frames
+        self.calls = 0                      # calls counted towards tiering up
+        self.native = None                  # translated Python function
+        self.max_stack = None               # highest stack height, if verified
+        self.fuel = 0                       # charged for each call when metered
+        self.source = None                  # structured instructions it was lowered from
+
+    def __len__(self):
+        return len(self.instructions)
+
+
+def lower(instructions, nparams=0, nlocals=None, metered=False):
+    """Lower structured instructions into flat bytecode with resolved branch targets."""
+    flat = []
+    _lower(instructions, flat, labels=[])
+    flat.append((RETURN, None))     # falling off the end returns
+    entry = 0
+    if metered:
+        flat, entry = _meter(flat)
+        entry = max(entry, 1)
+    used = 1 + max((i for opcode, arg in flat for i in _local_indices(opcode, arg)), default=-1)
+    if nlocals is None:
+        nlocals = max(nparams, used)
+    elif used > nlocals:
+        raise InvalidLocal(f'Local {used - 1} out of range for {nlocals} locals')
+    code = Code(flat, nparams, nlocals)
+    code.fuel = entry
+    return code
+
+
+def load_function(func, fused=False, metered=False):
+    """Lower a function's code, optionally fusing superinstructions first."""
+    code = fuse(func.code) if fused else func.code
+    return lower(code, func.nparams, func.nlocals, metered)
+
+
+def _lower(instructions, flat, labels):
+    #   labels holds the branch target of each enclosing block/loop, innermost
+    #   last. A loop target is the (known) address of its first instruction, a
+    #   block target is its end which isn't known yet so a list of the branch
+    #   instructions to patch is kept instead.
+    for opcode, *args in instructions:
+        if opcode == 'const':
+            flat.append((CONST, args[0]))
+        elif opcode in BINARY_OPS:
+            flat.append((BINOP, BINARY_OPS[opcode]))
+        elif opcode == 'load':
+            flat.append((LOAD, None))
+        elif opcode == 'store':
+            flat.append((STORE, None))
+        elif opcode == 'load.vec':
+            flat.append((LOAD_VEC, _f64_vector(args[0])))
+        elif opcode == 'store.vec':
+            flat.append((STORE_VEC, (args[0], _f64_vector(args[0]))))
+        elif opcode == 'memory.copy':
+            flat.append((MEMORY_COPY, None))
+        elif opcode == 'memory.fill':
+            flat.append((MEMORY_FILL, None))
+        elif opcode == 'memory.size':
+            flat.append((MEMORY_SIZE, None))
+        elif opcode == 'memory.grow':
+            flat.append((MEMORY_GROW, None))
+        elif opcode == 'local.get':
+            flat.append((LOCAL_GET, args[0]))
+        elif opcode == 'local.set':
+            flat.append((LOCAL_SET, args[0]))
+        elif opcode == 'call':
+            flat.append((CALL, args[0]))
+        elif opcode == 'br':
+            _branch(flat, labels, args[0], (BR, None))
+        elif opcode == 'br_if':
+            _branch(flat, labels, args[0], (BR_IF, None))
+        elif opcode == 'local.local.op':
+            a, b, name = args
+            flat.append((LOCAL_LOCAL_OP, (a, b, BINARY_OPS[name])))
+        elif opcode == 'local.const.op':
+            index, value, name = args
+            flat.append((LOCAL_CONST_OP, (index, value, BINARY_OPS[name])))
+        elif opcode == 'local.const.op.local.set':
+            index, value, name, dest = args
+            flat.append((LOCAL_CONST_OP_LOCAL_SET, (index, value, BINARY_OPS[name], dest)))
+        elif opcode == 'const.local.op.br_if':
+            value, index, name, level = args
+            _branch(flat, labels, level, (CONST_LOCAL_OP_BR_IF, (value, index, BINARY_OPS[name], None)))
+        elif opcode == 'block':
+            patches = []
+            labels.append(patches)
+            _lower(args[0], flat, labels)
+            labels.pop()
+            end = len(flat)
+            for pc in patches:
+                flat[pc] = _retarget(flat[pc], end)
+        elif opcode == 'loop':
+            labels.append(len(flat))
+            _lower(args[0], flat, labels)
+            labels.pop()
+        elif opcode == 'return':
+            flat.append((RETURN, None))
+        else:
+            raise InvalidOpcode(f'Unsupported opcode {opcode}')
+
+
+def _branch(flat, labels, level, instruction):
+    """Append a branch to the label of the enclosing block/loop level levels out."""
+    if not 0 <= level < len(labels):
+        raise InvalidBranch(f'Branch level {level} exceeds nesting depth {len(labels)}')
+    target = labels[-1 - level]
+    if isinstance(target, list):
+        target.append(len(flat))
+        flat.append(instruction)
+    else:
+        flat.append(_retarget(instruction, target))
+
+
+def _retarget(instruction, target):
+    """Set the address a branch instruction jumps to."""
+    opcode, arg = instruction
+    if opcode == CONST_LOCAL_OP_BR_IF:
+        return opcode, arg[:-1] + (target,)
+    return opcode, target
+
+
+def _target(instruction):
+    """The address a branch instruction jumps to, None for other instructions."""
+    opcode, arg = instruction
+    if opcode in (BR, BR_IF):
+        return arg
+    elif opcode == CONST_LOCAL_OP_BR_IF:
+        return arg[-1]
+    return None
+
+
+def _meter(flat):
+    """Add fuel charges to loop back edges, returning the new bytecode and the cost of a call.
+
+    Every loop iteration and call is charged, so fuel bounds how long code
+    runs. A call is charged for the instructions up to the first loop, at
+    least one so recursion through a loop is charged too, and a back edge for
+    the loop body it jumps back over, an estimate of the instructions
+    executed that is exact for straight line code.
+
+    A ``br`` back becomes a BR_FUEL charging as it jumps, a conditional branch
+    back gets a FUEL instruction before it.
+    """
+    entry = min((target for pc, target in enumerate(map(_target, flat)) if target is not None and target <= pc),
+                default=len(flat))
+    metered = []
+    moved = []      # new address of each instruction, or of the FUEL before it
+    for pc, instruction in enumerate(flat):
+        moved.append(len(metered))
+        target = _target(instruction)
+        if target is not None and target <= pc:
+            cost = pc + 1 - target
+            if instruction[0] == BR:
+                instruction = (BR_FUEL, (target, cost))
+            else:
+                metered.append((FUEL, cost))
+        metered.append(instruction)
+    metered = [_retarget(instruction, moved[_target(instruction)]) if _target(instruction) is not None
+               else (BR_FUEL, (moved[instruction[1][0]], instruction[1][1])) if instruction[0] == BR_FUEL
+               else instruction
+               for instruction in metered]
+    return metered, entry
+
+
+def _local_indices(opcode, arg):
+    """The local variable indices an instruction uses."""
+    if opcode in (LOCAL_GET, LOCAL_SET):
+        return (arg,)
+    elif opcode == LOCAL_LOCAL_OP:
+        return arg[:2]
+    elif opcode == LOCAL_CONST_OP:
+        return (arg[0],)
+    elif opcode == LOCAL_CONST_OP_LOCAL_SET:
+        return (arg[0], arg[3])
+    elif opcode == CONST_LOCAL_OP_BR_IF:
+        return (arg[1],)
+    return ()
+
+
+def _matches(instructions, *patterns):
+    """Whether instructions start with opcodes matching patterns (an opcode or a collection of them)."""
+    if len(instructions) < len(patterns):
+        return False
+    for (opcode, *_), pattern in zip(instructions, patterns):
+        if isinstance(pattern, str):
+            pattern = (pattern,)
+        if opcode not in pattern:
+            return False
+    return True
+
+
+def fuse(instructions):
+    """Peephole pass rewriting common instruction sequences into superinstructions."""
+    fused = []
+    i = 0
+    while i < len(instructions):
+        window = instructions[i:i + 4]
+        if _matches(window, 'const', 'local.get', BINARY_OPS, 'br_if'):
+            (_, value), (_, index), (name,), (_, level) = window
+            fused.append(('const.local.op.br_if', value, index, name, level))
+            i += 4
+        elif _matches(window, 'local.get', 'const', BINARY_OPS, 'local.set'):
+            (_, index), (_, value), (name,), (_, dest) = window
+            fused.append(('local.const.op.local.set', index, value, name, dest))
+            i += 4
+        elif _matches(window, 'local.get', 'local.get', BINARY_OPS):
+            (_, a), (_, b), (name,) = window[:3]
+            fused.append(('local.local.op', a, b, name))
+            i += 3
+        elif _matches(window, 'local.get', 'const', BINARY_OPS):
+            (_, index), (_, value), (name,) = window[:3]
+            fused.append(('local.const.op', index, value, name))
+            i += 3
+        elif window[0][0] in ('block', 'loop'):
+            opcode, body = window[0]
+            fused.append((opcode, fuse(body)))
+            i += 1
+        else:
+            fused.append(window[0])
+            i += 1
+    return fused
+
+
+def map_memory(path, access='copy'):
+    """Memory map a file for use as VM memory.
+
+    access is one of:
+        - 'read': read only, the pages are shared by every VM mapping the file
+        - 'copy': writes are private to the VM, pages are copied on first write
+        - 'write': writes go through to the file
+    """
+    with open(path, 'rb' if access == 'read' else 'r+b') as f:
+        return mmap.mmap(f.fileno(), 0, access=_MMAP_ACCESS[access])
+
+
+class OperandStack(MutableSequence):
+    """A list like operand stack over preallocated slots, for VMs created with stack_pointer=True.
+
+    The dispatch loop indexes ``items`` with its own stack pointer rather than
+    calling methods, ``sp`` is the number of values on the stack between runs.
+    """
+    def __init__(self, values=()):
+        self.items = list(values)
+        self.sp = len(self.items)
+
+    def reserve(self, size):
+        """Make room for at least size values, growing items in place."""
+        items = self.items
+        if size > len(items):
+            items.extend([0.0] * max(size - len(items), len(items)))
+
+    def _index(self, index):
+        if index < 0:
+            index += self.sp
+        if not 0 <= index < self.sp:
+            raise IndexError('stack index out of range')
+        return index
+
+    def _replace(self, values):
+        self.items[:self.sp] = values
+        self.sp = len(values)
+
+    def __len__(self):
+        return self.sp
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.items[:self.sp][index]
+        return self.items[self._index(index)]
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            values = self[:]
+            values[index] = value
+            self._replace(values)
+        else:
+            self.items[self._index(index)] = value
+
+    def __delitem__(self, index):
+        values = self[:]
+        del values[index]
+        self._replace(values)
+
+    def __iter__(self):
+        return iter(self.items[:self.sp])
+
+    def __eq__(self, other):
+        if isinstance(other, OperandStack):
+            other = other[:]
+        return self[:] == other
+
+    def __repr__(self):
+        return repr(self[:])
+
+    def insert(self, index, value):
+        values = self[:]
+        values.insert(index, value)
+        self._replace(values)
+
+    def append(self, value):
+        if self.sp < len(self.items):
+            self.items[self.sp] = value
+        else:
+            self.items.append(value)
+        self.sp += 1
+
+    def extend(self, values):
+        values = list(values)
+        self.items[self.sp:self.sp + len(values)] = values
+        self.sp += len(values)
+
+    def pop(self, index=-1):
+        if index != -1:
+            return super().pop(index)
+        if not self.sp:
+            raise IndexError('pop from empty stack')
+        self.sp -= 1
+        return self.items[self.sp]
+
+    def clear(self):
+        self.sp = 0
+
+
+class Snapshot:
+    """The memory, stack and fuel of a VM between runs."""
+    def __init__(self, memory, stack, fuel=None):
+        self.memory = memory    # bytes
+        self.stack = stack      # tuple
+        self.fuel = fuel
+        self._file = None       # the memory image for mappings, written on first use
+
+    def map(self):
+        """A private copy on write mapping of the memory, sharing its pages with other mappings until written."""
+        if not self.memory:
+            return bytearray()      # empty files can't be mapped
+        if self._file is None:
+            image = tempfile.TemporaryFile()
+            image.write(self.memory)
+            image.flush()
+            self._file = image
+        return mmap.mmap(self._file.fileno(), len(self.memory), access=mmap.ACCESS_COPY)
+
+    def __getstate__(self):
+        return {**self.__dict__, '_file': None}
+
 
 class VirtualMachine:
     """A simple stack based virtual machine with basic linear memory."""
-    def __init__(self, functions, memory_size=65536, debug=False):
+    def __init__(self, functions, memory_size=65536, debug=False, memory=None, max_memory_size=None,
+                 max_call_depth=MAX_CALL_DEPTH, fused=True, jit_threshold=None, verify=False, fuel=None,
+                 stack_pointer=False):
+        if fuel is not None and jit_threshold is not None:
+            raise ValueError('Fuel metering needs jit_threshold=None, translated functions are not metered')
+        if memory is None:
+            memory = bytearray(memory_size)
         self.functions = functions              # function table
-        self.memory = bytearray(memory_size)    # memory
-        self.stack = []                         # stack
+        self.memory = memory                    # memory
+        self.max_memory_size = max_memory_size  # limit for memory.grow
+        self.max_call_depth = max_call_depth    # limit for nested calls
+        self.fused = fused                      # use superinstructions
+        self.jit_threshold = jit_threshold      # calls before translating a function
+        self.verify = verify or stack_pointer   # verify code before running it, giving its max stack height
+        self.stack_pointer = stack_pointer      # preallocated operand stack indexed by a stack pointer
+        self.metered = fuel is not None         # charge fuel for executed instructions
+        self.fuel = fuel                        # remaining fuel
+        self.stack = OperandStack() if stack_pointer else []    # stack
+        self.profile = None                     # set by a CountingProfiler while profiling
+        self._queued = {}                       # batched external functions with queued calls
+        self._code = {}                         # lowered function bytecode
         self._logger = logging.getLogger(self.__class__.__name__)
-        logging_setup(debug=debug)
+        self._run = _run_indexed() if stack_pointer else _run_fast
+        if debug:
+            logging_setup(debug=debug)     # levels are otherwise left to the host
+            self._run = _run_traced
 
     def debug(self, msg):
         """Print a debug message."""
@@ -113,11 +766,91 @@ class VirtualMachine:
 
     def load(self, addr):
         """Load a value from the specified address."""
-        return struct.unpack('<d', self.memory[addr:addr+8])[0]
+        return _F64.unpack_from(self.memory, addr)[0]
 
     def store(self, addr, val):
         """Store a value at the specified address."""
-        self.memory[addr:addr+8] = struct.pack('<d', val)
+        _F64.pack_into(self.memory, addr, val)
+
+    def load_many(self, addr, n):
+        """Load n contiguous values starting at the specified address."""
+        return list(_f64_vector(n).unpack_from(self.memory, addr))
+
+    def store_many(self, addr, values):
+        """Store contiguous values starting at the specified address."""
+        _f64_vector(len(values)).pack_into(self.memory, addr, *values)
+
+    def _check_bounds(self, addr, n):
+        if addr < 0 or n < 0 or addr + n > len(self.memory):
+            raise IndexError(f'Out of bounds memory access {addr}:{addr+n}')
+
+    def copy(self, dst, src, n):
+        """Copy n bytes from src to dst, the regions may overlap."""
+        dst, src, n = int(dst), int(src), int(n)
+        self._check_bounds(dst, n)
+        self._check_bounds(src, n)
+        with memoryview(self.memory) as view:
+            view[dst:dst+n] = view[src:src+n]
+
+    def fill(self, dst, value, n):
+        """Set n bytes starting at dst to value."""
+        dst, value, n = int(dst), int(value), int(n)
+        self._check_bounds(dst, n)
+        with memoryview(self.memory) as view:
+            view[dst:dst+n] = bytes((value,)) * n
+
+    def size(self):
+        """The size of memory in pages."""
+        return len(self.memory) // PAGE_SIZE
+
+    def grow(self, pages):
+        """Grow memory by a number of pages returning the old size in pages, or -1 on failure."""
+        pages = int(pages)
+        old_size = len(self.memory)
+        new_size = old_size + pages * PAGE_SIZE
+        if pages < 0 or (self.max_memory_size is not None and new_size > self.max_memory_size):
+            return -1
+        try:
+            if isinstance(self.memory, mmap.mmap):
+                self.memory.resize(new_size)
+            else:
+                self.memory.extend(bytes(new_size - old_size))
+        except (BufferError, TypeError, OSError):
+            #   read only and copy on write mappings, or a bytearray with views
+            #   onto it, can't be resized
+            return -1
+        return old_size // PAGE_SIZE
+
+    def snapshot(self):
+        """Capture memory, stack and fuel, between runs."""
+        return Snapshot(bytes(self.memory), tuple(self.stack), self.fuel)
+
+    def restore(self, snapshot):
+        """Reset memory, stack and fuel to a snapshot."""
+        if len(self.memory) != len(snapshot.memory) and isinstance(self.memory, mmap.mmap):
+            self.memory.resize(len(snapshot.memory))
+        self.memory[:] = snapshot.memory
+        self.stack[:] = snapshot.stack
+        self.fuel = snapshot.fuel
+
+    def clone(self, snapshot=None):
+        """A new VM sharing the function table and loaded code, started from a snapshot (of this VM by default).
+
+        Memory is a copy on write mapping of the snapshot.
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+        vm = copy.copy(self)
+        vm.memory = snapshot.map()
+        vm.stack = type(self.stack)(snapshot.stack)
+        vm.fuel = snapshot.fuel
+        vm.profile = None
+        vm._queued = {}
+        if vm._run is _run_profiled:
+            vm._run = _run_indexed() if self.stack_pointer else _run_fast
+        if self.jit_threshold is not None:
+            vm._code = {}       # translated functions are bound to the VM that translated them
+        return vm
 
     def push(self, item):
         """Push an instruction onto the call stack."""
@@ -129,72 +862,443 @@ class VirtualMachine:
 
     def call(self, func, *args):
         """Call a specified function with args."""
-        locals_ = dict(enumerate(args))
         if isinstance(func, Function):
-            try:
-                self.execute(func.code, locals_)
-            except Return:
-                pass
+            _check_args(func, args)
+            code = self._load(func)
+            if self.jit_threshold is not None and self._tier_up(func, code):
+                return code.native(*args)
+            frames = code.frames
+            locals_ = frames.pop() if frames else [0.0] * code.nlocals
+            locals_[:code.nparams] = args
+            if code.zeros:
+                locals_[code.nparams:] = code.zeros
+            self.run(code, locals_)
+            if len(frames) < FRAME_POOL_SIZE:
+                frames.append(locals_)
             if func.returns:
                 return self.pop()
         else:
+            if func.batched:
+                self._queued[func] = None
             return func.call(*args)     # External function
 
-    def execute(self, instructions, locals_):
-        """Execute instructions."""
-        for opcode, *args in instructions:
-            self.debug(f'OPCODE: {opcode}, ARGS: {args}')
-            if opcode == 'const':
-                self.push(args[0])
-            elif opcode in BINARY_OPS:
-                operator = BINARY_OPS[opcode]
-                right = self.pop()
-                left = self.pop()
-                self.push(operator(left, right))
-            elif opcode == 'load':
-                addr = self.pop()
-                self.push(self.load(addr))
-            elif opcode == 'store':
-                val = self.pop()
-                addr = self.pop()
-                self.store(addr, val)
-            elif opcode == 'local.get':
-                self.push(locals_[args[0]])
-            elif opcode == 'local.set':
-                locals_[args[0]] = self.pop()
-            elif opcode == 'call':
-                func = self.functions[args[0]]
-                fargs = reversed([self.pop() for _ in range(func.nparams)])
-                result = self.call(func, *fargs)
-                if func.returns:
-                    self.push(result)
-            elif opcode == 'br':
-                raise Break(args[0]) 
-            elif opcode == 'br_if':
-                if self.pop():
-                    raise Break(args[0])
-            elif opcode == 'block':
+    def _load(self, func):
+        """The lowered code of a function, lowering it on first use."""
+        code = self._code.get(func)
+        if code is None:
+            max_stack = self._verify(func.code, func.nlocals, bool(func.returns))
+            code = self._code[func] = load_function(func, self.fused, self.metered)
+            code.max_stack = max_stack
+            code.source = func.code
+        return code
+
+    def _verify(self, instructions, nlocals=None, returns=None, height=0):
+        """The maximum stack height of verified instructions, None if the VM doesn't verify code."""
+        if self.verify:
+            from posed.verifier import verify     # posed.verifier imports this module
+            return verify(instructions, self.functions, nlocals, returns, height)
+
+    def _tier_up(self, func, code):
+        """Count a call to a function, translating it once it is hot. Returns whether it's translated."""
+        if code.native is None:
+            code.calls += 1
+            if code.calls == self.jit_threshold:
+                from posed.jit import translate, Untranslatable     # posed.jit imports this module
                 try:
-                    self.execute(args[0], locals_)
-                except Break as b:
-                    if b.level > 0:
-                        b.level -= 1
-                        raise
-            elif opcode == 'loop':
-                while True:
-                    try:
-                        self.execute(args[0], locals_)
-                        break
-                    except Break as b:
-                        if b.level > 0:
-                            b.level -= 1
-                            raise
-            elif opcode == 'return':
-                raise Return()
+                    code.native = translate(func, self)
+                except Untranslatable as e:
+                    self._logger.debug(f'Function left to the interpreter: {e}')
+        return code.native is not None
+
+    def run(self, code, locals_):
+        """Run lowered bytecode."""
+        if self.stack_pointer and code.max_stack is None:
+            raise VirtualMachineError('Code needs a max_stack from the verifier to run with stack_pointer=True')
+        try:
+            self._run(self, code, locals_)
+        finally:
+            if self._queued:
+                self.flush()
+
+    def resume(self, state, fuel=None):
+        """Continue execution stopped by OutOfFuel or Suspended, optionally with a new amount of fuel."""
+        if fuel is not None:
+            self.fuel = fuel
+        code, pc, locals_, frames = state
+        try:
+            self._run(self, code, locals_, pc, frames)
+        finally:
+            if self._queued:
+                self.flush()
+
+    def flush(self):
+        """Pass calls queued by batched external functions on to the host."""
+        queued = self._queued
+        self._queued = {}
+        for func in queued:
+            func.flush()
+
+    def execute(self, instructions, locals_=None):
+        """Execute instructions, locals_ is an optional sequence (or mapping by index) of initial local values."""
+        max_stack = self._verify(instructions, height=len(self.stack))
+        code = lower(fuse(instructions) if self.fused else instructions, metered=self.metered)
+        code.max_stack = max_stack
+        code.source = instructions
+        if isinstance(locals_, Mapping):
+            #   as locals were once given, a dict keyed by local index
+            frame = [0.0] * max(code.nlocals, 1 + max(locals_, default=-1))
+            for index, value in locals_.items():
+                frame[index] = value
+        else:
+            frame = list(locals_ or ())
+            frame.extend([0.0] * (code.nlocals - len(frame)))
+        self.run(code, frame)
+
+
+def _run(vm, code, locals_, pc=0, frames=None):
+    """The dispatch loop.
+
+    Never called directly, fast, traced and profiled copies are built from it
+    below with TRACE and PROFILE inlined so that tracing and profiling cost
+    nothing when they are disabled.
+
+    The indexed copy (STACK_POINTER) keeps operands in the preallocated
+    slots of an OperandStack, indexed by a local stack pointer that is
+    written back to the OperandStack whenever the loop exits or calls out.
+
+    Calls to guest functions don't recurse, the caller's code, pc and locals
+    are saved on a list of frames and restored by its callee's return.
+
+    Running out of fuel raises OutOfFuel with the code, pc, locals and frames
+    to pass back in to resume from the FUEL instruction that ran out.
+    """
+    instructions = code.instructions
+    functions = vm.functions
+    loaded = vm._code
+    if frames is None:
+        frames = []
+    fuel = vm.fuel
+    metered = vm.metered
+    max_depth = vm.max_call_depth
+    jit = vm.jit_threshold is not None
+    if STACK_POINTER:
+        operands = vm.stack
+        stack = operands.items
+        sp = operands.sp
+        operands.reserve(sp + code.max_stack)
+    else:
+        stack = vm.stack
+        push = stack.append
+        pop = stack.pop
+    memory = vm.memory
+    unpack_f64 = _F64.unpack_from
+    pack_f64 = _F64.pack_into
+    if TRACE:
+        debug = vm._logger.debug
+    if PROFILE:
+        profile = vm.profile
+        counts = profile.enter(code, frames)
+    try:
+        while True:
+            opcode, arg = instructions[pc]
+            if PROFILE:
+                counts[pc] += 1
+            if TRACE:
+                debug(f'OPCODE: {OPNAMES.get(opcode, opcode)}, ARG: {arg}')
+            pc += 1
+            if opcode == LOCAL_GET:
+                if STACK_POINTER:
+                    stack[sp] = locals_[arg]
+                    sp += 1
+                else:
+                    push(locals_[arg])
+            elif opcode == CONST:
+                if STACK_POINTER:
+                    stack[sp] = arg
+                    sp += 1
+                else:
+                    push(arg)
+            elif opcode == BINOP:
+                if STACK_POINTER:
+                    sp -= 1
+                    stack[sp - 1] = arg(stack[sp - 1], stack[sp])
+                else:
+                    right = pop()
+                    push(arg(pop(), right))
+            elif opcode == CONST_LOCAL_OP_BR_IF:
+                value, index, operator, target = arg
+                if operator(value, locals_[index]):
+                    pc = target
+            elif opcode == LOCAL_CONST_OP_LOCAL_SET:
+                index, value, operator, dest = arg
+                locals_[dest] = operator(locals_[index], value)
+            elif opcode == LOCAL_LOCAL_OP:
+                a, b, operator = arg
+                if STACK_POINTER:
+                    stack[sp] = operator(locals_[a], locals_[b])
+                    sp += 1
+                else:
+                    push(operator(locals_[a], locals_[b]))
+            elif opcode == LOCAL_CONST_OP:
+                index, value, operator = arg
+                if STACK_POINTER:
+                    stack[sp] = operator(locals_[index], value)
+                    sp += 1
+                else:
+                    push(operator(locals_[index], value))
+            elif opcode == BR_IF:
+                if STACK_POINTER:
+                    sp -= 1
+                    if stack[sp]:
+                        pc = arg
+                elif pop():
+                    pc = arg
+            elif opcode == BR:
+                pc = arg
+            elif opcode == BR_FUEL:
+                target, cost = arg
+                if fuel < cost:
+                    vm.fuel = fuel
+                    raise OutOfFuel(f'Out of fuel, {fuel} left for a loop costing {cost}',
+                                    (code, pc - 1, locals_, frames), cost)
+                fuel -= cost
+                pc = target
+            elif opcode == LOCAL_SET:
+                if STACK_POINTER:
+                    sp -= 1
+                    locals_[arg] = stack[sp]
+                else:
+                    locals_[arg] = pop()
+            elif opcode == LOAD:
+                if STACK_POINTER:
+                    stack[sp - 1] = unpack_f64(memory, stack[sp - 1])[0]
+                else:
+                    push(unpack_f64(memory, pop())[0])
+            elif opcode == STORE:
+                if STACK_POINTER:
+                    sp -= 2
+                    pack_f64(memory, stack[sp], stack[sp + 1])
+                else:
+                    val = pop()
+                    pack_f64(memory, pop(), val)
+            elif opcode == CALL:
+                func = functions[arg]
+                if isinstance(func, Function):
+                    if len(frames) >= max_depth:
+                        raise CallStackOverflow(f'Maximum call depth {max_depth} exceeded')
+                    callee = loaded.get(func) or vm._load(func)
+                    if metered:
+                        if fuel < callee.fuel:
+                            vm.fuel = fuel
+                            raise OutOfFuel(f'Out of fuel, {fuel} left for a call costing {callee.fuel}',
+                                            (code, pc - 1, locals_, frames), callee.fuel)
+                        fuel -= callee.fuel
+                    if jit and vm._tier_up(func, callee):
+                        if PROFILE:
+                            profile.count_call(arg)
+                        if STACK_POINTER:
+                            sp -= callee.nparams
+                            result = callee.native(*stack[sp:sp + callee.nparams])
+                            if func.returns:
+                                stack[sp] = result
+                                sp += 1
+                        else:
+                            base = len(stack) - callee.nparams
+                            fargs = stack[base:]
+                            del stack[base:]
+                            result = callee.native(*fargs)
+                            if func.returns:
+                                push(result)
+                    else:
+                        pool = callee.frames
+                        callee_locals = pool.pop() if pool else [0.0] * callee.nlocals
+                        nparams = callee.nparams
+                        if STACK_POINTER:
+                            if nparams:
+                                sp -= nparams
+                                callee_locals[:nparams] = stack[sp:sp + nparams]
+                            if sp + callee.max_stack > len(stack):
+                                operands.reserve(sp + callee.max_stack)
+                        elif nparams:
+                            base = len(stack) - nparams
+                            callee_locals[:nparams] = stack[base:]
+                            del stack[base:]
+                        if callee.zeros:
+                            callee_locals[nparams:] = callee.zeros
+                        frames.append((code, pc, locals_))
+                        code = callee
+                        instructions = callee.instructions
+                        locals_ = callee_locals
+                        pc = 0
+                        if PROFILE:
+                            counts = profile.call(arg, callee)
+                elif func.batched:
+                    if PROFILE:
+                        profile.count_call(arg)
+                    pending = func.pending
+                    vm._queued[func] = None     # even if queued already, maybe by another VM sharing func
+                    nparams = func.nparams
+                    if STACK_POINTER:
+                        sp -= nparams
+                        pending.extend(stack[sp:sp + nparams])
+                    elif nparams == 1:
+                        pending.append(pop())
+                    else:
+                        base = len(stack) - nparams
+                        pending.extend(stack[base:])
+                        del stack[base:]
+                    if len(pending) >= func.limit:
+                        if STACK_POINTER:
+                            operands.sp = sp
+                        vm.fuel = fuel      # in case it calls back into the VM
+                        func.flush()
+                        fuel = vm.fuel
+                else:
+                    if PROFILE:
+                        profile.count_call(arg)
+                    #   Calls with up to two params are made without building an argument list
+                    call = func.call
+                    nparams = func.nparams
+                    vm.fuel = fuel      # in case it calls back into the VM
+                    if STACK_POINTER:
+                        sp -= nparams
+                        operands.sp = sp
+                        if nparams == 1:
+                            result = call(stack[sp])
+                        elif nparams == 2:
+                            result = call(stack[sp], stack[sp + 1])
+                        else:
+                            result = call(*stack[sp:sp + nparams])
+                    elif nparams == 1:
+                        result = call(pop())
+                    elif nparams == 2:
+                        right = pop()
+                        result = call(pop(), right)
+                    elif nparams == 0:
+                        result = call()
+                    else:
+                        base = len(stack) - nparams
+                        fargs = stack[base:]
+                        del stack[base:]
+                        result = call(*fargs)
+                    fuel = vm.fuel
+                    if func.awaitable:
+                        raise Suspended(f'Suspended awaiting {result!r}', (code, pc, locals_, frames),
+                                        result, func.returns)
+                    if STACK_POINTER:
+                        sp = operands.sp
+                        if func.returns:
+                            stack[sp] = result
+                            sp += 1
+                    elif func.returns:
+                        push(result)
+            elif opcode == RETURN:
+                if not frames:
+                    vm.fuel = fuel
+                    if PROFILE:
+                        profile.leave()
+                    return
+                pool = code.frames
+                if len(pool) < FRAME_POOL_SIZE:
+                    pool.append(locals_)
+                code, pc, locals_ = frames.pop()
+                instructions = code.instructions
+                if PROFILE:
+                    counts = profile.ret()
+            elif opcode == FUEL:
+                if fuel < arg:
+                    vm.fuel = fuel
+                    raise OutOfFuel(f'Out of fuel, {fuel} left for code costing {arg}',
+                                    (code, pc - 1, locals_, frames), arg)
+                fuel -= arg
+            elif opcode == LOAD_VEC:
+                if STACK_POINTER:
+                    values = arg.unpack_from(memory, stack[sp - 1])
+                    stack[sp - 1:sp - 1 + len(values)] = values
+                    sp += len(values) - 1
+                else:
+                    stack.extend(arg.unpack_from(memory, pop()))
+            elif opcode == STORE_VEC:
+                n, packer = arg
+                if STACK_POINTER:
+                    sp -= n + 1
+                    packer.pack_into(memory, stack[sp], *stack[sp + 1:sp + 1 + n])
+                else:
+                    base = len(stack) - n
+                    values = stack[base:]
+                    del stack[base:]
+                    packer.pack_into(memory, pop(), *values)
+            elif opcode == MEMORY_COPY:
+                if STACK_POINTER:
+                    sp -= 3
+                    vm.copy(stack[sp], stack[sp + 1], stack[sp + 2])
+                else:
+                    n = pop()
+                    src = pop()
+                    vm.copy(pop(), src, n)
+            elif opcode == MEMORY_FILL:
+                if STACK_POINTER:
+                    sp -= 3
+                    vm.fill(stack[sp], stack[sp + 1], stack[sp + 2])
+                else:
+                    n = pop()
+                    value = pop()
+                    vm.fill(pop(), value, n)
+            elif opcode == MEMORY_SIZE:
+                if STACK_POINTER:
+                    stack[sp] = vm.size()
+                    sp += 1
+                else:
+                    push(vm.size())
+            elif opcode == MEMORY_GROW:
+                if STACK_POINTER:
+                    stack[sp - 1] = vm.grow(stack[sp - 1])
+                else:
+                    push(vm.grow(pop()))
             else:
                 raise InvalidOpcode(f'Unsupported opcode {opcode}')
 
-            self.debug(f'STACK: {self.stack}')
+            if TRACE:
+                debug(f'STACK: {stack}')
+    finally:
+        if STACK_POINTER:
+            operands.sp = sp
+
+
+class _Inline(ast.NodeTransformer):
+    """Replace reads of the named globals with constants."""
+    def __init__(self, constants):
+        self.constants = constants
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load) and node.id in self.constants:
+            return ast.copy_location(ast.Constant(self.constants[node.id]), node)
+        return node
+
+
+def _specialise(func, **constants):
+    """Recompile a module level function with some of its globals inlined.
+
+    CPython drops ``if False:`` blocks when compiling so any code guarded by a
+    flag inlined as False is removed from the specialised function entirely.
+    """
+    tree = ast.parse(textwrap.dedent(inspect.getsource(func)))
+    tree = ast.fix_missing_locations(_Inline(constants).visit(tree))
+    ast.increment_lineno(tree, func.__code__.co_firstlineno - 1)
+    namespace = {}
+    exec(compile(tree, func.__code__.co_filename, 'exec'), func.__globals__, namespace)
+    return namespace[func.__name__]
+
+
+_run_fast = _specialise(_run, TRACE=False, PROFILE=False, STACK_POINTER=False)
+_run_traced = _specialise(_run, TRACE=True, PROFILE=False, STACK_POINTER=False)
+_run_profiled = _specialise(_run, TRACE=False, PROFILE=True, STACK_POINTER=False)
+
+
+@functools.lru_cache(maxsize=None)
+def _run_indexed():
+    """The indexed dispatch loop, built on first use as few VMs need it."""
+    return _specialise(_run, TRACE=False, PROFILE=False, STACK_POINTER=True)
 
 
 def main():
@@ -26,7 +26,9 @@ setup(
     python_requires='>=3.7, <4',
     install_requires=(HERE / 'requirements.txt').read_text(encoding='utf-8').strip().split('\n'),
     #   $ pip install posed[dev]
+    #   $ pip install posed[batch]
     extras_require={
         'dev': ['check-manifest', 'coverage', 'pytest', 'pytest-cov'],
+        'batch': ['numpy'],
     },
 )
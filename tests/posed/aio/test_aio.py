@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+from posed.aio import call, execute
+from posed.vm import (
+    AsyncExternalFunction, ExternalFunction, OutOfFuel, Suspended, VirtualMachine, VirtualMachineError,
+)
+from tests.posed.vm.test_vm import countdown_loop, countdown_recursive
+
+
+async def double(x):
+    await asyncio.sleep(0.01)
+    return x * 2
+
+
+def functions(log=None):
+    return [
+        countdown_loop(),
+        AsyncExternalFunction(nparams=1, returns=True, call=double),
+        ExternalFunction(nparams=1, returns=False, call=(log if log is not None else []).append),
+    ]
+
+
+def program(x):
+    #   log(double(x) + countdown(100))
+    return [
+        ('const', x),
+        ('call', 1),
+        ('const', 100.0),
+        ('call', 0),
+        ('add',),
+        ('call', 2),
+    ]
+
+
+def test_vm_suspends_at_async_calls():
+    vm = VirtualMachine(functions=functions())
+    with pytest.raises(Suspended) as e:
+        vm.execute([('const', 1.0), ('const', 2.0), ('call', 1), ('add',)])
+    assert vm.stack == [1.0]
+    vm.push(asyncio.run(e.value.awaitable))
+    vm.resume(e.value.state)
+    assert vm.stack == [5.0]
+
+
+def test_execute_awaits_async_calls():
+    log = []
+    vm = VirtualMachine(functions=functions(log))
+    asyncio.run(execute(vm, program(3.0)))
+    assert log == [6.0]
+    assert vm.stack == []
+
+
+def test_guests_run_concurrently():
+    log = []
+
+    async def main():
+        vms = [VirtualMachine(functions=functions(log)) for _ in range(50)]
+        await asyncio.gather(*(execute(vm, program(float(i))) for i, vm in enumerate(vms)))
+
+    loop = asyncio.new_event_loop()
+    try:
+        start = loop.time()
+        loop.run_until_complete(main())
+        elapsed = loop.time() - start
+    finally:
+        loop.close()
+    assert sorted(log) == [i * 2.0 for i in range(50)]
+    assert elapsed < 0.01 * 50 / 2
+
+
+def test_guests_are_time_sliced():
+    order = []
+
+    def guest(name):
+        vm = VirtualMachine(functions=[countdown_loop(), ExternalFunction(1, False, order.append)], fuel=0)
+        return execute(vm, [('const', 1000.0), ('call', 0), ('const', name), ('call', 1)], quantum=100)
+
+    async def main():
+        await asyncio.gather(guest(1), guest(2), execute(
+            VirtualMachine(functions=[ExternalFunction(1, False, order.append)]), [('const', 3), ('call', 0)]))
+
+    asyncio.run(main())
+    assert order[0] == 3
+    assert sorted(order[1:]) == [1, 2]
+
+
+def test_out_of_fuel_without_quantum():
+    vm = VirtualMachine(functions=functions(), fuel=10)
+    with pytest.raises(OutOfFuel):
+        asyncio.run(execute(vm, program(1.0)))
+
+
+@pytest.mark.parametrize("quantum", [None, 7])
+def test_call(quantum):
+    vm = VirtualMachine(functions=[countdown_recursive()], fuel=None if quantum is None else 0)
+    assert asyncio.run(call(vm, vm.functions[0], 50.0, quantum=quantum)) == 0.0
+    assert asyncio.run(call(vm, AsyncExternalFunction(1, True, double), 4.0)) == 8.0
+    assert vm.stack == []
+
+
+def test_quantum_smaller_than_a_charge():
+    #   each iteration of the fused loop costs more than a slice
+    vm = VirtualMachine(functions=[countdown_loop()], fuel=0)
+    assert asyncio.run(call(vm, vm.functions[0], 5.0, quantum=2)) == 0.0
+
+
+@pytest.mark.parametrize("args", [(), (50.0, 2.0)])
+def test_call_checks_argument_count(args):
+    vm = VirtualMachine(functions=[countdown_recursive()])
+    with pytest.raises(VirtualMachineError):
+        asyncio.run(call(vm, vm.functions[0], *args))
@@ -0,0 +1,194 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from posed.batch import BatchVirtualMachine
+from posed.vm import VirtualMachine, Function, ExternalFunction, BatchedExternalFunction, InvalidOpcode
+
+
+def sum_to():
+    #   fun sum_to(x)
+    #       total = 0
+    #       while x > 0:
+    #           total = total + x
+    #           x = x - 1
+    #       return total
+    return Function(nparams=1, returns=True, code=[
+        ('block', [
+            ('loop', [
+                ('const', 0.0),
+                ('local.get', 0),
+                ('ge',),
+                ('br_if', 1),
+                ('local.get', 1),
+                ('local.get', 0),
+                ('add',),
+                ('local.set', 1),
+                ('local.get', 0),
+                ('const', 1.0),
+                ('sub',),
+                ('local.set', 0),
+                ('br', 0),
+            ]),
+        ]),
+        ('local.get', 1),
+    ])
+
+
+def collatz_steps():
+    #   fun steps(n)
+    #       while n > 1:
+    #           if n % 2 == 0: n = n / 2 else: n = 3 * n + 1
+    #           steps = steps + 1
+    #           if steps >= 20: return -1
+    #       return steps
+    return Function(nparams=1, returns=True, code=[
+        ('block', [
+            ('loop', [
+                ('const', 1.0),
+                ('local.get', 0),
+                ('ge',),
+                ('br_if', 1),
+                ('block', [
+                    ('block', [
+                        ('local.get', 0),
+                        ('const', 2.0),
+                        ('mod',),
+                        ('const', 0.0),
+                        ('eq',),
+                        ('br_if', 0),
+                        ('const', 3.0),
+                        ('local.get', 0),
+                        ('mul',),
+                        ('const', 1.0),
+                        ('add',),
+                        ('local.set', 0),
+                        ('br', 1),
+                    ]),
+                    ('local.get', 0),
+                    ('const', 2.0),
+                    ('div',),
+                    ('local.set', 0),
+                ]),
+                ('local.get', 1),
+                ('const', 1.0),
+                ('add',),
+                ('local.set', 1),
+                ('block', [
+                    ('local.get', 1),
+                    ('const', 20.0),
+                    ('lt',),
+                    ('br_if', 0),
+                    ('const', -1.0),
+                    ('return',),
+                ]),
+                ('br', 0),
+            ]),
+        ]),
+        ('local.get', 1),
+    ])
+
+
+def fib():
+    #   fun fib(n)
+    #       if n < 2: return n
+    #       return fib(n - 1) + fib(n - 2)
+    return Function(nparams=1, returns=True, code=[
+        ('block', [
+            ('local.get', 0),
+            ('const', 2.0),
+            ('ge',),
+            ('br_if', 0),
+            ('local.get', 0),
+            ('return',),
+        ]),
+        ('local.get', 0),
+        ('const', 1.0),
+        ('sub',),
+        ('call', 0),
+        ('local.get', 0),
+        ('const', 2.0),
+        ('sub',),
+        ('call', 0),
+        ('add',),
+    ])
+
+
+@pytest.mark.parametrize("func", [sum_to(), collatz_steps(), fib()])
+def test_batch_matches_vm(func):
+    inputs = np.arange(0.0, 15.0)
+    results = BatchVirtualMachine(functions=[func]).call(func, inputs)
+    vm = VirtualMachine(functions=[func])
+    assert list(results) == [vm.call(func, x) for x in inputs]
+
+
+def binary(*code):
+    return Function(nparams=2, returns=True, code=list(code))
+
+
+@pytest.mark.parametrize("func", [
+    #   (a < b) + (a < b)
+    binary(('local.get', 0), ('local.get', 1), ('lt',), ('local.get', 0), ('local.get', 1), ('lt',), ('add',)),
+    #   (a < b) - (a >= b)
+    binary(('local.get', 0), ('local.get', 1), ('lt',), ('local.get', 0), ('local.get', 1), ('ge',), ('sub',)),
+    #   (a == b) * 3 / (a != b + 1)
+    binary(('local.get', 0), ('local.get', 1), ('eq',), ('const', 3.0), ('mul',),
+           ('local.get', 0), ('local.get', 1), ('ne',), ('const', 1.0), ('add',), ('div',)),
+])
+def test_batch_arithmetic_on_comparisons_matches_vm(func):
+    a, b = np.meshgrid(np.arange(-2.0, 3.0), np.arange(-2.0, 3.0))
+    a, b = a.ravel(), b.ravel()
+    results = BatchVirtualMachine(functions=[func]).call(func, a, b)
+    vm = VirtualMachine(functions=[func])
+    assert results.dtype == float
+    assert list(results) == [vm.call(func, float(x), float(y)) for x, y in zip(a, b)]
+
+
+def test_batch_constant_division_by_zero():
+    vm = BatchVirtualMachine(functions=[])
+    vm.execute(instructions=[('const', 1.0), ('const', 0.0), ('div',)], size=2)
+    assert list(vm.pop()) == [np.inf, np.inf]
+
+
+def test_batch_execute_expression():
+    vm = BatchVirtualMachine(functions=[])
+    vm.execute(instructions=[
+        ('local.get', 0),
+        ('const', 2.0),
+        ('mul',),
+        ('local.get', 1),
+        ('add',),
+    ], locals_=[np.array([1.0, 2.0, 3.0]), 10.0])
+    assert list(vm.pop()) == [12.0, 14.0, 16.0]
+    assert vm.stack == []
+
+
+@pytest.mark.parametrize('external', [
+    lambda call: ExternalFunction(nparams=1, returns=False, call=call),
+    lambda call: BatchedExternalFunction(nparams=1, call=call),
+])
+def test_batch_external_function_receives_active_lanes(external):
+    calls = []
+
+    def show(x):
+        calls.append(list(x))
+
+    func = Function(nparams=1, returns=False, code=[
+        ('block', [
+            ('local.get', 0),
+            ('const', 0.0),
+            ('lt',),
+            ('br_if', 0),
+            ('local.get', 0),
+            ('call', 0),
+        ]),
+    ])
+    functions = [external(show), func]
+    BatchVirtualMachine(functions=functions).call(func, np.array([1.0, -1.0, 2.0]))
+    assert calls == [[1.0, 2.0]]
+
+
+def test_batch_memory_unsupported():
+    vm = BatchVirtualMachine(functions=[])
+    with pytest.raises(InvalidOpcode):
+        vm.execute(instructions=[('const', 0), ('load',)], size=4)
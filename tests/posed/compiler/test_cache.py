@@ -0,0 +1,76 @@
+import pytest
+
+from posed.compiler.cache import CompileCache
+from posed.compiler.compiler import Compiler
+from posed.compiler.parser import parse
+
+
+def test_cache_hits_and_misses():
+    cache = CompileCache(maxsize=4)
+    assert cache.compile('1 + 2 * 3') == [('const', 7.0)]
+    assert cache.compile('1 + 2 * 3') == [('const', 7.0)]
+    assert cache.compile('2 / 4') == [('const', 0.5)]
+    assert (cache.hits, cache.misses, len(cache)) == (1, 2, 2)
+
+
+def test_cache_matches_compiler():
+    cache = CompileCache()
+    for text in ['1 + 2', '(3 - 4) * 5', '6 / 0']:
+        assert cache.compile(text) == Compiler().compile(cache._optimizer.optimize(parse(text)))
+
+
+def test_cache_returns_copies():
+    cache = CompileCache()
+    cache.compile('1 / 0').append(('const', 1.0))
+    assert cache.compile('1 / 0') == [('const', 1.0), ('const', 0.0), ('div',)]
+
+
+def test_cache_memory_is_bounded():
+    cache = CompileCache(maxsize=8)
+    for i in range(1000):
+        cache.compile(f'{i} + 1 * 2')
+    assert len(cache) == 8
+    assert len(cache._optimizer.folded) == 2
+
+
+def test_cache_evicts_least_recently_used():
+    cache = CompileCache(maxsize=2)
+    cache.compile('1')
+    cache.compile('2')
+    cache.compile('1')
+    cache.compile('3')
+    assert '1' in cache and '3' in cache
+    assert '2' not in cache
+
+
+def test_cache_skips_syntax_errors(capsys):
+    cache = CompileCache()
+    assert cache.compile('1 +') is None
+    assert cache.compile('1 +') is None
+    assert len(cache) == 0
+    assert capsys.readouterr().out.count('Syntax error in input!') == 2
+
+
+def test_cache_persists(tmp_path):
+    path = tmp_path / 'cache.json'
+    cache = CompileCache(maxsize=2, path=path)
+    for text in ['1 + 1', '2 + 2', '3 + 3']:
+        cache.compile(text)
+    cache.save()
+
+    cache = CompileCache(maxsize=2, path=path)
+    assert len(cache) == 2 and '1 + 1' not in cache
+    assert cache.compile('3 + 3') == [('const', 6.0)]
+    assert (cache.hits, cache.misses) == (1, 0)
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_cache_ignores_unreadable_files(tmp_path):
+    path = tmp_path / 'cache.json'
+    path.write_text('not json')
+    assert len(CompileCache(path=path)) == 0
+
+
+def test_cache_size_must_be_positive():
+    with pytest.raises(ValueError):
+        CompileCache(maxsize=0)
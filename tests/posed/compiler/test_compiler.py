@@ -0,0 +1,65 @@
+import functools
+import pickle
+
+import pytest
+
+from posed.compiler.ast import BinaryOp, Constant, Add, Sub, Mul, Div
+from posed.compiler.compiler import Compiler
+from posed.compiler.optimizer import Optimizer
+from posed.compiler.parser import create_parser
+from posed.vm import VirtualMachine
+
+
+def test_operators_are_singletons():
+    assert Add() is Add()
+    assert Add() is not Sub()
+    assert pickle.loads(pickle.dumps(Mul())) is Mul()
+
+
+def test_nodes_have_slots():
+    for node in (Constant(1.0), BinaryOp(Constant(1.0), Div(), Constant(2.0)), Add()):
+        assert not hasattr(node, '__dict__')
+
+
+def test_compile():
+    ast = create_parser().parse('1 + 2 * 3 - 4 / 5')
+    assert Compiler().compile(ast) == [
+        ('const', 1.0),
+        ('const', 2.0),
+        ('const', 3.0),
+        ('mul',),
+        ('add',),
+        ('const', 4.0),
+        ('const', 5.0),
+        ('div',),
+        ('sub',),
+    ]
+
+
+def test_compile_appends_to_instructions():
+    instructions = [('const', 1.0)]
+    assert Compiler().compile(Constant(2.0), instructions) is instructions
+    assert instructions == [('const', 1.0), ('const', 2.0)]
+
+
+def deep(n, right):
+    """1 + 1 + ... with n terms nested to the left (as parsed) or the right."""
+    join = (lambda tree, one: BinaryOp(one, Add(), tree)) if right else (lambda tree, one: BinaryOp(tree, Add(), one))
+    return functools.reduce(join, (Constant(1.0) for _ in range(n - 1)), Constant(1.0))
+
+
+@pytest.mark.parametrize('right', [False, True])
+def test_deep_expressions(right):
+    n = 20000
+    ast = deep(n, right)
+    instructions = Compiler().compile(ast)
+    assert len(instructions) == 2 * n - 1
+    assert next(Compiler().iter_compile(ast)) == ('const', 1.0)
+
+    optimizer = Optimizer()
+    assert repr(optimizer.optimize(ast)) == f'Constant(value={float(n)!r})'
+    assert len(optimizer.folded) == n - 1
+
+    vm = VirtualMachine(functions=[])
+    vm.execute(instructions)
+    assert vm.stack == [float(n)]
@@ -0,0 +1,42 @@
+import pytest
+
+from posed.compiler.ast import BinaryOp, Constant, Add, Sub, Mul, Div
+from posed.compiler.compiler import Compiler
+from posed.compiler.optimizer import Optimizer
+
+
+def test_optimizer_folds_constants():
+    #   1 + 2 * 3 / 4
+    ast = BinaryOp(Constant(1.0), Add(), BinaryOp(BinaryOp(Constant(2.0), Mul(), Constant(3.0)), Div(), Constant(4.0)))
+    optimizer = Optimizer()
+    ast = optimizer.optimize(ast)
+    assert repr(ast) == repr(Constant(2.5))
+    assert Compiler().compile(ast) == [('const', 2.5)]
+    assert len(optimizer.folded) == 3
+
+
+def test_optimizer_leaves_division_by_zero_for_runtime():
+    ast = BinaryOp(Constant(1.0), Div(), BinaryOp(Constant(2.0), Sub(), Constant(2.0)))
+    optimizer = Optimizer()
+    ast = optimizer.optimize(ast)
+    assert repr(ast) == repr(BinaryOp(Constant(1.0), Div(), Constant(0.0)))
+
+
+@pytest.mark.parametrize("op, left_identity, right_identity", [
+    (Mul(), 1.0, 1.0),
+    (Div(), None, 1.0),
+    (Add(), -0.0, -0.0),
+    (Sub(), None, 0.0),
+])
+def test_optimizer_identities(op, left_identity, right_identity):
+    x = BinaryOp(Constant(1.0), Div(), Constant(0.0))   # not foldable
+    if right_identity is not None:
+        assert Optimizer().optimize(BinaryOp(x, op, Constant(right_identity))) is x
+    if left_identity is not None:
+        assert Optimizer().optimize(BinaryOp(Constant(left_identity), op, x)) is x
+
+
+def test_optimizer_keeps_signed_zero_semantics():
+    x = BinaryOp(Constant(1.0), Div(), Constant(0.0))
+    for ast in (BinaryOp(x, Add(), Constant(0.0)), BinaryOp(x, Sub(), Constant(-0.0))):
+        assert Optimizer().optimize(ast) is not x
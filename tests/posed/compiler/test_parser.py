@@ -0,0 +1,54 @@
+import sys
+import threading
+
+import ply.yacc as yacc
+
+from posed.compiler import parsetab
+from posed.compiler.lexer import Lexer
+from posed.compiler.parser import Parser, parse
+
+
+def test_shipped_parse_tables_match_grammar():
+    parser = Parser(Lexer())
+    pdict = {name: getattr(parser, name) for name in dir(parser)}
+    pdict['__file__'] = sys.modules[Parser.__module__].__file__
+    pinfo = yacc.ParserReflect(pdict)
+    pinfo.get_all()
+    assert pinfo.signature() == parsetab._lr_signature, 'run `make parsetab`'
+    #   the signature leaves out where rules are, each is a line after its def
+    lines = {name: line + 1 for line, _, name, _ in pinfo.pfuncs}
+    assert lines == {p[3]: p[5] for p in parsetab._lr_productions if p[3]}, 'run `make parsetab`'
+
+
+def test_parser_construction_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert repr(Parser(Lexer()).parse('1 + 2')) == repr(parse('1 + 2'))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_parsers_share_tables():
+    assert Parser(Lexer())._parser is Parser(Lexer())._parser
+
+
+def test_parser_uses_its_own_lexer():
+    first = Parser(Lexer())
+    second = Parser(Lexer())
+    assert repr(first.parse('(1 + 2) * 3')) == \
+        'BinaryOp(op=Mul(), left=BinaryOp(op=Add(), left=Constant(value=1.0), right=Constant(value=2.0)), ' \
+        'right=Constant(value=3.0))'
+    assert repr(second.parse('4 / 2')) == 'BinaryOp(op=Div(), left=Constant(value=4.0), right=Constant(value=2.0))'
+
+
+def test_parse_in_threads():
+    results = []
+
+    def worker():
+        results.extend(repr(parse(f'{i} + 1')) for i in range(100))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 400
+    assert all(result.startswith('BinaryOp(op=Add()') for result in results)
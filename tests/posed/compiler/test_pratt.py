@@ -0,0 +1,65 @@
+import io
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+from posed.compiler.lexer import Lexer
+from posed.compiler.parser import Parser, create_parser
+from posed.compiler.pratt import PrattParser
+from posed.compiler.scanner import Scanner
+
+
+def random_expression(rng, depth=0):
+    if depth > 4 or rng.random() < 0.3:
+        return rng.choice(['1', '23', '4.5', '67.', '0'])
+    left = random_expression(rng, depth + 1)
+    right = random_expression(rng, depth + 1)
+    expr = f'{left} {rng.choice("+-*/")} {right}'
+    return f'({expr})' if rng.random() < 0.3 else expr
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_pratt_matches_ply(seed):
+    data = random_expression(random.Random(seed))
+    assert repr(PrattParser().parse(data)) == repr(Parser(Lexer()).parse(data))
+
+
+@pytest.mark.parametrize("data", ['1 +', '', '(1', '1)', '1.25'])
+def test_pratt_syntax_errors_match_ply(data, capsys):
+    assert PrattParser().parse(data) is None
+    assert Parser(Lexer()).parse(data) is None
+    assert capsys.readouterr().out.count('Syntax error in input!') == 2
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7])
+def test_scanner_streams_files(chunk_size):
+    data = '12.5 + (3 * 45)\n- 6 / 78.9'
+    tokens = list(Scanner(chunk_size=chunk_size).tokenize(io.StringIO(data)))
+    assert tokens == list(Scanner().tokenize(data))
+    assert tokens[:3] == [('NUMBER', 12.5), ('PLUS', '+'), ('LPAREN', '(')]
+
+
+def test_pratt_parses_large_files():
+    data = io.StringIO(' + '.join(['1.5 * 2'] * 100000))
+    ast = PrattParser(Scanner(chunk_size=4096)).parse(data)
+    assert repr(ast.right) == 'BinaryOp(op=Mul(), left=Constant(value=1.5), right=Constant(value=2.0))'
+
+
+def test_create_parser():
+    assert isinstance(create_parser('pratt'), PrattParser)
+    assert isinstance(create_parser('ply'), Parser)
+    with pytest.raises(ValueError):
+        create_parser('foo')
+
+
+def test_pratt_does_not_load_ply():
+    #   in a fresh interpreter as the other tests have loaded it
+    code = ("import sys; from posed.compiler.parser import create_parser; create_parser('pratt').parse('1 + 2'); "
+            "print(sorted(name for name in sys.modules if name.split('.')[0] == 'ply'))")
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    result = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True)
+    assert result.stdout == '[]\n'
+    assert Scanner.tokens == Lexer.tokens
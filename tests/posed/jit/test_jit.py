@@ -0,0 +1,183 @@
+import pytest
+
+from posed.vm import VirtualMachine, Function, ExternalFunction, AsyncExternalFunction, BatchedExternalFunction
+from posed.jit import Untranslatable, translate
+
+
+def sum_to():
+    #   fun sum_to(x)
+    #       total = 0
+    #       while x > 0:
+    #           total = total + x
+    #           x = x - 1
+    #       return total
+    return Function(nparams=1, returns=True, code=[
+        ('block', [
+            ('loop', [
+                ('const', 0.0),
+                ('local.get', 0),
+                ('ge',),
+                ('br_if', 1),
+                ('local.get', 1),
+                ('local.get', 0),
+                ('add',),
+                ('local.set', 1),
+                ('local.get', 0),
+                ('const', 1.0),
+                ('sub',),
+                ('local.set', 0),
+                ('br', 0),
+            ]),
+        ]),
+        ('local.get', 1),
+    ])
+
+
+def nested_break():
+    #   fun f(n)
+    #       while True:
+    #           while True:
+    #               n = n + 1
+    #               if n >= 10: break outer
+    #               if n % 3 == 0: break
+    #           n = n + 100
+    #       return n
+    return Function(nparams=1, returns=True, code=[
+        ('block', [
+            ('loop', [
+                ('block', [
+                    ('loop', [
+                        ('local.get', 0),
+                        ('const', 1.0),
+                        ('add',),
+                        ('local.set', 0),
+                        ('local.get', 0),
+                        ('const', 10.0),
+                        ('ge',),
+                        ('br_if', 3),
+                        ('local.get', 0),
+                        ('const', 3.0),
+                        ('mod',),
+                        ('const', 0.0),
+                        ('eq',),
+                        ('br_if', 1),
+                        ('br', 0),
+                    ]),
+                ]),
+                ('local.get', 0),
+                ('const', 100.0),
+                ('add',),
+                ('local.set', 0),
+                ('br', 0),
+            ]),
+        ]),
+        ('local.get', 0),
+    ])
+
+
+def swap_through_stack():
+    #   reads a local before overwriting it
+    return Function(nparams=2, returns=True, code=[
+        ('local.get', 0),
+        ('local.get', 1),
+        ('local.set', 0),
+        ('local.get', 0),
+        ('sub',),
+    ])
+
+
+def memory_counter():
+    #   fun f(addr)
+    #       memory[addr] = memory[addr] + 1
+    return Function(nparams=1, returns=False, code=[
+        ('local.get', 0),
+        ('local.get', 0),
+        ('load',),
+        ('const', 1.0),
+        ('add',),
+        ('store',),
+    ])
+
+
+@pytest.mark.parametrize("func, args", [
+    (sum_to(), (100.0,)),
+    (nested_break(), (0.0,)),
+    (nested_break(), (20.0,)),
+    (swap_through_stack(), (5.0, 2.0)),
+])
+def test_translate_matches_interpreter(func, args):
+    vm = VirtualMachine(functions=[func])
+    native = translate(func, vm)
+    assert native(*args) == vm.call(func, *args)
+
+
+def test_translate_memory_access():
+    func = memory_counter()
+    vm = VirtualMachine(functions=[func])
+    vm.store(8, 41.0)
+    native = translate(func, vm)
+    assert native(8) is None
+    assert vm.load(8) == 42.0
+
+
+def test_translate_external_call():
+    values = []
+    show = ExternalFunction(nparams=2, returns=True, call=lambda x, y: values.append((x, y)) or x + y)
+    func = Function(nparams=1, returns=True, code=[
+        ('local.get', 0),
+        ('const', 1.0),
+        ('call', 0),
+    ])
+    native = translate(func, VirtualMachine(functions=[show, func]))
+    assert native(2.0) == 3.0
+    assert values == [(2.0, 1.0)]
+
+
+@pytest.mark.parametrize("code", [
+    [('local.get', 0), ('call', 0)],                                # guest call
+    [('local.get', 0), ('block', [('local.get', 0), ('add',)])],    # value across a block
+    [('local.get', 0), ('local.get', 0)],                           # leftover values
+    [('local.get', 0), ('load.vec', 1)],                            # unsupported opcode
+    [('local.get', 0), ('call', 1)],                                # async external call
+    [('local.get', 0), ('call', 2), ('local.get', 0)],              # batched external call
+])
+def test_translate_untranslatable(code):
+    func = Function(nparams=1, returns=True, code=code)
+    functions = [func, AsyncExternalFunction(1, True, None), BatchedExternalFunction(1, None)]
+    with pytest.raises(Untranslatable):
+        translate(func, VirtualMachine(functions=functions))
+
+
+def test_vm_tier_up():
+    func = sum_to()
+    vm = VirtualMachine(functions=[func], jit_threshold=3)
+    for _ in range(5):
+        vm.execute(instructions=[('const', 10.0), ('call', 0)])
+    assert vm.stack == [55.0] * 5
+    code = vm._code[func]
+    assert code.native is not None
+    assert code.calls == 3
+
+
+def test_vm_tier_up_falls_back_to_interpreter():
+    #   fun countdown(x)
+    #       if x <= 0: return x
+    #       return countdown(x - 1)
+    countdown = Function(nparams=1, returns=True, code=[
+        ('block', [
+            ('const', 0.0),
+            ('local.get', 0),
+            ('ge',),
+            ('br_if', 0),
+            ('local.get', 0),
+            ('const', 1.0),
+            ('sub',),
+            ('call', 0),
+            ('return',),
+        ]),
+        ('local.get', 0),
+    ])
+    vm = VirtualMachine(functions=[countdown], jit_threshold=2)
+    vm.execute(instructions=[('const', 10.0), ('call', 0)])
+    assert vm.stack == [0.0]
+    assert vm._code[countdown].native is None
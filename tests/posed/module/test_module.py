@@ -0,0 +1,117 @@
+import pytest
+
+from posed.module import LazyCode, ModuleError, dump, dumps, load, loads, _sleb, _uleb, _Reader
+from posed.vm import ExternalFunction, Function, VirtualMachine, fuse
+from tests.posed.vm.test_vm import countdown_recursive
+
+
+def sum_to():
+    #   fun sum_to(n, total=0, addr=8)
+    #       while n > 0: total += n; n -= 1
+    #       memory[addr] = total
+    return Function(nparams=1, returns=False, nlocals=4, code=[
+        ('const', 8),
+        ('local.set', 2),
+        ('block', [
+            ('loop', [
+                ('const', 0.0),
+                ('local.get', 0),
+                ('ge',),
+                ('br_if', 1),
+                ('local.get', 1),
+                ('local.get', 0),
+                ('add',),
+                ('local.set', 1),
+                ('local.get', 0),
+                ('const', 1.0),
+                ('sub',),
+                ('local.set', 0),
+                ('br', 0),
+            ]),
+        ]),
+        ('local.get', 2),
+        ('local.get', 1),
+        ('store',),
+    ])
+
+
+@pytest.mark.parametrize("value", [0, 1, 63, 64, 127, 128, 300, 2 ** 64, -1, -64, -65, -128, -(2 ** 70)])
+def test_leb128_round_trip(value):
+    out = bytearray()
+    _sleb(out, value)
+    assert _Reader(out).sleb() == value
+    if value >= 0:
+        out = bytearray()
+        _uleb(out, value)
+        assert _Reader(out).uleb() == value
+
+
+def test_leb128_encoding():
+    out = bytearray()
+    _uleb(out, 624485)
+    assert out == b'\xe5\x8e\x26'
+    out = bytearray()
+    _sleb(out, -123456)
+    assert out == b'\xc0\xbb\x78'
+
+
+def test_module_round_trip():
+    functions = [countdown_recursive(), sum_to(), Function(nparams=0, returns=True, code=fuse([
+        ('local.get', 0),
+        ('const', 2.5),
+        ('mul',),
+        ('local.set', 0),
+        ('memory.size',),
+        ('load.vec', 2),
+        ('store.vec', 2),
+    ]))]
+    loaded = loads(dumps(functions))
+    for original, func in zip(functions, loaded):
+        assert (func.nparams, func.returns, func.nlocals) == (original.nparams, original.returns, original.nlocals)
+        assert list(func.code) == list(original.code)
+    assert [type(arg) for _, arg in loaded[1].code[:2]] == [int, int]
+
+
+def test_module_imports():
+    calls = []
+    log = ExternalFunction(nparams=1, returns=False, call=calls.append)
+    data = dumps([log], imports={'log': log})
+    other = ExternalFunction(nparams=1, returns=False, call=calls.append)
+    assert loads(data, imports={'log': other}) == [other]
+    with pytest.raises(ModuleError, match='Unresolved'):
+        loads(data)
+    with pytest.raises(ModuleError, match='signature'):
+        loads(data, imports={'log': ExternalFunction(nparams=2, returns=False, call=print)})
+    with pytest.raises(ModuleError, match='import name'):
+        dumps([log])
+
+
+def test_module_invalid():
+    data = dumps([countdown_recursive()])
+    with pytest.raises(ModuleError, match='Not a posed module'):
+        loads(b'junk' + data[4:])
+    with pytest.raises(ModuleError, match='version'):
+        loads(data[:4] + b'\x7f' + data[5:])
+    with pytest.raises(ModuleError, match='end of module'):
+        loads(data[:8])
+    with pytest.raises(ModuleError, match='Unsupported opcode'):
+        dumps([Function(nparams=0, returns=False, code=[('foo',)])])
+    with pytest.raises(ModuleError, match='Unsupported constant'):
+        dumps([Function(nparams=0, returns=False, code=[('const', 'x')])])
+
+
+def test_module_load_is_lazy(tmp_path):
+    path = tmp_path / 'module.posed'
+    dump([countdown_recursive(), sum_to()], path)
+    functions = load(path)
+    assert all(isinstance(func.code, LazyCode) for func in functions)
+    assert all(func.code._instructions is None for func in functions)
+
+    vm = VirtualMachine(functions=functions)
+    vm.execute([('const', 10.0), ('call', 0)])
+    assert vm.pop() == 0.0
+    assert functions[0].code._instructions is not None
+    assert functions[1].code._instructions is None
+
+    vm.execute([('const', 100.0), ('call', 1)])
+    assert vm.load(8) == 5050.0
@@ -0,0 +1,71 @@
+import math
+import os
+
+import pytest
+
+from posed.pool import Pool, Result, _chunksize
+from posed.vm import CallStackOverflow, ExternalFunction, OutOfFuel
+from tests.posed.vm.test_vm import countdown_recursive
+
+
+def functions():
+    return [
+        countdown_recursive(),
+        ExternalFunction(nparams=1, returns=True, call=math.sqrt),
+        ExternalFunction(nparams=0, returns=True, call=os.getpid),
+    ]
+
+
+def test_pool_runs_functions_and_programs():
+    jobs = [
+        (0, (10.0,)),
+        (1, (16.0,)),
+        ([('local.get', 0), ('call', 1), ('const', 2.0), ('add',)], (9.0,)),
+        ([('const', 1.0), ('const', 2.0)], ()),
+    ]
+    with Pool(functions(), processes=2) as pool:
+        assert pool.map(jobs) == [0.0, 4.0, [5.0], [1.0, 2.0]]
+
+
+def test_pool_streams_results_with_errors():
+    jobs = [(0, (float(n),)) for n in range(20)]
+    jobs[3] = ([('const', 1.0), ('const', 0.0), ('div',)], ())
+    jobs[7] = (0, (1000.0,))
+    with Pool(functions(), processes=2, max_call_depth=100) as pool:
+        results = sorted(pool.imap(jobs, chunksize=3))
+        with pytest.raises(ZeroDivisionError):
+            pool.map(jobs)
+    assert [result.index for result in results] == list(range(20))
+    assert isinstance(results[3].error, ZeroDivisionError)
+    assert isinstance(results[7].error, CallStackOverflow)
+    assert results[8] == Result(8, 0.0, None)
+
+
+def test_pool_workers_keep_their_vm():
+    with Pool(functions(), processes=2) as pool:
+        pids = {value for _, value, _ in pool.imap([(2, ())] * 100, chunksize=1)}
+    assert 1 <= len(pids) <= 2
+
+
+def test_pool_refills_fuel_for_each_job():
+    #   each job needs most of the fuel, so would run out if it weren't refilled
+    with Pool(functions(), processes=1, fuel=100) as pool:
+        results = sorted(pool.imap([(0, (10.0,))] * 10 + [(0, (20.0,))]))
+    assert [result.value for result in results[:10]] == [0.0] * 10
+    assert isinstance(results[10].error, OutOfFuel)
+
+
+def test_pool_accepts_iterators():
+    with Pool(functions(), processes=2) as pool:
+        results = pool.imap((1, (float(n * n),)) for n in range(50))
+        assert sorted(value for _, value, _ in results) == [float(n) for n in range(50)]
+
+
+@pytest.mark.parametrize("njobs, processes, expected", [
+    (None, 4, 32),
+    (1, 4, 1),
+    (100, 4, 7),
+    (1000000, 4, 256),
+])
+def test_chunksize(njobs, processes, expected):
+    assert _chunksize(njobs, processes) == expected
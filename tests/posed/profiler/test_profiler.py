@@ -0,0 +1,124 @@
+import time
+
+import pytest
+
+from posed.profiler import CountingProfiler, FunctionStats, SamplingProfiler
+from posed.vm import ExternalFunction, Function, VirtualMachine, lower, _run_fast
+from tests.posed.jit.test_jit import sum_to
+from tests.posed.vm.test_vm import countdown_recursive
+
+
+def functions():
+    #   fun both(x) = sum_to(x) + countdown(x)
+    return [
+        countdown_recursive(),
+        sum_to(),
+        Function(nparams=1, returns=True, code=[
+            ('local.get', 0),
+            ('call', 1),
+            ('local.get', 0),
+            ('call', 0),
+            ('add',),
+        ]),
+        ExternalFunction(nparams=0, returns=False, call=lambda: time.sleep(0.05)),
+    ]
+
+
+@pytest.mark.parametrize("fused", [True, False])
+def test_counting_profiler(fused):
+    vm = VirtualMachine(functions=functions(), fused=fused)
+    with CountingProfiler(vm, names={2: 'both'}) as profiler:
+        vm.execute([('const', 10.0), ('call', 2)])
+    assert vm.stack == [55.0]
+    assert vm._run is _run_fast and vm.profile is None
+
+    stats = profiler.functions()
+    assert set(stats) == {None, 0, 1, 2}
+    assert stats[0].calls == 11
+    assert stats[2] == FunctionStats(1, 6, stats[2].seconds)
+    assert stats[None].instructions == 3
+    assert sum(s.instructions for s in stats.values()) == sum(profiler.opcodes().values())
+
+    opcodes = profiler.opcodes()
+    assert opcodes['call'] == 13
+    if fused:
+        assert opcodes['const.local.op.br_if'] == 11 + 11
+    else:
+        assert opcodes['ge'] == 11 + 11
+        assert opcodes['add'] == 10 + 1
+
+    assert profiler.loops() == [(1, [0, 0], 11)]
+    countdown = 4 if fused else 9   # instructions per recursive call
+    assert profiler.collapsed().splitlines()[:4] == [
+        'main 3',
+        'main;both 6',
+        f'main;both;f0 {countdown}',
+        f'main;both;f0;f0 {countdown}',
+    ]
+    assert 'main;both;f1 ' in profiler.collapsed()
+    assert 'f1 [0, 0]' in profiler.report()
+
+
+def test_counting_profiler_time():
+    vm = VirtualMachine(functions=functions())
+    with CountingProfiler(vm) as profiler:
+        vm.execute([('const', 10.0), ('call', 2), ('call', 3)])
+    stats = profiler.functions()
+    assert stats[None].seconds >= 0.05
+    assert stats[3].calls == 1
+    assert 'main ' in profiler.collapsed(weight='microseconds')
+
+
+def test_counting_profiler_resumes():
+    vm = VirtualMachine(functions=functions(), fuel=20)
+    with CountingProfiler(vm) as profiler:
+        state = None
+        while True:
+            try:
+                if state is None:
+                    vm.execute([('const', 10.0), ('call', 2)])
+                else:
+                    vm.resume(state, fuel=20)
+                break
+            except Exception as e:
+                state = e.state
+    assert vm.stack == [55.0]
+    assert profiler.functions()[0].calls == 11
+    assert profiler.loops() == [(1, [0, 0], 11)]
+
+
+def test_sampling_profiler():
+    vm = VirtualMachine(functions=functions())
+    with SamplingProfiler(vm, interval=0.0005) as profiler:
+        deadline = time.perf_counter() + 0.3
+        while time.perf_counter() < deadline:
+            vm.execute([('const', 200.0), ('call', 2)])
+            vm.stack.clear()
+    assert sum(profiler.samples.values()) > 0
+    assert set(profiler.functions()) <= {None, 0, 1, 2}
+    assert profiler.elapsed >= 0.3
+    for line in profiler.collapsed().splitlines():
+        stack, count = line.rsplit(' ', 1)
+        #   main only runs for a few instructions around its call to f2
+        assert (stack.startswith('main;f2') or stack == 'main') and int(count) > 0
+    assert 'seconds' in profiler.report()
+
+
+def test_sampling_profiler_drops_torn_stacks():
+    vm = VirtualMachine(functions=functions())
+    main = lower([('const', 10.0), ('call', 2)])
+    vm.run(main, [])
+    f0, f2 = vm._code[vm.functions[0]], vm._code[vm.functions[2]]
+    profiler = SamplingProfiler(vm)
+
+    def run(code, pc, frames):
+        #   stands in for the dispatch loop, sampled with the state it would be in
+        profiler.sample()
+
+    profiler._run_code = {run.__code__}
+    run(f0, 1, [(main, 2, []), (f2, 4, [])])
+    #   mid call: main's frame pushed but code not yet switched to f2
+    run(main, 2, [(main, 2, [])])
+    #   mid return: f0 returning to f2, f2's frame popped but code still f0
+    run(f0, len(f0.instructions), [(main, 2, [])])
+    assert profiler.samples == {(main, f2, f0): 1}
@@ -0,0 +1,90 @@
+import pytest
+
+from posed.verifier import VerifyError, verify, verify_function, verify_functions
+from posed.vm import ExternalFunction, Function, VirtualMachine
+from tests.posed.vm.test_vm import countdown_recursive
+
+
+def test_verify_max_stack():
+    #   1 + 2 * 3 / 4
+    assert verify([
+        ('const', 1.0),
+        ('const', 2.0),
+        ('const', 3.0),
+        ('mul',),
+        ('const', 4.0),
+        ('div',),
+        ('add',),
+    ], functions=[]) == 3
+
+
+def test_verify_functions():
+    log = ExternalFunction(nparams=1, returns=False, call=print)
+    functions = [countdown_recursive(), log]
+    assert verify_functions(functions) == [2, None]
+
+
+@pytest.mark.parametrize("code, error", [
+    ([('add',)],
+     r"\[0\] \('add',\): Stack underflow, needs 2 values, has 0"),
+    ([('block', [('const', 1.0), ('loop', [('const', 1.0), ('br_if', 0), ('sub',)])])],
+     r"\[0, 1, 2\] \('sub',\): Stack underflow, needs 2 values, has 1"),
+    ([('block', [('const', 1.0), ('br', 2)])],
+     r"\[0, 1\] \('br', 2\): Branch level 2 exceeds nesting depth 1"),
+    ([('block', [('br', 0), ('br', 1)])],
+     r"\[0, 1\] \('br', 1\): Branch level 1 exceeds nesting depth 1"),
+    ([('foo',)],
+     r"\[0\] \('foo',\): Unsupported opcode foo"),
+    ([('local.get', 0), ('local.get', 0), ('pow',)],
+     r"Unsupported opcode pow"),
+    ([('local.const.op', 0, 1.0, 'pow')],
+     r"Unsupported operator pow"),
+    ([('call', 5)],
+     r"\[0\] \('call', 5\): No function 5 in a table of 1"),
+    ([('loop', [('const', 1.0), ('br', 0)])],
+     r"Stack height 1 differs from 0 on entry to the loop"),
+    ([('block', [('const', 1.0), ('br_if', 0), ('const', 2.0)])],
+     r"\[0\] \('block', \[Ellipsis\]\): Stack height 1 differs from 0 at the end of the block"),
+])
+def test_verify_errors(code, error):
+    functions = [Function(nparams=1, returns=False, code=[])]
+    with pytest.raises(VerifyError, match=error):
+        verify(code, functions)
+
+
+def test_verify_returns():
+    with pytest.raises(VerifyError, match=r"\[2\] \('end',\): Function must return with its return value, has 0"):
+        verify_function(Function(nparams=1, returns=True, code=[('local.get', 0), ('local.set', 0)]), [])
+    with pytest.raises(VerifyError, match=r"\[1\] \('return',\): .* an empty stack, has 1"):
+        verify_function(Function(nparams=0, returns=False, code=[('const', 1.0), ('return',), ('add',)]), [])
+
+
+def test_verify_call_arity():
+    add = Function(nparams=2, returns=True, code=[('local.get', 0), ('local.get', 1), ('add',)])
+    with pytest.raises(VerifyError, match=r"\[1\] \('call', 0\): Stack underflow, needs 2 values, has 1"):
+        verify([('const', 1.0), ('call', 0)], [add])
+
+
+def test_verify_locals():
+    with pytest.raises(VerifyError, match=r"Local 2 out of range for 2 locals"):
+        verify_function(Function(nparams=1, returns=False, nlocals=2, code=[('local.get', 2), ('local.set', 0)]), [])
+
+
+def test_verify_unreachable_code():
+    assert verify([('block', [('br', 0), ('add',), ('add',)]), ('const', 1.0)], []) == 1
+
+
+def test_vm_verify():
+    bad = Function(nparams=0, returns=True, code=[('const', 1.0), ('const', 2.0)])
+    vm = VirtualMachine(functions=[countdown_recursive(), bad], verify=True)
+    vm.execute([('const', 10.0), ('call', 0)])
+    assert vm.pop() == 0.0
+    assert vm._code[vm.functions[0]].max_stack == 2
+    with pytest.raises(VerifyError, match=r'\[2\] \(\'end\',\)'):
+        vm.execute([('call', 1)])
+    with pytest.raises(VerifyError, match='Stack underflow'):
+        vm.execute([('add',)])
+    vm.push(1.0)
+    vm.push(2.0)
+    vm.execute([('add',)])
+    assert vm.stack == [3.0]
@@ -1,6 +1,14 @@
+import itertools
+import logging
+import struct
+
 import pytest
 
-from posed.vm import VirtualMachine, Function, InvalidOpcode, ExternalFunction
+from posed.vm import (
+    VirtualMachine, Function, InvalidOpcode, InvalidBranch, InvalidLocal, ExternalFunction, BatchedExternalFunction,
+    CallStackOverflow, OutOfFuel, OperandStack, VirtualMachineError,
+    lower, load_function, fuse, map_memory, BR, BR_IF, BR_FUEL, CONST, FUEL, RETURN, PAGE_SIZE,
+)
 
 
 def test_vm():
@@ -92,6 +100,97 @@ def test_vm_external_function_call():
     assert vm.stack == []
 
 
+@pytest.mark.parametrize('nparams', [0, 1, 2, 3])
+@pytest.mark.parametrize('stack_pointer', [False, True])
+def test_vm_external_function_args(nparams, stack_pointer):
+    calls = []
+
+    def record(*args):
+        calls.append(args)
+        return float(len(calls))
+
+    vm = VirtualMachine(functions=[ExternalFunction(nparams, True, record)], stack_pointer=stack_pointer)
+    args = [float(i) for i in range(nparams)]
+    push_args = [('const', arg) for arg in args]
+    vm.execute([('const', 9.0), *push_args, ('call', 0), *push_args, ('call', 0)])
+    assert calls == [tuple(args), tuple(args)]
+    assert vm.stack == [9.0, 1.0, 2.0]
+
+
+def countdown_calling(index):
+    #   fun countdown(x)
+    #       while x > 0: f(x, x * 2); x = x - 1
+    return Function(nparams=1, returns=False, code=[
+        ('block', [
+            ('loop', [
+                ('const', 0.0),
+                ('local.get', 0),
+                ('ge',),
+                ('br_if', 1),
+                ('local.get', 0),
+                ('local.get', 0),
+                ('const', 2.0),
+                ('mul',),
+                ('call', index),
+                ('local.get', 0),
+                ('const', 1.0),
+                ('sub',),
+                ('local.set', 0),
+                ('br', 0),
+            ]),
+        ]),
+    ])
+
+
+@pytest.mark.parametrize('stack_pointer', [False, True])
+def test_vm_batched_external_function(stack_pointer):
+    batches = []
+    show = BatchedExternalFunction(nparams=2, call=lambda xs, ys: batches.append((xs, ys)), size=1000)
+    vm = VirtualMachine(functions=[show, countdown_calling(0)], stack_pointer=stack_pointer)
+    vm.execute([('const', 2500.0), ('call', 1)])
+    assert [len(xs) for xs, _ in batches] == [1000, 1000, 500]
+    xs = [x for batch, _ in batches for x in batch]
+    ys = [y for _, batch in batches for y in batch]
+    assert xs == [float(x) for x in range(2500, 0, -1)]
+    assert ys == [x * 2 for x in xs]
+    assert show.pending == [] and vm.stack == []
+
+
+def test_vm_batched_external_function_flush():
+    values = []
+    show = BatchedExternalFunction(nparams=1, call=values.extend)
+    vm = VirtualMachine(functions=[show])
+    vm.call(show, 1.0)
+    vm.call(show, 2.0)
+    assert values == []
+    vm.flush()
+    assert values == [1.0, 2.0]
+    vm.execute([('const', 3.0), ('call', 0)])
+    assert values == [1.0, 2.0, 3.0]
+    with pytest.raises(ValueError):
+        BatchedExternalFunction(nparams=0, call=print)
+
+
+@pytest.mark.parametrize('stack_pointer', [False, True])
+def test_vm_batched_external_function_flushed_on_error(stack_pointer):
+    values = []
+    show = BatchedExternalFunction(nparams=1, call=values.extend)
+    vm = VirtualMachine(functions=[show], stack_pointer=stack_pointer)
+    with pytest.raises(ZeroDivisionError):
+        vm.execute([('const', 1.0), ('call', 0), ('const', 1.0), ('const', 0.0), ('div',)])
+    assert values == [1.0] and show.pending == []
+
+
+def test_vm_batched_external_function_shared_between_vms():
+    values = []
+    show = BatchedExternalFunction(nparams=1, call=values.extend)
+    a = VirtualMachine(functions=[show])
+    b = VirtualMachine(functions=[show])
+    a.call(show, 1.0)       # left queued by a
+    b.execute([('const', 2.0), ('call', 0)])
+    assert values == [1.0, 2.0] and show.pending == []
+
+
 @pytest.mark.parametrize("x, y, opcode, expected_result", [
     (2.0, 3.0, 'add', 5.0),
     (2.0, 3.0, 'mul', 6.0),
@@ -173,3 +272,662 @@ def test_vm_invalid_opcode():
 
     with pytest.raises(InvalidOpcode):
         vm.execute(instructions=[('foo',),], locals_=None)
+
+
+def test_lower_resolves_branch_targets():
+    code = lower([
+        ('block', [
+            ('loop', [
+                ('const', 1.0),
+                ('br_if', 1),
+                ('br', 0),
+            ]),
+        ]),
+    ])
+    assert code.instructions == [
+        (CONST, 1.0),
+        (BR_IF, 3),
+        (BR, 0),
+        (RETURN, None),
+    ]
+
+
+def test_lower_invalid_branch():
+    with pytest.raises(InvalidBranch):
+        lower([('block', [('br', 1)])])
+
+
+def test_lower_invalid_opcode():
+    with pytest.raises(InvalidOpcode):
+        lower([('block', [('foo',)])])
+
+
+def test_vm_run_lowered_while_loop():
+    #   x = 0
+    #   while x < 10
+    #       x = x + 1
+    program = [
+        ('const', 0.0),
+        ('local.set', 0),
+        ('block', [
+            ('loop', [
+                ('const', 10.0),
+                ('local.get', 0),
+                ('le',),
+                ('br_if', 1),
+                ('local.get', 0),
+                ('const', 1.0),
+                ('add',),
+                ('local.set', 0),
+                ('br', 0),
+            ]),
+        ]),
+        ('local.get', 0),
+    ]
+    vm = VirtualMachine(functions=[])
+    vm.run(lower(program), [0.0])
+    assert vm.stack == [10.0]
+
+
+def test_vm_function_call_recursive():
+    #   fun sum(x)
+    #       if x <= 0:
+    #           return 0
+    #       return x + sum(x - 1)
+    sum_ = Function(nparams=1, returns=True, code=[
+        ('block', [
+            ('const', 0.0),
+            ('local.get', 0),
+            ('ge',),
+            ('br_if', 0),
+            ('local.get', 0),
+            ('local.get', 0),
+            ('const', 1.0),
+            ('sub',),
+            ('call', 0),
+            ('add',),
+            ('return',),
+        ]),
+        ('const', 0.0),
+    ])
+
+    vm = VirtualMachine(functions=[sum_])
+    vm.execute(instructions=[
+        ('const', 10.0),
+        ('call', 0),
+    ], locals_=None)
+    assert vm.stack == [55.0]
+
+
+def test_vm_execute_multi_level_break():
+    #   for x in 0..: for y in 0..: if x * y >= 6: break outer
+    program = [
+        ('const', 0.0),
+        ('local.set', 0),
+        ('block', [                 # label : 2 (from the inner loop)
+            ('loop', [              # label : 1
+                ('const', 0.0),
+                ('local.set', 1),
+                ('block', [
+                    ('loop', [      # label : 0
+                        ('local.get', 0),
+                        ('local.get', 1),
+                        ('mul',),
+                        ('const', 6.0),
+                        ('ge',),
+                        ('br_if', 3),   # break out of both loops
+                        ('local.get', 1),
+                        ('const', 1.0),
+                        ('add',),
+                        ('local.set', 1),
+                        ('const', 3.0),
+                        ('local.get', 1),
+                        ('le',),
+                        ('br_if', 1),   # break inner loop
+                        ('br', 0),
+                    ]),
+                ]),
+                ('local.get', 0),
+                ('const', 1.0),
+                ('add',),
+                ('local.set', 0),
+                ('br', 0),
+            ]),
+        ]),
+        ('local.get', 0),
+        ('local.get', 1),
+    ]
+    vm = VirtualMachine(functions=[])
+    vm.execute(instructions=program, locals_=None)
+    assert vm.stack == [3.0, 2.0]
+
+
+def test_vm_return_from_nested_loop():
+    #   fun first_multiple(n)
+    #       x = 1
+    #       while True:
+    #           if x % n == 0: return x
+    #           x = x + 1
+    first_multiple = Function(nparams=1, returns=True, code=[
+        ('const', 1.0),
+        ('local.set', 1),
+        ('block', [
+            ('loop', [
+                ('local.get', 1),
+                ('local.get', 0),
+                ('mod',),
+                ('const', 0.0),
+                ('eq',),
+                ('block', [
+                    ('br_if', 0),
+                    ('local.get', 1),
+                    ('const', 1.0),
+                    ('add',),
+                    ('local.set', 1),
+                    ('br', 1),
+                ]),
+                ('local.get', 1),
+                ('return',),
+            ]),
+        ]),
+        ('const', -1.0),
+    ])
+
+    vm = VirtualMachine(functions=[first_multiple])
+    vm.execute(instructions=[
+        ('const', 7.0),
+        ('call', 0),
+    ], locals_=None)
+    assert vm.stack == [7.0]
+
+
+def test_vm_debug_traces_instructions(caplog):
+    vm = VirtualMachine(functions=[], debug=True)
+    with caplog.at_level(logging.DEBUG, logger='VirtualMachine'):
+        vm.execute(instructions=[('const', 1.0)], locals_=None)
+    assert 'OPCODE: const, ARG: 1.0' in caplog.text
+    assert 'STACK: [1.0]' in caplog.text
+
+
+def test_vm_debug_leaves_logger_levels_alone():
+    logger = logging.getLogger('VirtualMachine')
+    level = logger.level
+    VirtualMachine(functions=[], debug=True)
+    assert logger.level == level
+
+
+def test_vm_without_debug_does_not_trace_or_configure_logging(caplog, monkeypatch):
+    def basic_config(**kwargs):
+        raise AssertionError('logging configured')
+
+    monkeypatch.setattr(logging, 'basicConfig', basic_config)
+    vm = VirtualMachine(functions=[], debug=False)
+    with caplog.at_level(logging.DEBUG, logger='VirtualMachine'):
+        vm.execute(instructions=[('const', 1.0)], locals_=None)
+    assert caplog.text == ''
+
+
+def test_vm_load_and_store_many():
+    vm = VirtualMachine(functions=[], memory_size=32)
+    vm.store_many(4, [1.0, 2.0, 3.0])
+    assert vm.load(12) == 2.0
+    assert vm.load_many(4, 3) == [1.0, 2.0, 3.0]
+
+
+def test_vm_execute_vector_load_store():
+    vm = VirtualMachine(functions=[], memory_size=64)
+    vm.execute(instructions=[
+        ('const', 8),
+        ('const', 1.0),
+        ('const', 2.0),
+        ('const', 3.0),
+        ('store.vec', 3),
+        ('const', 16),
+        ('load.vec', 2),
+    ], locals_=None)
+    assert vm.stack == [2.0, 3.0]
+    assert vm.load_many(8, 3) == [1.0, 2.0, 3.0]
+
+
+def test_vm_execute_memory_copy_and_fill():
+    vm = VirtualMachine(functions=[], memory_size=16)
+    vm.memory[0:8] = b'abcdefgh'
+    vm.execute(instructions=[
+        ('const', 2),   # dst
+        ('const', 0),   # src
+        ('const', 6),   # nbytes
+        ('memory.copy',),
+        ('const', 10),
+        ('const', ord('z')),
+        ('const', 4),
+        ('memory.fill',),
+    ], locals_=None)
+    assert vm.memory == b'ababcdef\x00\x00zzzz\x00\x00'
+    assert vm.stack == []
+
+
+def test_vm_execute_memory_copy_and_fill_with_floats():
+    vm = VirtualMachine(functions=[], memory_size=16)
+    vm.memory[0:8] = b'abcdefgh'
+    vm.execute(instructions=[
+        ('const', 2.0),
+        ('const', 0.0),
+        ('const', 6.0),
+        ('memory.copy',),
+        ('const', 10.0),
+        ('const', float(ord('z'))),
+        ('const', 4.0),
+        ('memory.fill',),
+    ], locals_=None)
+    assert vm.memory == b'ababcdef\x00\x00zzzz\x00\x00'
+
+
+def test_vm_memory_copy_out_of_bounds():
+    vm = VirtualMachine(functions=[], memory_size=16)
+    with pytest.raises(IndexError):
+        vm.copy(8, 0, 9)
+    with pytest.raises(IndexError):
+        vm.fill(-1, 0, 4)
+
+
+def test_vm_execute_memory_size_and_grow():
+    vm = VirtualMachine(functions=[], max_memory_size=3 * PAGE_SIZE)
+    vm.store(100, 42.0)
+    vm.execute(instructions=[
+        ('memory.size',),
+        ('const', 2.0),
+        ('memory.grow',),
+        ('memory.size',),
+        ('const', 1),
+        ('memory.grow',),
+    ], locals_=None)
+    assert vm.stack == [1, 1, 3, -1]
+    assert len(vm.memory) == 3 * PAGE_SIZE
+    assert vm.load(100) == 42.0
+
+
+def test_vm_memory_mapped_file(tmp_path):
+    path = tmp_path / 'heap.bin'
+    path.write_bytes(struct.pack('<2d', 1.0, 2.0))
+
+    shared = [VirtualMachine(functions=[], memory=map_memory(path, 'read')) for _ in range(2)]
+    for vm in shared:
+        vm.execute(instructions=[('const', 0), ('load.vec', 2)], locals_=None)
+        assert vm.stack == [1.0, 2.0]
+        with pytest.raises(TypeError):
+            vm.store(0, 3.0)
+        assert vm.grow(1) == -1
+
+    private = VirtualMachine(functions=[], memory=map_memory(path, 'copy'))
+    private.store(0, 3.0)
+    assert private.load(0) == 3.0
+    assert path.read_bytes() == struct.pack('<2d', 1.0, 2.0)
+
+    writable = VirtualMachine(functions=[], memory=map_memory(path, 'write'))
+    writable.store(8, 4.0)
+    writable.memory.flush()
+    assert path.read_bytes() == struct.pack('<2d', 1.0, 4.0)
+    assert writable.grow(1) == 0
+    assert path.stat().st_size == 16 + PAGE_SIZE
+
+
+
+def test_vm_snapshot_and_restore():
+    vm = VirtualMachine(functions=[], memory_size=PAGE_SIZE, fuel=100)
+    vm.store_many(0, [1.0, 2.0])
+    vm.push(3.0)
+    snapshot = vm.snapshot()
+
+    vm.store(0, 42.0)
+    vm.grow(1)
+    vm.push(4.0)
+    vm.fuel = 7
+    vm.restore(snapshot)
+    assert vm.load_many(0, 2) == [1.0, 2.0]
+    assert len(vm.memory) == PAGE_SIZE
+    assert vm.stack == [3.0]
+    assert vm.fuel == 100
+
+
+def test_vm_clone_is_copy_on_write():
+    double = Function(nparams=1, returns=True, code=[('local.get', 0), ('const', 2.0), ('mul',)])
+    vm = VirtualMachine(functions=[double])
+    vm.execute([('const', 8), ('const', 21.0), ('call', 0), ('store',)])
+    warm = vm.snapshot()
+
+    clones = [vm.clone(warm) for _ in range(3)]
+    clones[0].store(8, 1.0)
+    assert clones[0].load(8) == 1.0
+    assert [clone.load(8) for clone in clones[1:]] == [42.0, 42.0]
+    assert vm.load(8) == 42.0
+    assert clones[1].call(double, 4.0) == 8.0
+    assert clones[1]._code is vm._code
+    assert clones[2].grow(1) == -1
+
+    vm.store(8, 2.0)
+    assert vm.clone().load(8) == 2.0
+    assert vm.clone(warm).load(8) == 42.0
+
+
+def test_vm_clone_of_empty_memory():
+    vm = VirtualMachine(functions=[], memory_size=0)
+    vm.push(1.0)
+    clone = vm.clone()
+    assert clone.stack == [1.0]
+    assert clone.stack is not vm.stack
+    assert clone.grow(1) == 0
+
+def test_load_function_locals():
+    func = Function(nparams=1, returns=False, code=[
+        ('local.get', 0),
+        ('local.set', 2),
+    ])
+    assert load_function(func).nlocals == 3
+
+    func.nlocals = 4
+    assert load_function(func).nlocals == 4
+
+    func.nlocals = 2
+    with pytest.raises(InvalidLocal):
+        load_function(func)
+
+
+def test_vm_function_frames_are_reused_and_reset():
+    #   fun f(x)
+    #       y = y + x
+    #       return y
+    f = Function(nparams=1, returns=True, nlocals=2, code=[
+        ('local.get', 1),
+        ('local.get', 0),
+        ('add',),
+        ('local.set', 1),
+        ('local.get', 1),
+    ])
+
+    vm = VirtualMachine(functions=[f])
+    assert vm.call(f, 2.0) == 2.0
+    assert vm.call(f, 3.0) == 3.0
+    assert len(vm._code[f].frames) == 1
+
+
+def test_vm_execute_locals_by_index():
+    vm = VirtualMachine(functions=[])
+    vm.execute([('local.get', 0), ('local.get', 2), ('local.get', 1)], {0: 7.0, 2: 9.0})
+    assert vm.stack == [7.0, 9.0, 0.0]
+
+
+def test_vm_call_checks_argument_count():
+    f = Function(nparams=1, returns=True, nlocals=2, code=[('local.get', 0), ('local.get', 1), ('add',)])
+    vm = VirtualMachine(functions=[f])
+    assert vm.call(f, 2.0) == 2.0
+    for args in [(), (1.0, 2.0, 3.0)]:
+        with pytest.raises(VirtualMachineError):
+            vm.call(f, *args)
+    #   the pooled frame is left the right size
+    assert [len(locals_) for locals_ in vm._code[f].frames] == [2]
+    assert vm.call(f, 3.0) == 3.0
+
+
+def countdown_recursive():
+    #   fun countdown(x)
+    #       if x <= 0:
+    #           return 0
+    #       return countdown(x - 1)
+    return Function(nparams=1, returns=True, code=[
+        ('block', [
+            ('const', 0.0),
+            ('local.get', 0),
+            ('ge',),
+            ('br_if', 0),
+            ('local.get', 0),
+            ('const', 1.0),
+            ('sub',),
+            ('call', 0),
+            ('return',),
+        ]),
+        ('local.get', 0),
+    ])
+
+
+def test_vm_deep_recursion_does_not_use_python_stack():
+    vm = VirtualMachine(functions=[countdown_recursive()])
+    vm.execute(instructions=[
+        ('const', 100000.0),
+        ('call', 0),
+    ])
+    assert vm.stack == [0.0]
+
+
+def test_vm_call_stack_overflow():
+    vm = VirtualMachine(functions=[countdown_recursive()], max_call_depth=100)
+    with pytest.raises(CallStackOverflow):
+        vm.execute(instructions=[
+            ('const', 1000.0),
+            ('call', 0),
+        ])
+
+
+def test_fuse():
+    assert fuse([
+        ('local.get', 0),
+        ('local.get', 1),
+        ('add',),
+        ('block', [
+            ('loop', [
+                ('const', 0.0),
+                ('local.get', 0),
+                ('ge',),
+                ('br_if', 1),
+                ('local.get', 0),
+                ('const', 1.0),
+                ('sub',),
+                ('local.set', 0),
+                ('local.get', 0),
+                ('const', 2.0),
+                ('mul',),
+                ('call', 0),
+                ('br', 0),
+            ]),
+        ]),
+    ]) == [
+        ('local.local.op', 0, 1, 'add'),
+        ('block', [
+            ('loop', [
+                ('const.local.op.br_if', 0.0, 0, 'ge', 1),
+                ('local.const.op.local.set', 0, 1.0, 'sub', 0),
+                ('local.const.op', 0, 2.0, 'mul'),
+                ('call', 0),
+                ('br', 0),
+            ]),
+        ]),
+    ]
+
+
+@pytest.mark.parametrize("functions, program", [
+    ([countdown_recursive()], [('const', 50.0), ('call', 0)]),
+    ([Function(nparams=2, returns=True, code=[
+        ('block', [
+            ('loop', [
+                ('const', 0.0),
+                ('local.get', 0),
+                ('ge',),
+                ('br_if', 1),
+                ('local.get', 1),
+                ('local.get', 0),
+                ('add',),
+                ('local.set', 1),
+                ('local.get', 0),
+                ('const', 1.0),
+                ('sub',),
+                ('local.set', 0),
+                ('br', 0),
+            ]),
+        ]),
+        ('local.get', 1),
+        ('local.get', 0),
+        ('const', 3.0),
+        ('mul',),
+        ('add',),
+    ])], [('const', 100.0), ('const', 0.0), ('call', 0)]),
+])
+def test_vm_fused_matches_unfused(functions, program):
+    results = []
+    for fused, stack_pointer in itertools.product((True, False), repeat=2):
+        vm = VirtualMachine(functions=functions, fused=fused, stack_pointer=stack_pointer)
+        vm.execute(instructions=program)
+        results.append(vm.stack)
+    assert all(result == results[0] for result in results)
+
+
+def test_operand_stack():
+    stack = OperandStack([1.0, 2.0])
+    stack.append(3.0)
+    stack.extend([4.0, 5.0])
+    assert stack == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert [1.0, 2.0, 3.0, 4.0, 5.0] == stack
+    assert stack.pop() == 5.0
+    assert stack[-1] == 4.0 and stack[1:3] == [2.0, 3.0]
+    del stack[1:3]
+    assert stack == [1.0, 4.0] and len(stack) == 2
+    stack[:] = [7.0]
+    stack.insert(0, 6.0)
+    assert list(stack) == [6.0, 7.0] and repr(stack) == '[6.0, 7.0]'
+    stack.reserve(100)
+    assert len(stack.items) >= 100 and stack == [6.0, 7.0]
+    stack.clear()
+    assert stack == [] and not stack
+    with pytest.raises(IndexError):
+        stack.pop()
+    with pytest.raises(IndexError):
+        stack[0]
+
+
+def test_vm_stack_pointer_memory_and_external_calls():
+    double = Function(nparams=1, returns=True, code=[('local.get', 0), ('const', 2.0), ('mul',)])
+    program = [
+        ('const', 0),
+        ('const', 1.0),
+        ('const', 2.0),
+        ('store.vec', 2),
+        ('const', 16),
+        ('const', 0),
+        ('const', 16),
+        ('memory.copy',),
+        ('const', 16),
+        ('load.vec', 2),
+        ('call', 1),
+        ('const', 8),
+        ('load',),
+        ('memory.size',),
+        ('const', 1),
+        ('memory.grow',),
+    ]
+    results = []
+    for stack_pointer in (False, True):
+        vm = VirtualMachine(functions=[], stack_pointer=stack_pointer)
+        #   an external function calling back into the VM
+        vm.functions = [double, ExternalFunction(nparams=1, returns=True, call=lambda x: vm.call(double, x) + 1.0)]
+        vm.push(42.0)
+        vm.execute(program)
+        results.append(list(vm.stack))
+    assert results[0] == results[1] == [42.0, 1.0, 5.0, 2.0, 1, 1]
+
+
+def test_vm_stack_pointer_needs_verified_code():
+    vm = VirtualMachine(functions=[], stack_pointer=True)
+    with pytest.raises(VirtualMachineError):
+        vm.run(lower([('const', 1.0)]), [])
+
+
+def countdown_loop():
+    #   fun countdown(x)
+    #       while x > 0: x = x - 1
+    #       return x
+    return Function(nparams=1, returns=True, code=[
+        ('block', [
+            ('loop', [
+                ('const', 0.0),
+                ('local.get', 0),
+                ('ge',),
+                ('br_if', 1),
+                ('local.get', 0),
+                ('const', 1.0),
+                ('sub',),
+                ('local.set', 0),
+                ('br', 0),
+            ]),
+        ]),
+        ('local.get', 0),
+    ])
+
+
+def test_lower_metered():
+    code = load_function(countdown_loop(), metered=True)
+    assert code.fuel == 1
+    assert code.instructions[8] == (BR_FUEL, (0, 9))
+    assert code.instructions[3] == (BR_IF, 9)
+
+    code = lower([
+        ('const', 1.0),
+        ('loop', [
+            ('const', 1.0),
+            ('br_if', 0),
+        ]),
+        ('const', 2.0),
+    ], metered=True)
+    assert code.fuel == 1
+    assert code.instructions == [(CONST, 1.0), (CONST, 1.0), (FUEL, 2), (BR_IF, 1), (CONST, 2.0), (RETURN, None)]
+
+
+@pytest.mark.parametrize("functions, fused", [
+    ([countdown_loop()], True),
+    ([countdown_loop()], False),
+    ([countdown_recursive()], True),
+])
+@pytest.mark.parametrize('stack_pointer', [False, True])
+def test_vm_out_of_fuel_resumes(functions, fused, stack_pointer):
+    vm = VirtualMachine(functions=functions, fused=fused, fuel=50, stack_pointer=stack_pointer)
+    program = [('const', 1.0), ('const', 500.0), ('call', 0), ('add',)]
+    slices = 0
+    try:
+        vm.execute(program)
+    except OutOfFuel as e:
+        state = e.state
+        while True:
+            slices += 1
+            assert 0 <= vm.fuel < 50
+            try:
+                vm.resume(state, fuel=50)
+                break
+            except OutOfFuel as e:
+                state = e.state
+    assert vm.stack == [1.0]
+    assert slices > 10
+
+
+def test_vm_out_of_fuel_stops_infinite_loops():
+    vm = VirtualMachine(functions=[], fuel=1000)
+    with pytest.raises(OutOfFuel):
+        vm.execute([('loop', [('br', 0)])])
+    assert vm.fuel == 0
+
+
+def test_vm_fuel_is_charged_for_instructions():
+    vm = VirtualMachine(functions=[countdown_loop()], fused=False, fuel=10000)
+    vm.execute([('const', 100.0), ('call', 0)])
+    assert vm.stack == [0.0]
+    assert vm.fuel == 10000 - 1 - 100 * 9
+
+
+def test_vm_fuel_is_charged_for_calls_into_loops():
+    #   the body starts with a loop so the call itself covers no instructions
+    recurse = Function(nparams=0, returns=False, code=[('loop', [('call', 0), ('br', 0)])])
+    vm = VirtualMachine(functions=[recurse], fuel=10)
+    with pytest.raises(OutOfFuel):
+        vm.execute([('call', 0)])
+    assert vm.fuel == 0
+
+
+def test_vm_fuel_without_jit():
+    with pytest.raises(ValueError):
+        VirtualMachine(functions=[], fuel=100, jit_threshold=10)